@@ -19,11 +19,11 @@ from scipy.signal import find_peaks
 #from scipy.signal import argrelextrema
 import math
 import openpyxl
-from xml.dom import minidom
 from scipy.interpolate import interp1d
 import time
 
 from ImageAnal import LocateImaging
+from LogReader import LoadImagingXML
 
 #start_time = time.time()
 
@@ -185,22 +185,16 @@ class ProcessManualRoiData:
         print('Loading imaging frames time...')
         prew_time = time.time() 
         offset = self.time_shift
-        # function that reads the action_log_file and finds the current stage
-        # minidom is an xml file interpreter for python
-        # hope it works for python 3.7...
-        imaging_logfile = minidom.parse(self.imaging_logfile_name)
-        voltage_rec = imaging_logfile.getElementsByTagName('VoltageRecording')
-        voltage_delay = float(voltage_rec[0].attributes['absoluteTime'].value)
+        # function that reads the frame times from the xml logfile of the imaging
+        imaging_times = LoadImagingXML(self.imaging_logfile_name)
+        voltage_delay = imaging_times['voltage_delay']
         ## the offset is the time of the first voltage signal in Labview time
         ## the signal's 0 has a slight delay compared to the time 0 of the imaging recording 
         ## we substract this delay from the offset to get the LabView time of the time 0 of the imaging recording
         corrected_offset = offset - voltage_delay
 #        print('   corrected offset:', corrected_offset, 'voltage_delay:', voltage_delay)        
 
-        frames = imaging_logfile.getElementsByTagName('Frame')
-        self.frame_times = np.zeros(len(frames)) # this is already in labview time
-        for i in range(len(frames)):
-            self.frame_times[i] = float(frames[i].attributes['relativeTime'].value) + corrected_offset
+        self.frame_times = imaging_times['relative_times'] + corrected_offset # this is already in labview time
 #        print('times from xml:', self.frame_times[0], self.frame_times[-1], self.frame_times[-1]-self.frame_times[0])
         #checking from here on
         if self.frame_times.size != self.M:
@@ -16,28 +16,87 @@ from matplotlib import colors as matcols
 from scipy.interpolate import interp1d
 import scipy.stats
 import csv
+import multiprocessing
 
 from utils import *
+from LogReader import *
 from Stages import *
 from Corridors import *
 
 ## a function to break a time series into Nbreak sections each at least Lmin long.
-def breakpoints(Nframes, Lmin=500, Nbreak=5, rngD=None):
+def breakpoints(Nframes, Lmin=500, Nbreak=5, rngD=None, size=None):
+    ## returns the start index and the length of the sections: 2 x (Nbreak+1) array
+    ## if size is given, size layouts are drawn at once: size x 2 x (Nbreak+1) array, the same as calling the function size times with the same rngD
     if (Nframes < (Lmin * Nbreak)):
         print('Nframes < (Lmin * Nbreak), we use smaller segments')
-        Lmin = floor(Nframes / Nbreak)
+        Lmin = math.floor(Nframes / Nbreak)
     alpha = np.ones(Nbreak+1)
-    seclengths = np.round(scipy.stats.dirichlet.rvs(alpha, random_state=rngD)[0] * (Nframes - Lmin * (Nbreak+1)) + Lmin) ## see Dirichlet distribution...
-    seclengths[Nbreak] = Nframes - np.sum(seclengths[0:Nbreak]) # the original list may be a bit longer or shorter...
-    sections = np.zeros((2, Nbreak+1))
-    for i in range(Nbreak+1):
-        sections[0,i] = np.sum(seclengths[0:i])# start index
-        sections[1,i] = seclengths[i]# length
+    N = 1 if size is None else size
+    seclengths = np.round(scipy.stats.dirichlet.rvs(alpha, size=N, random_state=rngD) * (Nframes - Lmin * (Nbreak+1)) + Lmin) ## see Dirichlet distribution...
+    seclengths[:,Nbreak] = Nframes - np.sum(seclengths[:,0:Nbreak], axis=1) # the original list may be a bit longer or shorter...
+    sections = np.zeros((N, 2, Nbreak+1))
+    sections[:,0,1:] = np.cumsum(seclengths[:,0:Nbreak], axis=1) # start index
+    sections[:,1,:] = seclengths # length
+    if size is None:
+        return sections[0]
     return sections
 
+def shift_shuffle_frames(Nframes, N_shuffle, rngP, rngI, rngD, Lmin=500, Nbreak=5):
+    ## index of the frames in N_shuffle shift-shuffles: N_shuffle x Nframes array
+    ## the frames are broken up into Nbreak+1 sections, which are permuted and circularly shifted by at least Lmin frames
+    ## the random numbers are the same as drawing the breakpoints, permutation and shift shuffle by shuffle
+    sections = breakpoints(Nframes=Nframes, Lmin=Lmin, Nbreak=Nbreak, rngD=rngD, size=N_shuffle).astype(int)
+    order = rngP.permuted(np.tile(np.arange(Nbreak+1), (N_shuffle, 1)), axis=1)
+    n_roll = rngI.integers((Nframes - 1000), size=N_shuffle) + 500
+
+    ## start of the sections in the original and in the permuted frames
+    starts = np.take_along_axis(sections[:,0,:], order, axis=1)
+    lengths = np.take_along_axis(sections[:,1,:], order, axis=1)
+    new_starts = np.cumsum(lengths, axis=1) - lengths
+
+    ## frame p of the shuffle is the frame (p - n_roll) of the permuted frames, which belongs to the last section starting before it
+    ## the sections of all shuffles are searched together by adding Nframes x shuffle index to the positions
+    shuffle_offset = (np.arange(N_shuffle) * Nframes).reshape(-1,1)
+    permuted_pos = (np.arange(Nframes).reshape(1,-1) - n_roll.reshape(-1,1)) % Nframes
+    i_section = np.searchsorted((new_starts + shuffle_offset).ravel(), (permuted_pos + shuffle_offset).ravel(), side='right') - 1
+    return permuted_pos + (starts - new_starts).ravel()[i_section].reshape(N_shuffle, Nframes)
+
+## the minibatches can be processed in parallel by a pool of processes
+## each process has its own copy of the ImShuffle object, but the spikes are read from shared memory
+shuffle_worker = None
+shuffle_worker_memory = None
+
+def init_shuffle_worker(state, shared_spikes_name, shape, dtype):
+    ## shared_memory requires python >= 3.8, it is only imported when the shuffles are run in parallel
+    from multiprocessing import shared_memory, util
+    global shuffle_worker, shuffle_worker_memory
+    shuffle_worker_memory = shared_memory.SharedMemory(name=shared_spikes_name)
+    shuffle_worker = ImShuffle.__new__(ImShuffle)
+    shuffle_worker.__dict__.update(state)
+    shuffle_worker.raw_spikes = np.ndarray(shape, dtype=dtype, buffer=shuffle_worker_memory.buf)
+    util.Finalize(None, close_shuffle_worker, exitpriority=10) # called when the worker exits
+
+def close_shuffle_worker():
+    ## the array using the shared memory is deleted before the memory is closed
+    global shuffle_worker, shuffle_worker_memory
+    shuffle_worker = None
+    if (shuffle_worker_memory is not None):
+        shuffle_worker_memory.close()
+        shuffle_worker_memory = None
+
+def shuffle_worker_minibatch(batch):
+    batch_ids, i_minibatch = batch
+    shuffle_worker.shuffle_minibatch(batch_ids, i_minibatch)
+    return {key:getattr(shuffle_worker, key) for key in ImShuffle.minibatch_results if hasattr(shuffle_worker, key)}
+
 class ImShuffle:
     'Base structure for shuffling analysis of imaging data'
-    def __init__(self, datapath, date_time, name, task, stage, raw_spikes, frame_times, frame_pos, frame_laps, N_shuffle=1000, cellids=np.array([-1]), mode='random', batchsize=None, selected_laps=None, speed_threshold=5, randseed=476, elfiz=False, min_Nlaps=5, multiplane=False):
+    ## attributes set by shuffle_minibatch() and used by merge_minibatch()
+    minibatch_results = ['cell_reliability_batch', 'P_reliability_batch', 'cell_skaggs_batch', 'P_skaggs_batch', 'cell_tuning_specificity_batch', 'P_tuning_specificity_batch', 'accepted_PCs_batch', 'candidate_PCs_batch', 'cell_corridor_selectivity_batch', 'P_corridor_selectivity_batch', 'cell_pattern_selectivity_batch', 'P_pattern_selectivity_batch', 'ratemaps_batch', 'cell_corridor_similarity_batch', 'P_corridor_similarity_batch']
+    ## maximal number of shuffled spikes (cells x frames x shuffles) generated at once in a minibatch
+    shuffle_chunk_size = 2**24
+
+    def __init__(self, datapath, date_time, name, task, stage, raw_spikes, frame_times, frame_pos, frame_laps, N_shuffle=1000, cellids=np.array([-1]), mode='random', batchsize=None, selected_laps=None, speed_threshold=5, randseed=476, elfiz=False, min_Nlaps=5, multiplane=False, n_workers=1):
         ###########################################
         ## setting basic parameters for the session
         ###########################################
@@ -135,7 +194,7 @@ class ImShuffle:
         ###########################################
         ## shuffling in minibatches - to save memory when running high number of shuffles with a lots of cells
         ## defining containers for the P-values
-        ## still not super efficient as we load the behavior data separately for each minibatch...
+        ## the behavioral data is loaded only once and the laps are reused by all minibatches
         if batchsize is None:
             self.batchsize = self.N_cells
         else:
@@ -153,6 +212,7 @@ class ImShuffle:
         self.P_tuning_specificity=[] # a list, each element is a vector with the the P value estimated from shuffle control - P(specificity > measured)
 
         self.accepted_PCs = [] # a list, each element is a vector of Trues and Falses of candidate place cells with at least 1 place field according to Hainmuller and Bartos 2018
+        self.candidate_PCs = [] # a list, each element is a cells x (N_shuffle+1) matrix of candidate place cells in the shuffles, the last column is the real data
 
         self.cell_corridor_selectivity = np.zeros([2, self.N_cells, self.N_shuffle]) # a matrix with the selectivity index of the cells. Second row indicates the corridor with the highers rate.
         self.P_corridor_selectivity = np.zeros([self.N_cells])
@@ -160,209 +220,247 @@ class ImShuffle:
         self.cell_corridor_similarity = np.zeros([self.N_cells, self.N_shuffle]) # a vector with the similarity index of the cells.
         self.P_corridor_similarity = np.zeros([self.N_cells])
 
+        ##################################################
+        ## loading behavioral data
+        ##################################################
+
+        self.shuffle_ImLaps = [] # list containing a special class for storing the imaging and behavioral data for single laps
+        self.n_laps = 0 # total number of laps
+        self.i_Laps_ImData = np.zeros(1) # np array with the index of laps with imaging
+        self.i_corridors = np.zeros(1) # np array with the index of corridors in each run
+
+        self.get_lapdata_shuffle(self.datapath, self.date_time, self.name, self.task, selected_laps=self.selected_laps) # collects all behavioral data and sort it into laps, storing each in a Shuffle_ImData object - the spikes are added for each minibatch
+
+        ## in certain tasks, the same corridor may appear multiple times in different substages
+        ## we need to keep this corridor in the list self.all_corridors for running self.get_lapdata()
+        ## but we should remove the redundancy after the data is loaded
+        self.all_corridors = np.unique(self.all_corridors_raw)
+        print('all corridors:', self.all_corridors)
+        self.N_all_corridors = len(self.all_corridors)
+
+        ## only analyse corridors with at least 3 laps 
+        # - the data still remains in the ImLaps list and will appear in the activity tensor!
+        #   but the corridor will not 
+        #   we also do NOT include corridor 0 here
+        if (self.N_all_corridors > 1):
+            corridors, N_laps_corr = np.unique(self.i_corridors[self.i_Laps_ImData], return_counts=True)
+            self.corridors = corridors[np.flatnonzero(N_laps_corr >= self.minimum_Nlaps)]
+            self.N_corridors = len(self.corridors)
+        else :
+            self.corridors = np.setdiff1d(self.all_corridors, 0)
+            self.N_corridors = len(self.corridors)
+
+        print('corridors: ', self.corridors, '; number of corridors:', self.N_corridors)
+
+        self.N_ImLaps = len(self.i_Laps_ImData)
+
         ##################################################
         ## shuffling the spikes data
         ##################################################
+        self.shuffle_cells(n_workers)
+
+
+    def shuffle_block(self, cellids, N_shuffle, randseed, n_workers=1):
+        ## repeats the shuffling for a subset of the cells with a new number of shuffles and random seed
+        ## the behavioral data and the laps are not loaded again
+        ## the results are the same as constructing a new ImShuffle with the spikes of cellids, N_shuffle and randseed
+        keep = np.isin(self.cellids, cellids)
+        self.raw_spikes = self.raw_spikes[keep,:]
+        self.cellids = self.cellids[keep]
+        self.N_cells = self.raw_spikes.shape[0]
+        self.N_shuffle = N_shuffle
+        self.randseed = randseed
+        self.shuffle_cells(n_workers)
 
+    def shuffle_cells(self, n_workers=1):
+        ## the cells are divided into minibatches: [i_start, i_end)
+        batch_ranges = []
         i_start = 0
         i_end = min(i_start + self.batchsize, self.N_cells)
         if (i_end == (self.N_cells - 1)): # the last minibatch would contain only 1 cell
             i_end = i_end + 1
-        i_minibatch = 0
-
         while (i_start < self.N_cells):
-            batchsize = i_end - i_start # the last cycle in the loop will have a different size...
-            batch_ids = np.arange(i_start, i_end)
-            print('calculating minibatch ' + str(i_minibatch) + ', batch length: ', str(batchsize))
-
-            self.shuffle_spikes = np.zeros((batchsize, self.N_frames, self.N_shuffle+1), dtype='float32')
-            self.shuffle_spikes[:,:,self.N_shuffle] = self.raw_spikes[batch_ids,:] # the last element is the real data ...
-
-            rngP = np.random.default_rng(self.randseed)
-            rngI = np.random.default_rng(self.randseed+1)
-            rngS = np.random.default_rng(self.randseed+2)
-            rngD = np.random.default_rng(self.randseed+3)
-
-            if (self.mode == 'shift'):
-                for i_shuffle in range(self.N_shuffle):
-                    spks = np.zeros_like(self.raw_spikes[batch_ids,:])
-                    ## we break up the array into 6 pieces of at least 500 frames, permuting them and circularly shifting by at least 500 frames
-                    Nbreak = 5
-                    sections = breakpoints(Nframes=self.N_frames, Lmin=500, Nbreak=Nbreak, rngD=rngD)
-                    order = rngP.permutation(Nbreak + 1)
-                    k = 0
-                    for j in range(Nbreak+1):
-                        i_section = order[j]
-                        spks[:,k:(k+int(sections[1,i_section]))] = self.raw_spikes[batch_ids,int(sections[0,i_section]):int(sections[0,i_section]+sections[1,i_section])]
-                        k = k + int(sections[1,i_section])
-
-                    n_roll = rngI.integers((self.N_frames - 1000)) + 500
-                    spks_rolled = np.roll(spks, n_roll, axis=1)
-                    self.shuffle_spikes[:,:,i_shuffle] = spks_rolled
-            else:
-                if (self.mode != 'random'):
-                    print ('Warning: shuffling mode must be either random or shift. We will use random.')
-                for i_shuffle in range(self.N_shuffle):
-                    spks = np.copy(self.raw_spikes[batch_ids,:])
-                    spks = np.moveaxis(spks, 1, 0)
-                    rngS.shuffle(spks)
-                    spks = np.moveaxis(spks, 1, 0)
-                    self.shuffle_spikes[:,:,i_shuffle] = spks
-
-            ##################################################
-            ## loading behavioral data
-            ##################################################
-
-            self.shuffle_ImLaps = [] # list containing a special class for storing the imaging and behavioral data for single laps
-            self.n_laps = 0 # total number of laps
-            self.i_Laps_ImData = np.zeros(1) # np array with the index of laps with imaging
-            self.i_corridors = np.zeros(1) # np array with the index of corridors in each run
-
-            self.get_lapdata_shuffle(self.datapath, self.date_time, self.name, self.task, selected_laps=self.selected_laps) # collects all behavioral and imaging data and sort it into laps, storing each in a Lap_ImData object
-
-            ## in certain tasks, the same corridor may appear multiple times in different substages
-            ## we need to keep this corridor in the list self.all_corridors for running self.get_lapdata()
-            ## but we should remove the redundancy after the data is loaded
-            self.all_corridors = np.unique(self.all_corridors_raw)
-            print('all corridors:', self.all_corridors)
-            self.N_all_corridors = len(self.all_corridors)
-
-            ## only analyse corridors with at least 3 laps 
-            # - the data still remains in the ImLaps list and will appear in the activity tensor!
-            #   but the corridor will not 
-            #   we also do NOT include corridor 0 here
-            if (self.N_all_corridors > 1):
-                corridors, N_laps_corr = np.unique(self.i_corridors[self.i_Laps_ImData], return_counts=True)
-                self.corridors = corridors[np.flatnonzero(N_laps_corr >= self.minimum_Nlaps)]
-                self.N_corridors = len(self.corridors)
-            else :
-                self.corridors = np.setdiff1d(self.all_corridors, 0)
-                self.N_corridors = len(self.corridors)
-
-            print('corridors: ', self.corridors, '; number of corridors:', self.N_corridors)
-
-            self.N_ImLaps = len(self.i_Laps_ImData)
-
-            self.raw_activity_tensor = np.zeros((self.N_pos_bins, batchsize, self.N_ImLaps, self.N_shuffle+1)) # a tensor with space x neurons x trials x shuffle containing the spikes
-            self.raw_activity_tensor_time = np.zeros((self.N_pos_bins, self.N_ImLaps)) # a tensor with space x trials containing the time spent at each location in each lap
-            self.activity_tensor = np.zeros((self.N_pos_bins, batchsize, self.N_ImLaps, self.N_shuffle+1)) # same as the activity tensor spatially smoothed
-            self.activity_tensor_time = np.zeros((self.N_pos_bins, self.N_ImLaps)) # same as the activity_tensor_time spatially smoothed
-            self.combine_lapdata_shuffle() ## fills in the cell_activity tensor
-            # print(self.activity_tensor.shape)
-            # print(np.sum(self.activity_tensor))
-
-            self.cell_rates_batch = [] # a list, each element is a 1 x n_cells matrix with the average rate of the cells in the total corridor
-            if (self.task == 'contingency_learning'):
-                self.cell_pattern_rates_batch = []
-            self.cell_activelaps_batch=[] # a list, each element is a matrix with the % of significantly spiking laps of the shuffles in a corridor
-            self.cell_Fano_factor_batch = [] # a list, each element is a matrix with the reliability of the shuffles in a corridor
-
-            self.cell_reliability_batch = [] # a list, each element is a matrix with the reliability of the shuffles in a corridor
-            self.cell_skaggs_batch=[] # a list, each element is a matrix with the skaggs93 spatial info of the shuffles in a corridor
-            self.cell_tuning_specificity_batch=[] # a list, each element is a matrix with the tuning specificity of the shuffles in a corridor
+            batch_ranges.append([i_start, i_end])
+            i_start = i_end
+            i_end = min(i_start + self.batchsize, self.N_cells)
+            if (i_end == (self.N_cells - 1)): # the last minibatch would contain only 1 cell
+                i_end = i_end + 1
 
-            self.P_reliability_batch = [] # a list, each element is a vector with the P value estimated from shuffle control - P(reliability > measured)
-            self.P_skaggs_batch=[] # a list, each element is a vector with the the P value estimated from shuffle control - P(Skaggs-info > measured)
-            self.P_tuning_specificity_batch=[] # a list, each element is a vector with the the P value estimated from shuffle control - P(specificity > measured)
+        ## the random generators are initialised with the same seed in each minibatch,
+        ## so the results do not depend on the number of workers
+        if ((n_workers > 1) & (len(batch_ranges) > 1)):
+            self.shuffle_parallel(batch_ranges, n_workers)
+        else:
+            for i_minibatch in range(len(batch_ranges)):
+                i_start, i_end = batch_ranges[i_minibatch]
+                self.shuffle_minibatch(np.arange(i_start, i_end), i_minibatch)
+                self.merge_minibatch(i_minibatch)
+
+
+    def shuffle_minibatch(self, batch_ids, i_minibatch):
+        ## shuffles the spikes of the cells in batch_ids and calculates the statistics of the shuffles
+        ## the results are stored in the attributes listed in minibatch_results
+        batchsize = len(batch_ids) # the last minibatch may have a different size...
+        print('calculating minibatch ' + str(i_minibatch) + ', batch length: ', str(batchsize))
+
+        ## the shuffles are permutations of the frames: instead of the full batchsize x N_frames x N_shuffle tensor of shuffled spikes
+        ## we generate the permuted frame indices and bin the spikes of a chunk of shuffles at a time
+        batch_spikes = self.raw_spikes[batch_ids,:]
+
+        rngP = np.random.default_rng(self.randseed)
+        rngI = np.random.default_rng(self.randseed+1)
+        rngS = np.random.default_rng(self.randseed+2)
+        rngD = np.random.default_rng(self.randseed+3)
+
+        if ((self.mode != 'shift') and (self.mode != 'random')):
+            print ('Warning: shuffling mode must be either random or shift. We will use random.')
+
+        self.init_lapdata_shuffle(batchsize)
+        N_chunk = max(1, int(self.shuffle_chunk_size / max(batchsize * self.N_frames, 1))) # number of shuffles binned together
+        for i_start in range(0, self.N_shuffle+1, N_chunk):
+            i_end = min(i_start + N_chunk, self.N_shuffle+1)
+            frame_index = self.shuffle_frames(i_start, i_end, rngP, rngI, rngS, rngD)
+            chunk_spikes = np.take(batch_spikes, frame_index.T, axis=1).astype('float32') # cells x frames x shuffles in the chunk
+            self.bin_lapdata_shuffle(chunk_spikes, slice(i_start, i_end)) ## bins the shuffled spikes of the chunk using the lap data loaded once
+
+        self.combine_lapdata_shuffle(batchsize) ## fills in the cell_activity tensor
+        # print(self.activity_tensor.shape)
+        # print(np.sum(self.activity_tensor))
+
+        self.cell_rates_batch = [] # a list, each element is a 1 x n_cells matrix with the average rate of the cells in the total corridor
+        if (self.task == 'contingency_learning'):
+            self.cell_pattern_rates_batch = []
+        self.cell_activelaps_batch=[] # a list, each element is a matrix with the % of significantly spiking laps of the shuffles in a corridor
+        self.cell_Fano_factor_batch = [] # a list, each element is a matrix with the reliability of the shuffles in a corridor
 
-            self.cell_corridor_selectivity_batch = np.zeros([batchsize, self.N_shuffle]) # a matrix with the selectivity index of the cells
-            self.P_corridor_selectivity_batch = np.zeros([batchsize])
-            if (self.task == 'contingency_learning'):            
-                self.P_pattern_selectivity_batch = np.zeros([4, batchsize])
+        self.cell_reliability_batch = [] # a list, each element is a matrix with the reliability of the shuffles in a corridor
+        self.cell_skaggs_batch=[] # a list, each element is a matrix with the skaggs93 spatial info of the shuffles in a corridor
+        self.cell_tuning_specificity_batch=[] # a list, each element is a matrix with the tuning specificity of the shuffles in a corridor
 
-            self.ratemaps_batch = [] # a list, each element is an array space x neurons being the ratemap of the cells in a given corridor
-            self.cell_corridor_similarity_batch = np.zeros([batchsize, self.N_shuffle]) # a vector with the similarity index of the cells.
-            self.P_corridor_similarity_batch = np.zeros([batchsize])
+        self.P_reliability_batch = [] # a list, each element is a vector with the P value estimated from shuffle control - P(reliability > measured)
+        self.P_skaggs_batch=[] # a list, each element is a vector with the the P value estimated from shuffle control - P(Skaggs-info > measured)
+        self.P_tuning_specificity_batch=[] # a list, each element is a vector with the the P value estimated from shuffle control - P(specificity > measured)
 
-            self.calculate_properties_shuffle()
+        self.cell_corridor_selectivity_batch = np.zeros([batchsize, self.N_shuffle]) # a matrix with the selectivity index of the cells
+        self.P_corridor_selectivity_batch = np.zeros([batchsize])
+        if (self.task == 'contingency_learning'):            
+            self.P_pattern_selectivity_batch = np.zeros([4, batchsize])
 
-            self.candidate_PCs_batch = [] # a list, each element is a vector of Trues and Falses of candidate place cells with at least 1 place field according to Hainmuller and Bartos 2018
-            self.accepted_PCs_batch = [] # a list, each element is a vector of Trues and Falses of accepted place cells after bootstrapping
-            self.Hainmuller_PCs_shuffle()
+        self.ratemaps_batch = [] # a list, each element is an array space x neurons being the ratemap of the cells in a given corridor
+        self.cell_corridor_similarity_batch = np.zeros([batchsize, self.N_shuffle]) # a vector with the similarity index of the cells.
+        self.P_corridor_similarity_batch = np.zeros([batchsize])
 
-            if (i_minibatch == 0):
-                self.cell_reliability = self.cell_reliability_batch
-                self.P_reliability = self.P_reliability_batch
-                self.cell_skaggs = self.cell_skaggs_batch
-                self.P_skaggs = self.P_skaggs_batch
-                self.cell_tuning_specificity = self.cell_tuning_specificity_batch
-                self.P_tuning_specificity = self.P_tuning_specificity_batch
-                self.accepted_PCs = self.accepted_PCs_batch
+        self.calculate_properties_shuffle()
 
-                self.cell_corridor_selectivity = self.cell_corridor_selectivity_batch  
-                self.P_corridor_selectivity = self.P_corridor_selectivity_batch 
-                if (self.task == 'contingency_learning'):            
-                    self.cell_pattern_selectivity = self.cell_pattern_selectivity_batch
-                    self.P_pattern_selectivity = self.P_pattern_selectivity_batch
+        self.candidate_PCs_batch = [] # a list, each element is a vector of Trues and Falses of candidate place cells with at least 1 place field according to Hainmuller and Bartos 2018
+        self.accepted_PCs_batch = [] # a list, each element is a vector of Trues and Falses of accepted place cells after bootstrapping
+        self.Hainmuller_PCs_shuffle()
+
+
+    def merge_minibatch(self, i_minibatch):
+        ## appends the results of the minibatch to the results of the previous minibatches
+        if (i_minibatch == 0):
+            self.cell_reliability = self.cell_reliability_batch
+            self.P_reliability = self.P_reliability_batch
+            self.cell_skaggs = self.cell_skaggs_batch
+            self.P_skaggs = self.P_skaggs_batch
+            self.cell_tuning_specificity = self.cell_tuning_specificity_batch
+            self.P_tuning_specificity = self.P_tuning_specificity_batch
+            self.accepted_PCs = self.accepted_PCs_batch
+            self.candidate_PCs = self.candidate_PCs_batch
+
+            self.cell_corridor_selectivity = self.cell_corridor_selectivity_batch  
+            self.P_corridor_selectivity = self.P_corridor_selectivity_batch 
+            if (self.task == 'contingency_learning'):            
+                self.cell_pattern_selectivity = self.cell_pattern_selectivity_batch
+                self.P_pattern_selectivity = self.P_pattern_selectivity_batch
 
-                self.ratemaps = self.ratemaps_batch
-                self.cell_corridor_similarity = self.cell_corridor_similarity_batch 
-                self.P_corridor_similarity = self.P_corridor_similarity_batch 
+            self.ratemaps = self.ratemaps_batch
+            self.cell_corridor_similarity = self.cell_corridor_similarity_batch 
+            self.P_corridor_similarity = self.P_corridor_similarity_batch 
 
+        else:
+            for i_cor in range(self.N_corridors):
+                print(np.shape(self.cell_reliability[i_cor]), np.shape(self.cell_reliability_batch[i_cor]))
+                self.cell_reliability[i_cor] = np.vstack((self.cell_reliability[i_cor], self.cell_reliability_batch[i_cor]))
+                self.P_reliability[i_cor] = np.hstack((self.P_reliability[i_cor], self.P_reliability_batch[i_cor]))
+                self.cell_skaggs[i_cor] = np.vstack((self.cell_skaggs[i_cor], self.cell_skaggs_batch[i_cor]))
+                self.P_skaggs[i_cor] = np.hstack((self.P_skaggs[i_cor], self.P_skaggs_batch[i_cor]))
+                self.cell_tuning_specificity[i_cor] = np.vstack((self.cell_tuning_specificity[i_cor], self.cell_tuning_specificity_batch[i_cor]))
+                self.P_tuning_specificity[i_cor] = np.hstack((self.P_tuning_specificity[i_cor], self.P_tuning_specificity_batch[i_cor]))
+                self.accepted_PCs[i_cor] = np.hstack((self.accepted_PCs[i_cor], self.accepted_PCs_batch[i_cor]))
+                self.candidate_PCs[i_cor] = np.vstack((self.candidate_PCs[i_cor], self.candidate_PCs_batch[i_cor]))
+                self.ratemaps[i_cor] = np.concatenate((self.ratemaps[i_cor], self.ratemaps_batch[i_cor]), axis=1)
+
+            # matrix, N x M
+            self.cell_corridor_selectivity = np.concatenate((self.cell_corridor_selectivity, self.cell_corridor_selectivity_batch))
+            self.P_corridor_selectivity = np.concatenate((self.P_corridor_selectivity, self.P_corridor_selectivity_batch))
+            if (self.task == 'contingency_learning'):
+                # 4 x N x M = N_corridor x 4 x N_cell x N_shuffle            
+                self.cell_pattern_selectivity = np.concatenate((self.cell_pattern_selectivity, self.cell_pattern_selectivity_batch), axis=1)
+                # np.zeros([4, batchsize])
+                self.P_pattern_selectivity = np.concatenate((self.P_pattern_selectivity, self.P_pattern_selectivity_batch), axis=1)
+
+            self.cell_corridor_similarity = np.concatenate((self.cell_corridor_similarity, self.cell_corridor_similarity_batch)) 
+            self.P_corridor_similarity = np.concatenate((self.P_corridor_similarity, self.P_corridor_similarity_batch))
+
+
+    def shuffle_frames(self, i_start, i_end, rngP, rngI, rngS, rngD):
+        ## (i_end - i_start) x N_frames array with the index of the frames in the shuffles i_start:i_end
+        ## the shuffle N_shuffle is the real data
+        ## the random number generators are called in the same order as when the spikes were shuffled one by one
+        frame_index = np.tile(np.arange(self.N_frames), (i_end - i_start, 1))
+        N_shuffled = min(i_end, self.N_shuffle) - i_start
+        if (N_shuffled > 0):
+            if (self.mode == 'shift'):
+                ## we break up the array into 6 pieces of at least 500 frames, permuting them and circularly shifting by at least 500 frames
+                frame_index[0:N_shuffled,:] = shift_shuffle_frames(self.N_frames, N_shuffled, rngP, rngI, rngD, Lmin=500, Nbreak=5)
             else:
-                for i_cor in range(self.N_corridors):
-                    print(np.shape(self.cell_reliability[i_cor]), np.shape(self.cell_reliability_batch[i_cor]))
-                    self.cell_reliability[i_cor] = np.vstack((self.cell_reliability[i_cor], self.cell_reliability_batch[i_cor]))
-                    self.P_reliability[i_cor] = np.hstack((self.P_reliability[i_cor], self.P_reliability_batch[i_cor]))
-                    self.cell_skaggs[i_cor] = np.vstack((self.cell_skaggs[i_cor], self.cell_skaggs_batch[i_cor]))
-                    self.P_skaggs[i_cor] = np.hstack((self.P_skaggs[i_cor], self.P_skaggs_batch[i_cor]))
-                    self.cell_tuning_specificity[i_cor] = np.vstack((self.cell_tuning_specificity[i_cor], self.cell_tuning_specificity_batch[i_cor]))
-                    self.P_tuning_specificity[i_cor] = np.hstack((self.P_tuning_specificity[i_cor], self.P_tuning_specificity_batch[i_cor]))
-                    self.accepted_PCs[i_cor] = np.hstack((self.accepted_PCs[i_cor], self.accepted_PCs_batch[i_cor]))
-                    self.ratemaps[i_cor] = np.concatenate((self.ratemaps[i_cor], self.ratemaps_batch[i_cor]), axis=1)
-
-                # matrix, N x M
-                self.cell_corridor_selectivity = np.concatenate((self.cell_corridor_selectivity, self.cell_corridor_selectivity_batch))
-                self.P_corridor_selectivity = np.concatenate((self.P_corridor_selectivity, self.P_corridor_selectivity_batch))
-                if (self.task == 'contingency_learning'):
-                    # 4 x N x M = N_corridor x 4 x N_cell x N_shuffle            
-                    self.cell_pattern_selectivity = np.concatenate((self.cell_pattern_selectivity, self.cell_pattern_selectivity_batch), axis=1)
-                    # np.zeros([4, batchsize])
-                    self.P_pattern_selectivity = np.concatenate((self.P_pattern_selectivity, self.P_pattern_selectivity_batch), axis=1)
-
-                self.cell_corridor_similarity = np.concatenate((self.cell_corridor_similarity, self.cell_corridor_similarity_batch)) 
-                self.P_corridor_similarity = np.concatenate((self.P_corridor_similarity, self.P_corridor_similarity_batch))
+                frame_index[0:N_shuffled,:] = rngS.permuted(frame_index[0:N_shuffled,:], axis=1)
+        return frame_index
+
+    def shuffle_parallel(self, batch_ranges, n_workers):
+        ## the minibatches are processed by a pool of n_workers processes
+        ## the spikes are shared between the processes and the results are merged in the order of the minibatches
+        ## the tensors of the last minibatch (activity_tensor, raw_activity_tensor...) are not kept in this case
+        ## shared_memory requires python >= 3.8
+        from multiprocessing import shared_memory
+        shared_spikes_memory = shared_memory.SharedMemory(create=True, size=max(self.raw_spikes.nbytes, 1))
+        try:
+            shared_spikes = np.ndarray(self.raw_spikes.shape, dtype=self.raw_spikes.dtype, buffer=shared_spikes_memory.buf)
+            shared_spikes[:] = self.raw_spikes
+            state = {key:value for key, value in self.__dict__.items() if (key != 'raw_spikes')}
+            batches = [[np.arange(batch_ranges[i][0], batch_ranges[i][1]), i] for i in range(len(batch_ranges))]
+            n_processes = min(n_workers, len(batch_ranges))
+            with multiprocessing.Pool(n_processes, initializer=init_shuffle_worker, initargs=(state, shared_spikes_memory.name, self.raw_spikes.shape, self.raw_spikes.dtype.str)) as pool:
+                i_minibatch = 0
+                for batch_results in pool.imap(shuffle_worker_minibatch, batches):
+                    for key in batch_results.keys():
+                        setattr(self, key, batch_results[key])
+                    self.merge_minibatch(i_minibatch)
+                    i_minibatch = i_minibatch + 1
+                pool.close() # the workers exit normally and close the shared memory
+                pool.join()
+            del shared_spikes
+        finally:
+            shared_spikes_memory.close()
+            shared_spikes_memory.unlink()
 
-            i_start = i_end
-            i_end = min(i_start + batchsize, self.N_cells)
-            if (i_end == (self.N_cells - 1)): # the last minibatch would contain only 1 cell
-                i_end = i_end + 1
-            i_minibatch = i_minibatch + 1
 
 
     def get_lapdata_shuffle(self, datapath, date_time, name, task, selected_laps=None):
 
-        time_array=[]
-        lap_array=[]
-        maze_array=[]
-        position_array=[]
-        mode_array=[]
-        lick_array=[]
-        action=[]
-        substage=[]
-
-        data_log_file_string=datapath + 'data/' + name + '_' + task + '/' + date_time + '/' + date_time + '_' + name + '_' + task + '_ExpStateMashineLog.txt'
-        data_log_file=open(data_log_file_string, newline='')
-        log_file_reader=csv.reader(data_log_file, delimiter=',')
-        next(log_file_reader, None)#skip the headers
-        for line in log_file_reader:
-            time_array.append(float(line[0]))
-            lap_array.append(int(line[1]))
-            maze_array.append(int(line[2]))
-            position_array.append(int(line[3]))
-            mode_array.append(line[6] == 'Go')
-            lick_array.append(line[9] == 'TRUE')
-            action.append(str(line[14]))
-            substage.append(str(line[17]))
-
-        laptime = np.array(time_array)
-        lap = np.array(lap_array)
-        sstage = np.array(substage)
-
-        pos = np.array(position_array)
-        lick = np.array(lick_array)
-        maze = np.array(maze_array)
-        mode = np.array(mode_array)
+        data_log_file_string = ExpStateLogFileName(datapath, date_time, name, task)
+        explog = ExpStateLog(data_log_file_string)
+
+        laptime = explog.time
+        lap = explog.lap
+        sstage = explog.substage_codes
+
+        pos = explog.position
+        lick = explog.lick
+        maze = explog.maze
+        mode = explog.mode
 
         #################################################
         ## position, and lap info has been already added to the imaging frames
@@ -428,9 +526,7 @@ class ImShuffle:
         
                     istart = np.min(y)
                     iend = np.max(y) + 1
-                    action_lap = action[istart:iend]
-        
-                    reward_indices = [j for j, x in enumerate(action_lap) if x == "TrialReward"]
+                    reward_indices = explog.get_reward_indices(istart, iend)
                     t_reward = t_lap[reward_indices]
         
                     ## detecting invalid laps - terminated before the animal could receive reward
@@ -442,10 +538,7 @@ class ImShuffle:
                     if (valid_lap == False):
                         mode_lap = 0
 
-                    actions = []
-                    for j in range(len(action_lap)):
-                        if not((action_lap[j]) in ['No', 'TrialReward']):
-                            actions.append([t_lap[j], action_lap[j]])
+                    actions = explog.get_actions(t_lap, istart, iend)
 
                     ### include only a subset of laps
                     add_ImLap = True
@@ -453,12 +546,11 @@ class ImShuffle:
                         add_ImLap = False
 
                     ### imaging data    
-                    iframes = np.where(self.frame_laps == i_lap)[0]
-                    # print(self.n_laps, len(iframes), i_lap)
+                    iframes = lap_frames(self.frame_laps, i_lap) # slice - the lap arrays are views of the session arrays
+                    # print(self.n_laps, len(self.frame_times[iframes]), i_lap)
 
-                    if (len(iframes) > 1): # there is imaging data belonging to this lap...
+                    if (len(self.frame_times[iframes]) > 1): # there is imaging data belonging to this lap...
                         # print('imaging data found', min(iframes), max(iframes))
-                        lap_frames_spikes = self.shuffle_spikes[:,iframes,:]
                         lap_frames_time = self.frame_times[iframes]
                         lap_frames_pos = self.frame_pos[iframes]
                         if (np.min(lap_frames_pos) > imaging_min_position):
@@ -473,12 +565,13 @@ class ImShuffle:
                     if (add_ImLap): # there is imaging data belonging to this lap...
                         i_ImData.append(self.n_laps)
                     else :
-                        lap_frames_spikes = np.nan
+                        iframes = None
                         lap_frames_time = np.nan
                         lap_frames_pos = np.nan 
                         
+                    ## the spikes are added later for each minibatch by bin_lapdata_shuffle
                     # sessions.append(Lap_Data(name, i, t_lap, pos_lap, t_licks, t_reward, corridor, mode_lap, actions))
-                    self.shuffle_ImLaps.append(Shuffle_ImData(self.name, self.n_laps, t_lap, pos_lap, t_licks, t_reward, corridor, mode_lap, actions, lap_frames_spikes, lap_frames_pos, lap_frames_time, self.frame_period, self.corridor_list, speed_threshold=self.speed_threshold, elfiz=self.elfiz, multiplane=self.multiplane))
+                    self.shuffle_ImLaps.append(Shuffle_ImData(self.name, self.n_laps, t_lap, pos_lap, t_licks, t_reward, corridor, mode_lap, actions, None, lap_frames_pos, lap_frames_time, self.frame_period, self.corridor_list, speed_threshold=self.speed_threshold, elfiz=self.elfiz, multiplane=self.multiplane, frames=iframes))
                     self.n_laps = self.n_laps + 1
                     lap_count = lap_count + 1                    
                 else:
@@ -490,33 +583,29 @@ class ImShuffle:
         self.i_Laps_ImData = np.array(i_ImData) # index of laps with imaging data
         self.i_corridors = np.array(i_corrids) # ID of corridor for the current lap
 
-    def combine_lapdata_shuffle(self): ## fills in the cell_activity tensor
-        # self.raw_activity_tensor = np.zeros((self.N_pos_bins, self.N_cells, self.N_ImLaps)) # a tensor with space x neurons x trials containing the spikes
-        # self.raw_activity_tensor_time = np.zeros((self.N_pos_bins, self.N_ImLaps)) # a tensor with space x  trials containing the time spent at each location in each lap
-        valid_lap = np.zeros(len(self.i_Laps_ImData))
-        k_lap = 0
+    def init_lapdata_shuffle(self, batchsize): ## allocates the binned spikes of the current minibatch in the laps with imaging data
         for i_lap in self.i_Laps_ImData:
-            if (self.shuffle_ImLaps[i_lap].n_cells > 0):
-                valid_lap[k_lap] = 1
-                self.raw_activity_tensor[:,:,k_lap,:] = np.moveaxis(self.shuffle_ImLaps[i_lap].spks_pos, 1, 0)
-                self.raw_activity_tensor_time[:,k_lap] = self.shuffle_ImLaps[i_lap].T_pos_fast
-            k_lap = k_lap + 1
+            self.shuffle_ImLaps[i_lap].init_spikes(batchsize, self.N_shuffle+1)
 
-        ## smoothing - average of the 3 neighbouring bins
-        self.activity_tensor[0,:,:,:] = (self.raw_activity_tensor[0,:,:,:] + self.raw_activity_tensor[1,:,:,:]) / 2
-        self.activity_tensor[-1,:,:,:] = (self.raw_activity_tensor[-2,:,:,:] + self.raw_activity_tensor[-1,:,:,:]) / 2
-        self.activity_tensor_time[0,:] = (self.raw_activity_tensor_time[0,:] + self.raw_activity_tensor_time[1,:]) / 2
-        self.activity_tensor_time[-1,:] = (self.raw_activity_tensor_time[-2,:] + self.raw_activity_tensor_time[-1,:]) / 2
-        for i_bin in np.arange(1, self.N_pos_bins-1):
-            self.activity_tensor[i_bin,:,:,:] = np.average(self.raw_activity_tensor[(i_bin-1):(i_bin+2),:,:,:], axis=0)
-            self.activity_tensor_time[i_bin,:] = np.average(self.raw_activity_tensor_time[(i_bin-1):(i_bin+2),:], axis=0)
+    def bin_lapdata_shuffle(self, spikes, i_shuffles): ## bins the shuffled spikes of a chunk of shuffles in the laps with imaging data
+        for i_lap in self.i_Laps_ImData:
+            ImLap = self.shuffle_ImLaps[i_lap]
+            ImLap.bin_spikes(spikes[:,ImLap.frames,:], i_shuffles)
+
+    def combine_lapdata_shuffle(self, batchsize): ## fills in the cell_activity tensor
+        valid_lap = np.array([self.shuffle_ImLaps[i_lap].n_cells > 0 for i_lap in self.i_Laps_ImData], dtype=bool)
+        self.i_Laps_ImData = self.i_Laps_ImData[valid_lap]
+        N_valid_laps = len(self.i_Laps_ImData)
+
+        self.raw_activity_tensor = np.zeros((self.N_pos_bins, batchsize, N_valid_laps, self.N_shuffle+1)) # a tensor with space x neurons x trials x shuffle containing the spikes
+        self.raw_activity_tensor_time = np.zeros((self.N_pos_bins, N_valid_laps)) # a tensor with space x trials containing the time spent at each location in each lap
+        for k_lap, i_lap in enumerate(self.i_Laps_ImData):
+            self.raw_activity_tensor[:,:,k_lap,:] = np.moveaxis(self.shuffle_ImLaps[i_lap].spks_pos, 1, 0)
+            self.raw_activity_tensor_time[:,k_lap] = self.shuffle_ImLaps[i_lap].T_pos_fast
 
-        i_valid_laps = np.nonzero(valid_lap)[0]
-        self.i_Laps_ImData = self.i_Laps_ImData[i_valid_laps]
-        self.raw_activity_tensor = self.raw_activity_tensor[:,:,i_valid_laps,:]
-        self.raw_activity_tensor_time = self.raw_activity_tensor_time[:,i_valid_laps]
-        self.activity_tensor = self.activity_tensor[:,:,i_valid_laps,:]
-        self.activity_tensor_time = self.activity_tensor_time[:,i_valid_laps]
+        ## smoothing - average of the 3 neighbouring bins
+        self.activity_tensor = smooth_bins(self.raw_activity_tensor) # same as the activity tensor spatially smoothed
+        self.activity_tensor_time = smooth_bins(self.raw_activity_tensor_time) # same as the activity_tensor_time spatially smoothed
 
 
 
@@ -558,11 +647,7 @@ class ImShuffle:
                 act_tensor_1 = self.activity_tensor[:,:,i_laps,:] ## bin x cells x laps x shuffle; all activity in all laps in corridor i
                 total_spikes = np.sum(act_tensor_1, axis=2) ##  bin x cells x shuffle; total activity of the cells in corridor i
 
-                rate_matrix = np.zeros_like(total_spikes) ## event rate 
-                
-                for i_cell in range(minibatchsize):
-                    for i_shuffle in range(self.N_shuffle+1):
-                        rate_matrix[:,i_cell,i_shuffle] = total_spikes[:,i_cell,i_shuffle] / total_time
+                rate_matrix = total_spikes / total_time.reshape(-1,1,1) ## event rate 
 
                 self.ratemaps_batch.append(rate_matrix)
 
@@ -581,19 +666,21 @@ class ImShuffle:
 
 
                 ## reliability and Fano factor
+                ## calculated for all cells and shuffles together, in chunks of shuffles to limit the memory
                 reliability = np.zeros((minibatchsize, self.N_shuffle+1))
-                P_reliability_batch = np.zeros(minibatchsize)
                 Fano_factor = np.zeros((minibatchsize, self.N_shuffle+1))
-                for i_cell in range(minibatchsize):
-                    for i_shuffle in range(self.N_shuffle+1):
-                        laps_rates = nan_divide(act_tensor_1[:,i_cell,:,i_shuffle], time_matrix_1, where=(time_matrix_1 > 0.025))
-                        corrs_cell = vcorrcoef(np.transpose(laps_rates), rate_matrix[:,i_cell,i_shuffle])
-                        reliability[i_cell, i_shuffle] = np.nanmean(corrs_cell)
-                        Fano_factor[i_cell, i_shuffle] = np.nanmean(nan_divide(np.nanvar(laps_rates, axis=1), rate_matrix[:,i_cell,i_shuffle], rate_matrix[:,i_cell,i_shuffle] > 0))
-
-                    shuffle_ecdf = reliability[i_cell, 0:self.N_shuffle]
-                    data_point = reliability[i_cell, self.N_shuffle]
-                    P_reliability_batch[i_cell] = sum(shuffle_ecdf > data_point) / float(self.N_shuffle)
+                time_matrix_4 = time_matrix_1.reshape(self.N_pos_bins, 1, N_laps_corr, 1)
+                N_chunk = max(1, int(self.shuffle_chunk_size / (self.N_pos_bins * minibatchsize * N_laps_corr)))
+                for i_start in range(0, self.N_shuffle+1, N_chunk):
+                    i_shuffles = slice(i_start, min(i_start + N_chunk, self.N_shuffle+1))
+                    laps_rates = nan_divide(act_tensor_1[:,:,:,i_shuffles], time_matrix_4, where=(time_matrix_4 > 0.025)) # bins x cells x laps x shuffle
+                    rates_cells = np.transpose(rate_matrix[:,:,i_shuffles], (1,2,0)) # cells x shuffle x bins
+                    ## the sums are rounded as in the loop over the cells and shuffles, see loop_sum_layout
+                    corrs = batch_vcorrcoef(loop_sum_layout(np.transpose(laps_rates, (1,3,2,0))), rates_cells) # cells x shuffle x laps
+                    reliability[:,i_shuffles] = np.nanmean(np.ascontiguousarray(corrs), axis=2)
+                    laps_var = np.nanvar(loop_sum_layout(np.transpose(laps_rates, (1,3,0,2))), axis=3) # cells x shuffle x bins
+                    Fano_factor[:,i_shuffles] = np.nanmean(np.ascontiguousarray(nan_divide(laps_var, rates_cells, rates_cells > 0)), axis=2)
+                P_reliability_batch = shuffle_P_value(reliability, self.N_shuffle)
 
                 self.cell_reliability_batch.append(reliability)
                 self.P_reliability_batch.append(P_reliability_batch)
@@ -602,19 +689,9 @@ class ImShuffle:
 
                 print('calculating Skaggs spatial info...')
                 ## Skaggs spatial info
-                skaggs_matrix=np.zeros((minibatchsize, self.N_shuffle+1))
-                P_skaggs_batch = np.zeros(minibatchsize)
                 P_x=total_time/np.sum(total_time)
-                for i_cell in range(minibatchsize):
-                    for i_shuffle in range(self.N_shuffle+1):
-                        mean_firing = rates[i_cell,i_shuffle]
-                        lambda_x = rate_matrix[:,i_cell,i_shuffle]
-                        i_nonzero = np.nonzero(lambda_x > 0)
-                        skaggs_matrix[i_cell,i_shuffle] = np.sum(lambda_x[i_nonzero]*np.log2(lambda_x[i_nonzero]/mean_firing)*P_x[i_nonzero]) / mean_firing
-
-                    shuffle_ecdf = skaggs_matrix[i_cell, 0:self.N_shuffle]
-                    data_point = skaggs_matrix[i_cell, self.N_shuffle]
-                    P_skaggs_batch[i_cell] = sum(shuffle_ecdf > data_point) / float(self.N_shuffle)
+                skaggs_matrix = skaggs_info(np.moveaxis(rate_matrix, 0, 2), rates, P_x) # cells x shuffle
+                P_skaggs_batch = shuffle_P_value(skaggs_matrix, self.N_shuffle)
 
                 self.cell_skaggs_batch.append(skaggs_matrix)
                 self.P_skaggs_batch.append(P_skaggs_batch)
@@ -622,38 +699,19 @@ class ImShuffle:
                 ## active laps/ all laps spks
                 #use raw spks instead activity tensor
                 print('calculating proportion of active laps...')
-                active_laps = np.zeros((minibatchsize, N_laps_corr, self.N_shuffle+1))
-
                 icorrids = self.i_corridors[self.i_Laps_ImData] # corridor ids with image data
                 i_laps_abs = self.i_Laps_ImData[np.nonzero(icorrids == corridor)[0]]
-                k = 0
-                for i_lap in i_laps_abs:#y=ROI
-                    for i_shuffle in range(self.N_shuffle+1):
-                        act_cells = np.nonzero(np.amax(self.shuffle_ImLaps[i_lap].frames_spikes[:,:,i_shuffle], 1) > 25)[0] # cells * frames * shuffle
-                        active_laps[act_cells, k, i_shuffle] = 1 # cells * laps * shuffle
-                    k = k + 1
-
-                active_laps_ratio = np.sum(active_laps, 1) / N_laps_corr
+
+                ## maximum of the cells in each lap: laps x cells x shuffle
+                max_spikes = np.array([self.shuffle_ImLaps[i_lap].max_spikes for i_lap in i_laps_abs]).reshape(N_laps_corr, minibatchsize, self.N_shuffle+1)
+                active_laps_ratio = np.sum(max_spikes > 25, 0) / N_laps_corr
                 self.cell_activelaps_batch.append(active_laps_ratio)
                 
                 ## linear tuning specificity
                 print('calculating linear tuning specificity ...')
-                tuning_spec=np.zeros((minibatchsize, self.N_shuffle+1))
-                P_tuning_specificity_batch = np.zeros(minibatchsize)
                 xbins = (np.arange(self.N_pos_bins) + 0.5) * self.corridor_length_cm / self.N_pos_bins
-                
-                for i_cell in range(minibatchsize):
-                    for i_shuffle in range(self.N_shuffle+1):
-                        rr = np.copy(rate_matrix[:,i_cell,i_shuffle])
-                        rr[rr < np.mean(rr)] = 0
-                        Px = rr / np.sum(rr)
-                        mu = np.sum(Px * xbins)
-                        sigma = np.sqrt(np.sum(Px * xbins**2) - mu**2)
-                        tuning_spec[i_cell,i_shuffle] = self.corridor_length_cm / sigma
-
-                    shuffle_ecdf = tuning_spec[i_cell, 0:self.N_shuffle]
-                    data_point = tuning_spec[i_cell, self.N_shuffle]
-                    P_tuning_specificity_batch[i_cell] = sum(shuffle_ecdf > data_point) / float(self.N_shuffle)
+                tuning_spec = tuning_specificity(np.moveaxis(rate_matrix, 0, 2), xbins, self.corridor_length_cm) # cells x shuffle
+                P_tuning_specificity_batch = shuffle_P_value(tuning_spec, self.N_shuffle)
 
                 self.cell_tuning_specificity_batch.append(tuning_spec)
                 self.P_tuning_specificity_batch.append(P_tuning_specificity_batch)
@@ -698,55 +756,23 @@ class ImShuffle:
         ## L    corridor length in bins
 
         print('calculating corridor selectivity ...')
-        rate_matrix = np.array(self.cell_rates_batch) # K x N x M
-
-        max_rate = np.max(rate_matrix, axis=0)
-        i_corr_max = np.argmax(rate_matrix, axis=0)
-        min_rate = np.min(rate_matrix, axis=0)
-        sumrate = np.sum(rate_matrix, axis=0)
-
-        self.cell_corridor_selectivity_batch = (max_rate - min_rate) / sumrate # matrix, N x M
-
+        self.cell_corridor_selectivity_batch = corridor_selectivity(np.array(self.cell_rates_batch))[0] # K x N x M -> matrix, N x M
 
         # in Rita's task, we also calculate corridor selectivity in the pattern and reward zones:
         if (self.task == 'contingency_learning'):
-            rate_matrix = np.array(self.cell_pattern_rates_batch) # K x 4 x N x M = N_corridor x 4 x N_cell x N_shuffle
-            max_rate = np.max(rate_matrix, axis=0) # 4 x N x M
-            min_rate = np.min(rate_matrix, axis=0)
-            sumrate = np.sum(rate_matrix, axis=0)
-            self.cell_pattern_selectivity_batch = (max_rate - min_rate) / sumrate
+            self.cell_pattern_selectivity_batch = corridor_selectivity(np.array(self.cell_pattern_rates_batch))[0] # K x 4 x N x M -> 4 x N x M
         
         print('calculating corridor similarity ...  Number of corridors:', self.N_corridors)
-        minibatchsize = self.activity_tensor.shape[1]
-
         map_mat = np.array(self.ratemaps_batch) # K x L x N x M
-        M = int(self.N_corridors * (self.N_corridors - 1) / 2)
-        similarity_matrix = np.zeros((M, minibatchsize, self.N_shuffle+1))
-        m = 0
-        for i_cor in np.arange(self.N_corridors-1):
-            for j_cor in np.arange(i_cor+1, self.N_corridors):
-                for i_cell in np.arange(minibatchsize):
-                    # print(i_cor, j_cor)
-                    X = np.transpose(map_mat[i_cor,:,i_cell,:])
-                    Y = np.transpose(map_mat[j_cor,:,i_cell,:])
-                    similarity_matrix[m,i_cell,] = Mcorrcoef(X,Y, zero_var_out=0)
-
-        self.cell_corridor_similarity_batch = np.mean(similarity_matrix, axis=0) # matrix of N x M
-
-        for i_cell in np.arange(minibatchsize):
-            shuffle_ecdf = self.cell_corridor_selectivity_batch[i_cell, 0:self.N_shuffle]
-            data_point = self.cell_corridor_selectivity_batch[i_cell, self.N_shuffle]
-            self.P_corridor_selectivity_batch[i_cell] = sum(shuffle_ecdf > data_point) / float(self.N_shuffle)
-
-            shuffle_ecdf = self.cell_corridor_similarity_batch[i_cell, 0:self.N_shuffle]
-            data_point = self.cell_corridor_similarity_batch[i_cell, self.N_shuffle]
-            self.P_corridor_similarity_batch[i_cell] = sum(shuffle_ecdf > data_point) / float(self.N_shuffle)
+        similarity_matrix = corridor_similarity(map_mat, zero_var_out=0) # K x K x N x M, all pairs of corridors, cells and shuffles at once
+        i_cor, j_cor = np.triu_indices(self.N_corridors, k=1)
+        self.cell_corridor_similarity_batch = np.mean(similarity_matrix[i_cor, j_cor], axis=0) # matrix of N x M
 
-            if (self.task == 'contingency_learning'):
-                for kk in np.arange(4):
-                    shuffle_ecdf = self.cell_pattern_selectivity_batch[kk, i_cell, 0:self.N_shuffle]
-                    data_point = self.cell_pattern_selectivity_batch[kk, i_cell, self.N_shuffle]
-                    self.P_pattern_selectivity_batch[kk, i_cell] = sum(shuffle_ecdf > data_point) / float(self.N_shuffle)
+        self.P_corridor_selectivity_batch = shuffle_P_value(self.cell_corridor_selectivity_batch, self.N_shuffle)
+        self.P_corridor_similarity_batch = shuffle_P_value(self.cell_corridor_similarity_batch, self.N_shuffle)
+        if (self.task == 'contingency_learning'):
+            for kk in np.arange(4):
+                self.P_pattern_selectivity_batch[kk,:] = shuffle_P_value(self.cell_pattern_selectivity_batch[kk], self.N_shuffle)
 
 
     def plot_properties_shuffle(self, cellids=np.array([-1]), maxNcells=10):
@@ -934,59 +960,13 @@ class ImShuffle:
         for i_corrid in np.arange(self.N_corridors):
             corrid = self.corridors[i_corrid]
             rate_matrix = self.ratemaps_batch[i_corrid]
-            cell_number = rate_matrix.shape[1]
 
-            candidate_cells = np.zeros((cell_number, self.N_shuffle+1))
-            accepted_cells = np.zeros(cell_number)
-            
             i_laps = np.nonzero(self.i_corridors[self.i_Laps_ImData] == corrid)[0] 
-            N_laps_corr = len(i_laps)
-            act_tensor_1 = self.activity_tensor[:,:,i_laps,:] ## bin x cells x laps x shuffle; all activity in all laps in corridor i
-
-            for i_cell in np.arange(rate_matrix.shape[1]):
-                for i_shuffle in np.arange(rate_matrix.shape[2]):
-                    rate_i = rate_matrix[:,i_cell,i_shuffle]
-
-                    ### calculate the baseline, peak and threshold for each cell
-                    ## Hainmuller: average of the lowest 25%; 
-                    baseline = np.mean(np.sort(rate_i)[:12])
-                    peak_rate = np.max(rate_i)
-                    threshold = baseline + 0.25 * (peak_rate - baseline)
-
-                    ## 1) find the longest contiguous region of above threshold for at least 3 bins...
-                    placefield_start = np.nan
-                    placefield_length = 0
-                    candidate_start = 0
-                    candidate_length = 0
-                    for k in range(self.N_pos_bins):
-                        if (rate_i[k] > threshold):
-                            candidate_length = candidate_length + 1
-                            if (candidate_length == 1):
-                                candidate_start = k
-                            elif ((candidate_length > 2) & (candidate_length > placefield_length)):
-                                placefield_length = candidate_length
-                                placefield_start = candidate_start
-                        else:
-                            candidate_length = 0
-
-                    if (not(np.isnan(placefield_start))):
-                        ##  2) with average rate at least 7x the average rate outside
-                        index_infield = np.arange(placefield_start,(placefield_start+placefield_length))
-                        index_outfield = np.setdiff1d(np.arange(self.N_pos_bins), index_infield)
-                        rate_inField = np.mean(rate_i[index_infield])
-                        rate_outField = np.mean(rate_i[index_outfield])
-
-
-                        ## significant (total spike is larger than 0.6) transient in the field in at least 20% of the runs
-                        lapsums = act_tensor_1[index_infield,i_cell,:,i_shuffle].sum(0) # only laps in this corridor
-
-                        if ( ( (sum(lapsums > 0.6) / float(N_laps_corr)) > 0.2)  & ( (rate_inField / rate_outField) > 7) ):
-                            # accepted_cells[i_cell] = 1
-                            candidate_cells[i_cell, i_shuffle] = 1
-
-                place_cell_P = np.sum(candidate_cells[i_cell, 0:self.N_shuffle]) / self.N_shuffle
-                if ((candidate_cells[i_cell,self.N_shuffle]==1) & (place_cell_P < 0.05)):
-                    accepted_cells[i_cell] = 1
+            ## all cells and shuffles are processed at once, see utils.placefield_candidates for the criteria
+            candidate_cells = placefield_candidates(rate_matrix, self.activity_tensor, i_laps).astype(float) # cells x shuffles
+
+            place_cell_P = np.sum(candidate_cells[:,0:self.N_shuffle], axis=1) / self.N_shuffle
+            accepted_cells = ((candidate_cells[:,self.N_shuffle] == 1) & (place_cell_P < 0.05)).astype(float)
 
             self.candidate_PCs_batch.append(candidate_cells)
             self.accepted_PCs_batch.append(accepted_cells.astype(int))
@@ -1000,7 +980,7 @@ class ImShuffle:
 class Shuffle_ImData:
     'common base class for shuffled laps'
 
-    def __init__(self, name, lap, laptime, position, lick_times, reward_times, corridor, mode, actions, lap_frames_spikes, lap_frames_pos, lap_frames_time, frame_period, corridor_list, dt=0.01, printout=False, speed_threshold=5, elfiz=False, multiplane=False):
+    def __init__(self, name, lap, laptime, position, lick_times, reward_times, corridor, mode, actions, lap_frames_spikes, lap_frames_pos, lap_frames_time, frame_period, corridor_list, dt=0.01, printout=False, speed_threshold=5, elfiz=False, multiplane=False, frames=None):
         self.name = name
         self.lap = lap
         self.multiplane = multiplane
@@ -1024,7 +1004,8 @@ class Shuffle_ImData:
 
         self.frame_period = frame_period
 
-        self.frames_spikes = lap_frames_spikes
+        self.frames = frames # index of the frames of the lap in the imaging data of the session
+        self.frames_spikes = lap_frames_spikes # None if the spikes are added later by bin_spikes() - not stored in that case
         self.frames_pos = lap_frames_pos
         self.frames_time = lap_frames_time
         
@@ -1064,11 +1045,8 @@ class Shuffle_ImData:
 
         ####################################################################
         ## calculate the lick-rate and the average speed versus location    
-        bin_counts = np.zeros(self.N_pos_bins)
-
-        for i_frame in range(len(self.frames_pos)):
-            bin_number = int(self.frames_pos[i_frame] // 70)
-            bin_counts[bin_number] += 1
+        i_frames, i_bins, n_bins = position_bins(self.frames_pos) # here each frame is assigned to a single position bin
+        bin_counts = bin_sum(np.ones(len(i_bins)), i_bins, self.N_pos_bins)
 
         self.T_pos = bin_counts * self.frame_period           # used for lick rate and average speed
 
@@ -1076,40 +1054,45 @@ class Shuffle_ImData:
         ####################################################################
         ## calculate the cell activations (spike rate) as a function of position
         if (self.imaging_data == True):
-            fast_bin_counts = np.zeros(self.N_pos_bins)
-            self.n_cells = self.frames_spikes.shape[0]
-            self.n_shuffle = self.frames_spikes.shape[2]
-    
-            self.spks_pos = np.zeros((self.n_cells, self.N_pos_bins, self.n_shuffle)) # sum of spike counts measured at a given position
-            self.event_rate = np.zeros((self.n_cells, self.N_pos_bins, self.n_shuffle)) # spike rate 
-            
-            last_bin_number = 0 # each spike is assigned to all position bins since the last imaging frame 
-            for i_frame in range(len(self.frames_pos)):
-                next_bin_number = int(self.frames_pos[i_frame] // 70) 
-                if ((next_bin_number > last_bin_number + 1) & self.multiplane):
-                    bin_number = np.arange(last_bin_number+1, next_bin_number+1) # the sequence ends at next_bun_number
-                    n_bins = len(bin_number)
-                    B = np.tile(self.frames_spikes[:,i_frame,:], (n_bins, 1, 1))
-                    added_spikes = np.moveaxis(B, 0, 1) # prepare a matrix with the spikes to add at multiple spatial bins
-                    # print('multiple position bins: ', self.lap, i_frame, n_bins)
-                else:
-                    bin_number = next_bin_number
-                    n_bins = 1
-                    added_spikes = self.frames_spikes[:,i_frame,:]
-
-                if (self.frames_speed[i_frame] > self.speed_threshold):
-                    fast_bin_counts[bin_number] += 1 / n_bins
-                    if (self.elfiz):
-                        self.spks_pos[:,bin_number,:] = self.spks_pos[:,bin_number,:] + added_spikes
-                    else:
-                        ### we need to multiply the values with frame_period as this converts probilities to expected counts
-                        self.spks_pos[:,bin_number,:] = self.spks_pos[:,bin_number,:] + added_spikes * self.frame_period / n_bins
-                last_bin_number = next_bin_number
-
+            ## each spike is assigned to all position bins since the last imaging frame in multiplane recordings
+            ## only frames with speed above the threshold are used
+            ## the index is calculated once and used for all minibatches of shuffled spikes
+            i_frames, i_bins, n_bins = position_bins(self.frames_pos, self.multiplane)
+            fast = self.frames_speed[i_frames] > self.speed_threshold
+            self.i_fast_frames = i_frames[fast]
+            self.fast_bins = i_bins[fast]
+            self.fast_n_bins = n_bins[fast]
+            fast_bin_counts = bin_sum(1 / self.fast_n_bins, self.fast_bins, self.N_pos_bins)
             self.T_pos_fast = fast_bin_counts * self.frame_period # used for spike rate calculations
-            for bin_number in range(self.N_pos_bins):
-                if (self.T_pos_fast[bin_number] > 0): # otherwise the rate will remain 0
-                    self.event_rate[:,bin_number,:] = self.spks_pos[:,bin_number,:] / self.T_pos_fast[bin_number]                
-
-
 
+            if (self.frames_spikes is not None):
+                self.bin_spikes(self.frames_spikes)
+
+    def init_spikes(self, n_cells, n_shuffle):
+        ## allocates the spike counts and rates as a function of position for n_cells x n_shuffle shuffled spike trains
+        self.n_cells = n_cells
+        self.n_shuffle = n_shuffle
+        self.spks_pos = np.zeros((self.n_cells, self.N_pos_bins, self.n_shuffle)) # sum of spike counts measured at a given position
+        self.event_rate = np.zeros((self.n_cells, self.N_pos_bins, self.n_shuffle)) # spike rate 
+        self.max_spikes = np.zeros((self.n_cells, self.n_shuffle)) # maximum of the spikes in the lap
+
+    def bin_spikes(self, frames_spikes, i_shuffles=None):
+        ## spike counts and rates as a function of position
+        ## frames_spikes: cells x frames x shuffle array with the spikes in the frames of the lap
+        ## i_shuffles: the shuffles frames_spikes belongs to - the arrays must be allocated by init_spikes
+        ## if None, frames_spikes contains all shuffles
+        ## the shuffled spikes are not stored, only the binned spikes and the maximum in the lap
+        if (i_shuffles is None):
+            self.init_spikes(frames_spikes.shape[0], frames_spikes.shape[2])
+            i_shuffles = slice(None)
+
+        added_spikes = frames_spikes[:,self.i_fast_frames,:]
+        if (not self.elfiz):
+            ### we need to multiply the values with frame_period as this converts probilities to expected counts
+            added_spikes = added_spikes * self.frame_period
+            added_spikes = added_spikes / self.fast_n_bins.astype(added_spikes.dtype).reshape(-1,1)
+        self.spks_pos[:,:,i_shuffles] = bin_sum(added_spikes, self.fast_bins, self.N_pos_bins, axis=1)
+
+        T_fast = self.T_pos_fast.reshape(-1,1)
+        np.divide(self.spks_pos[:,:,i_shuffles], T_fast, out=self.event_rate[:,:,i_shuffles], where=(T_fast > 0)) # otherwise the rate will remain 0
+        self.max_spikes[:,i_shuffles] = np.amax(frames_spikes, 1)
@@ -13,6 +13,8 @@ from matplotlib import pyplot as plt
 from matplotlib import colors as matcols
 # from pathlib import Path # this only works with python > 3.4, not compatible with 2.7
 from scipy.interpolate import interp1d
+from scipy.ndimage import convolve1d
+from scipy.sparse import csr_matrix
 import scipy.stats
 import csv
 from matplotlib.patches import Polygon
@@ -24,7 +26,6 @@ import copy
 import time
 import os
 import pickle
-from xml.dom import minidom
 from matplotlib.backends.backend_pdf import PdfPages
 from datetime import datetime
 import pandas as pd
@@ -34,6 +35,7 @@ from utils import *
 from Stages import *
 from Corridors import *
 from ImShuffle import *
+from LogReader import *
 
 if (platform == 'darwin'):
     csv_kwargs = {'delimiter':' '}
@@ -44,7 +46,7 @@ else:
 
 class ImagingSessionData:
     'Base structure for both imaging and behaviour data'
-    def __init__(self, datapath, date_time, name, task, suite2p_folder, imaging_logfile_name, TRIGGER_VOLTAGE_FILENAME, sessionID=np.nan, selected_laps=None, speed_threshold=5, randseed=123, elfiz=False, reward_zones=None, spikes_tag='', data_folder='analysed_data'):
+    def __init__(self, datapath, date_time, name, task, suite2p_folder, imaging_logfile_name, TRIGGER_VOLTAGE_FILENAME, sessionID=np.nan, selected_laps=None, speed_threshold=5, randseed=123, elfiz=False, reward_zones=None, spikes_tag='', data_folder='analysed_data', mmap=False):
         self.datapath = datapath
         self.date_time = date_time
         self.name = name
@@ -64,6 +66,8 @@ class ImagingSessionData:
         self.substage_change_laps = [0]
         self.substage_change_time = [0]
         self.data_folder = data_folder
+        self.event_params = None # sd_times and refract_seconds used in detect_events
+        self.mmap = mmap # if True, the suite2p arrays are memory mapped and only the arrays of the selected cells are loaded
 
         stagefilename = self.datapath + self.task + '_stages.pkl'
         input_file = open(stagefilename, 'rb')
@@ -129,6 +133,9 @@ class ImagingSessionData:
         ## matching imaging time with labview time
         self.imstart_time = 0 # the labview time of the first imaging frame
         self.imstart_time = LocateImaging(trigger_log_file_string, TRIGGER_VOLTAGE_FILENAME)
+        if np.isnan(self.imstart_time):
+            print('Error: behavior data could not be matched with the imaging data! No analysis was performed, check the logfiles!')
+            return
 
         ##################################################
         ## loading imaging data
@@ -168,9 +175,13 @@ class ImagingSessionData:
             spks_string = self.suite2p_folder + 'spks' + spikes_tag + '.npy'
             iscell_string = self.suite2p_folder + 'iscell.npy'
             
-            self.F_all = np.load(F_string) # npy array, N_ROI x N_frames, fluorescence traces of ROIs from suite2p
+            if (self.mmap):
+                mmap_mode = 'r' # the arrays stay on the disk, F_all and spks_all are read-only views
+            else:
+                mmap_mode = None
+            self.F_all = np.load(F_string, mmap_mode=mmap_mode) # npy array, N_ROI x N_frames, fluorescence traces of ROIs from suite2p
             # self.Fneu = np.load(Fneu_string) # npy array, N_ROI x N_frames, fluorescence traces of neuropil from suite2p
-            self.spks_all = np.load(spks_string) # npy array, N_ROI x N_frames, spike events detected from suite2p
+            self.spks_all = np.load(spks_string, mmap_mode=mmap_mode) # npy array, N_ROI x N_frames, spike events detected from suite2p
             self.iscell = np.load(iscell_string) # np array, N_ROI x 2, 1st col: binary classified as cell. 2nd P_cell?
             self.stat_string = self.suite2p_folder + 'stat.npy' # we may load these later if needed
             self.ops_string = self.suite2p_folder + 'ops.npy'
@@ -187,11 +198,19 @@ class ImagingSessionData:
 
             ## arrays containing only valid cells
             self.neuron_index = np.nonzero(self.iscell[:,0])[0]
-            self.F = self.F_all[self.neuron_index,:]
-            self.raw_spks = self.spks_all[self.neuron_index,:]
-            self.dF_F = np.copy(self.F)
-            self.spks = np.copy(self.raw_spks) # could be normalized in calc_dF_F: spks / F / SD(F)
-            self.N_cells = self.F.shape[0]
+            if (self.mmap):
+                ## F is not loaded, calc_dF_F reads the fluorescence of the cells from F_all
+                ## spks is not normalized, so it is the same array as raw_spks
+                self.F = None
+                self.raw_spks = np.array(self.spks_all[self.neuron_index,:])
+                self.dF_F = np.zeros((len(self.neuron_index), self.F_all.shape[1]), dtype=self.F_all.dtype)
+                self.spks = self.raw_spks
+            else:
+                self.F = self.F_all[self.neuron_index,:]
+                self.raw_spks = self.spks_all[self.neuron_index,:]
+                self.dF_F = np.copy(self.F)
+                self.spks = np.copy(self.raw_spks) # could be normalized in calc_dF_F: spks / F / SD(F)
+            self.N_cells = self.dF_F.shape[0]
             # self.cell_SDs = np.sqrt(np.var(self.dF_F, 1)) - we calculate this later
             self.cell_SDs = np.zeros(self.N_cells) # a vector with the SD of the cells
             self.cell_SNR = np.zeros(self.N_cells) # a vector with the signal to noise ratio of the cells (max F / SD)
@@ -241,10 +260,6 @@ class ImagingSessionData:
 
         self.N_ImLaps = len(self.i_Laps_ImData)
         # print('number of laps with imaging data:', self.N_ImLaps)
-        self.raw_activity_tensor = np.zeros((self.N_pos_bins, self.N_cells, self.N_ImLaps)) # a tensor with space x neurons x trials containing the spikes
-        self.raw_activity_tensor_time = np.zeros((self.N_pos_bins, self.N_ImLaps)) # a tensor with space x trials containing the time spent at each location in each lap
-        self.activity_tensor = np.zeros((self.N_pos_bins, self.N_cells, self.N_ImLaps)) # same as the activity tensor spatially smoothed
-        self.activity_tensor_time = np.zeros((self.N_pos_bins, self.N_ImLaps)) # same as the activity tensor time spatially smoothed
         # print('laps with image data:')
         # print(self.i_Laps_ImData)
         self.combine_lapdata() ## fills in the cell_activity tensor
@@ -406,23 +421,94 @@ class ImagingSessionData:
 
         return True
 
+    def session_params(self):
+        # the parameters of the current ImagingSessionData determining the results of the shuffling, as strings
+        # the datapath and the suite2p_folder are saved but not checked
+        return {'name':self.name, 'task':self.task, 'date_time':self.date_time, 'datapath':self.datapath, 'suite2p_folder':self.suite2p_folder, 'stage':str(self.stage), 'randseed':str(self.randseed), 'speed_threshold':str(self.speed_threshold)}
+
+    def load_shuffle_file(self, filename):
+        # reads the arrays saved by save_shuffle_file from the binary file filename.npz
+        # returns None if the file does not exist or it does not match the parameters of the current ImagingSessionData
+        npz_path = self.suite2p_folder + self.data_folder + '/' + filename + '.npz'
+        if not os.path.exists(npz_path):
+            return None
+        with np.load(npz_path, allow_pickle=False) as store:
+            stored = {key:store[key] for key in store.files}
+        params = self.session_params()
+        for key in ['name', 'task', 'date_time', 'stage', 'randseed', 'speed_threshold']:
+            if (str(stored['param_' + key]) != params[key]):
+                print('Error: ' + key + ' read from file not equals the ' + key + ' in the loaded session!')
+                return None
+        if (('selected_laps' in stored) != (self.selected_laps is not None)):
+            print('Error: selected_laps read from file not equals the selected_laps in the loaded session!')
+            return None
+        if ((self.selected_laps is not None) and (not np.array_equal(stored['selected_laps'], self.selected_laps))):
+            print('Error: selected_laps read from file not equals the selected_laps in the loaded session!')
+            return None
+        return stored
+
+    def save_shuffle_file(self, filename, compressed=False, **arrays):
+        # saves the arrays into the binary file filename.npz together with the parameters of the session
+        data_folder = self.suite2p_folder + self.data_folder
+        if not os.path.exists(data_folder):
+            os.makedirs(data_folder)
+        npz_path = data_folder + '/' + filename + '.npz'
+        temp_path = npz_path + '.tmp'
+        params = {'param_' + key:value for key, value in self.session_params().items()}
+        if (self.selected_laps is not None):
+            params['selected_laps'] = np.array(self.selected_laps)
+        with open(temp_path, 'wb') as shuffle_file:
+            if (compressed):
+                np.savez_compressed(shuffle_file, **arrays, **params)
+            else:
+                np.savez(shuffle_file, **arrays, **params)
+        os.replace(temp_path, npz_path)
+
+    def load_shuffle_Pvalues(self, filename, expected_names, verbous=1):
+        # reads the P-values of the shuffling from the binary file filename.npz in a single read
+        # an old space delimited filename.csv is read if there is no binary file
+        # returns the cells x P-values matrix sorted by the cellids and the names of its columns
+        # or None if the file does not exist or it does not match the parameters of the current ImagingSessionData
+        data_folder = self.suite2p_folder + self.data_folder
+        npz_path = data_folder + '/' + filename + '.npz'
+        csv_path = data_folder + '/' + filename + '.csv'
+        if os.path.exists(npz_path):
+            stored = self.load_shuffle_file(filename)
+            if (stored is None):
+                return None
+            Pvalues = stored['Pvalues']
+            Ps_names = [str(P_name) for P_name in stored['Ps_names']]
+        elif (os.path.exists(csv_path) and self.check_params(filename + '.csv')):
+            with open(csv_path, newline='') as shuffle_file:
+                ## we skip the first few lines, as they contain the header already checked by check_params
+                rows = [row for row in csv.reader(shuffle_file, delimiter=' ') if (row[0][0] != '#')]
+            Ps_names = rows[0]
+            Pvalues = np.array(rows[1:], dtype='float').reshape(-1, len(Ps_names))
+        else:
+            return None
+
+        if (len(Ps_names) != expected_names):
+            if (verbous > 0):
+                print ('number of P-values read from the saved file for each cell does not match the number expected for a given number of corridor. We will perform shuffling.')
+            return None
+        if (verbous > 1):
+            print('shuffling P-values loaded from file for', Pvalues.shape[0], 'cells')
+        return Pvalues[np.argsort(Pvalues[:,0], kind='stable'),:], Ps_names
+
     def get_stage(self, datapath, date_time, name, task):
         # function that reads the action_log_file and finds the current stage
-        action_log_file_string=datapath + 'data/' + name + '_' + task + '/' + date_time + '/' + date_time + '_' + name + '_' + task + '_UserActionLog.txt'
-        action_log_file=open(action_log_file_string, newline='')
-        log_file_reader=csv.reader(action_log_file, delimiter=',')
-        next(log_file_reader, None)#skip the headers
-        for line in log_file_reader:
-            if (line[1] == 'Stage'):
-                self.stage = int(round(float(line[2])))
+        action_log_file_string = LogFileName(datapath, date_time, name, task, 'UserActionLog')
+        stage = LoadStage(action_log_file_string)
+        if (stage is not None):
+            self.stage = stage
 
     def LoadImaging_times(self, offset):
-        # function that reads the action_log_file and finds the current stage
-        # minidom is an xml file interpreter for python
-        # hope it works for python 3.7...
-        imaging_logfile = minidom.parse(self.imaging_logfile_name)
-        voltage_rec = imaging_logfile.getElementsByTagName('VoltageRecording')
-        voltage_delay = float(voltage_rec[0].attributes['absoluteTime'].value)
+        # function that reads the frame times from the xml logfile of the imaging
+        # only the Frame, Sequence and VoltageRecording elements are read - see LogReader.LoadImagingXML
+        imaging_times = LoadImagingXML(self.imaging_logfile_name)
+        relative_times = imaging_times['relative_times']
+        absolute_times = imaging_times['absolute_times']
+        voltage_delay = imaging_times['voltage_delay']
         ## the offset is the time of the first voltage signal in Labview time
         ## the signal's 0 has a slight delay compared to the time 0 of the imaging recording 
         ## we substract this delay from the offset to get the LabView time of the time 0 of the imaging recording
@@ -430,32 +516,27 @@ class ImagingSessionData:
         print('corrected offset:', corrected_offset, 'voltage_delay:', voltage_delay)  
         
         #find out whether it's a multiplane recording
-        sequence = imaging_logfile.getElementsByTagName('Sequence')
-        frames = imaging_logfile.getElementsByTagName('Frame')
-        if sequence[0].attributes['type'].value == 'TSeries ZSeries Element':
+        N_frames = len(relative_times)
+        if imaging_times['sequence_type'] == 'TSeries ZSeries Element':
             print('multi-plane')
             self.multiplane = True
             #for multiplane recordings we drop last frame as it is sometimes 'missing' for one of the planes
             self.F_all = self.F_all[:, 0:-1]
             self.spks_all = self.spks_all[:, 0:-1]
             # self.Fneu = self.Fneu[:, 0:-1]
-            if len(frames) %2 == 0:    
-                len_frames_used = int(len(frames)/2-1)
-            if len(frames) %2 == 1:
-                len_frames_used = int((len(frames)-1)/2)
+            if N_frames %2 == 0:    
+                len_frames_used = int(N_frames/2-1)
+            if N_frames %2 == 1:
+                len_frames_used = int((N_frames-1)/2)
             # for frame time we use the average of the two planes time
-            self.frame_times = np.zeros(len_frames_used)
-            self.im_reftime = float(frames[1].attributes['relativeTime'].value) - float(frames[1].attributes['absoluteTime'].value)
-            for i in range(len_frames_used): ## checkit: why i and i+1 and not 2i and 2i - 1?
-                self.frame_times[i] = (float(frames[2*i].attributes['relativeTime'].value) + float(frames[2*i+1].attributes['relativeTime'].value))/2 + corrected_offset
+            self.im_reftime = relative_times[1] - absolute_times[1]
+            self.frame_times = (relative_times[0:2*len_frames_used:2] + relative_times[1:2*len_frames_used:2])/2 + corrected_offset
             
         else:
             print('single-plane')
 
-            self.frame_times = np.zeros(len(frames)) # this is already in labview time
-            self.im_reftime = float(frames[1].attributes['relativeTime'].value) - float(frames[1].attributes['absoluteTime'].value)
-            for i in range(len(frames)):
-                self.frame_times[i] = float(frames[i].attributes['relativeTime'].value) + corrected_offset       
+            self.im_reftime = relative_times[1] - absolute_times[1]
+            self.frame_times = relative_times + corrected_offset # this is already in labview time
         
         if (len(self.frame_times) != self.F_all.shape[1]):
             print('ERROR: imaging frame number does not match suite2p frame number! Something is wrong!')
@@ -530,71 +611,71 @@ class ImagingSessionData:
         Lmin_no_spike = int(round(Tmin_no_spike * self.frame_rate ))
 
         N_frames = len(self.frame_times) 
-        filt = np.ones(self.frame_rate)
 
-        #calculate baseline
-        for i_cell in range(self.N_cells):
-            
-            # baseline: mode of the histogram
-            trace=self.F[i_cell,]
-            hist=np.histogram(trace, bins=100)
-            max_index = np.where(hist[0] == max(hist[0]))[0][0]
-            baseline = hist[1][max_index]
-            # if (baseline == 0): 
-            #     baseline = hist[1][max_index+1]            
+        ## cells are processed in blocks - all operations on the full traces are done for the whole block at once
+        block_size = max(1, int(2**22 / N_frames))
+        for i_start_block in range(0, self.N_cells, block_size):
+            i_cells = np.arange(i_start_block, min(i_start_block + block_size, self.N_cells))
+            if (self.F is None): # memory mapped data
+                F_block = np.array(self.F_all[self.neuron_index[i_cells],])
+            else:
+                F_block = self.F[i_cells,]
 
-            self.dF_F[i_cell,] = (self.F[i_cell,] - baseline) / baseline
+            # baseline: mode of the histogram
+            baselines = hist_mode(F_block, bins=100).reshape(-1,1)
+            self.dF_F[i_cells,] = (F_block - baselines) / baselines
 
             ### 1. find places where there are no spikes for a long interval 
             ### 1.1. we add all spikes in a 1s window by convolving it with a 1s box car function
-            # fig, ax = plt.subplots(figsize=(12,8))
-            # i_plot = 0  
-            # cells = np.sort(np.random.randint(0, self.N_cells, 6))
-            # cells[0] = 4
-            # cells[5] = 1064
-
-            allspikes_1s = np.hstack([np.repeat(sp_threshold, self.frame_rate-1), np.convolve(self.raw_spks[i_cell,:], filt, mode='valid')])
+            allspikes_1s = np.hstack([np.full((len(i_cells), self.frame_rate-1), sp_threshold), moving_sum(self.raw_spks[i_cells,:], self.frame_rate, exact_at=sp_threshold)])
 
             ### 1.2 no spikes if the sum remains smaller than sp_threshold
             sp_1s = np.copy(allspikes_1s)
-            sp_1s[np.nonzero(allspikes_1s < sp_threshold)[0]] = 0
-
-            ### 1.3. find silent sections
-            rise_index=np.nonzero((sp_1s[0:-1] < 1)&(sp_1s[1:]>= 1))[0]+1
-            fall_index=np.nonzero((sp_1s[0:-1] > 1)&(sp_1s[1:]<= 1))[0]+1
-            if (len(rise_index) == 0):
-                rise_index = np.array([int(len(sp_1s))])
-            if (max(rise_index) < N_frames-1000):
-                rise_index = np.hstack([rise_index, int(len(sp_1s))])
-            if (len(fall_index) == 0):
-                fall_index = np.array([int(0)])
-
-
-            # pairing rises with falls
-            if (fall_index[0]>rise_index[0]):
-                # print('deleting first rise')
-                rise_index = np.delete(rise_index,0)
-            if (fall_index[-1] > rise_index[-1]):
-                # print('deleting last fall')
-                fall_index=np.delete(fall_index,-1)
-            if (len(rise_index) != len(fall_index)):
-                print('rise and fall could not be matched for cell ' +  str(i_cell))
-
-            long_index = np.nonzero((rise_index - fall_index) > L_after_spike + L_before_spike + Lmin_no_spike)[0]
-            rise_ind = rise_index[long_index]
-            fall_ind = fall_index[long_index]
-
-            sds = np.zeros(len(rise_ind))
-            bases = np.zeros(len(rise_ind))
-            for k in range(len(rise_ind)):
-                i_start = fall_ind[k] + L_after_spike
-                i_end = rise_ind[k] - L_before_spike
-                sds[k] = np.sqrt(np.var(self.dF_F[i_cell,i_start:i_end]))
-                bases[k] = np.average(self.dF_F[i_cell,i_start:i_end])
-            self.cell_baselines[i_cell] = np.mean(bases)
-            self.cell_SDs[i_cell] = np.mean(sds)
-            self.cell_SNR[i_cell] = max(self.dF_F[i_cell,:]) / np.mean(sds)
-            self.spks[i_cell,:] = self.spks[i_cell,:]# / baseline / self.cell_SDs[i_cell]
+            sp_1s[allspikes_1s < sp_threshold] = 0
+
+            ### 1.3. find silent sections - rises and falls for all cells in the block
+            rise_cells, rise_frames = np.nonzero((sp_1s[:,0:-1] < 1)&(sp_1s[:,1:]>= 1))
+            fall_cells, fall_frames = np.nonzero((sp_1s[:,0:-1] > 1)&(sp_1s[:,1:]<= 1))
+            rise_starts = np.searchsorted(rise_cells, np.arange(len(i_cells) + 1))
+            fall_starts = np.searchsorted(fall_cells, np.arange(len(i_cells) + 1))
+            max_dF_F = np.max(self.dF_F[i_cells,], axis=1)
+
+            for k_cell in range(len(i_cells)):
+                i_cell = i_cells[k_cell]
+                rise_index = rise_frames[rise_starts[k_cell]:rise_starts[k_cell+1]] + 1
+                fall_index = fall_frames[fall_starts[k_cell]:fall_starts[k_cell+1]] + 1
+                if (len(rise_index) == 0):
+                    rise_index = np.array([int(N_frames)])
+                if (max(rise_index) < N_frames-1000):
+                    rise_index = np.hstack([rise_index, int(N_frames)])
+                if (len(fall_index) == 0):
+                    fall_index = np.array([int(0)])
+
+                # pairing rises with falls
+                if (fall_index[0]>rise_index[0]):
+                    # print('deleting first rise')
+                    rise_index = np.delete(rise_index,0)
+                if (fall_index[-1] > rise_index[-1]):
+                    # print('deleting last fall')
+                    fall_index=np.delete(fall_index,-1)
+                if (len(rise_index) != len(fall_index)):
+                    print('rise and fall could not be matched for cell ' +  str(i_cell))
+
+                long_index = np.nonzero((rise_index - fall_index) > L_after_spike + L_before_spike + Lmin_no_spike)[0]
+                rise_ind = rise_index[long_index]
+                fall_ind = fall_index[long_index]
+
+                ## the silent segments have different lengths, their SD and mean are calculated one by one
+                sds = np.zeros(len(rise_ind))
+                bases = np.zeros(len(rise_ind))
+                for k in range(len(rise_ind)):
+                    i_start = fall_ind[k] + L_after_spike
+                    i_end = rise_ind[k] - L_before_spike
+                    sds[k] = np.sqrt(np.var(self.dF_F[i_cell,i_start:i_end]))
+                    bases[k] = np.average(self.dF_F[i_cell,i_start:i_end])
+                self.cell_baselines[i_cell] = np.mean(bases)
+                self.cell_SDs[i_cell] = np.mean(sds)
+                self.cell_SNR[i_cell] = max_dF_F[k_cell] / np.mean(sds)
 
         print('SNR done')
 
@@ -614,16 +695,10 @@ class ImagingSessionData:
         #sd_times - events should be above this many times the baseline sd
         #refract_seconds - refractoryness of event detection in seconds
         
-        
-        # creating the gaussian filter
-        sdfilt = 3
-        N = 10
-        sampling_time = 1
-        xfilt = np.arange(-N*sdfilt, N*sdfilt + sampling_time, sampling_time)
-        filt = np.exp(-(xfilt**2) / (2*(sdfilt**2)))
-        filt = filt/sum(filt)
-        
-        # calculating events
+        # the events are detected only once, by detect_events - we only repeat it if the parameters are different
+        if ((self.event_params is None) or (self.event_params != (sd_times, refract_seconds))):
+            self.detect_events(sd_times=sd_times, refract_seconds=refract_seconds)
+
         #if not all laps are loaded we need to adjust the threshold accordingly!
         #if all laps are used:
         if self.selected_laps is None:
@@ -637,48 +712,54 @@ class ImagingSessionData:
             print('active_cells may be unreliable due to the shortness of the analysed period')
         
         # print('active threshold: ', active_threshold)
-        refractoriness = int(refract_seconds/self.frame_period) 
-        
-        n_events = np.zeros([self.N_cells])
-        self.events=np.zeros(self.F.shape)
+        self.active_cells = np.nonzero(self.N_events>active_threshold)[0]
         
-        for i in range(self.N_cells):
-            temp = np.hstack([np.repeat(self.dF_F[i,0], N*sdfilt),self.dF_F[i,:], np.repeat(self.dF_F[i,-1], N*sdfilt)])
-            dF_F_s = np.convolve(temp, filt, mode = 'valid')
-            threshold=self.cell_baselines[i]+self.cell_SDs[i]*sd_times
-            rises = np.nonzero((dF_F_s[0:-1] < threshold) & (dF_F_s[1:]>= threshold))[0]
-            
-            self.events[i,rises]=1 #here we do not take refractoriness into account
-            valid = np.ones_like(rises)
-            for j in range(rises.size-1):
-                if valid[j]:
-                    ind = np.nonzero((rises > rises[j]) & ((rises-rises[j]) < refractoriness))[0]
-                    valid[ind] = 0
-            n_events[i]=np.size(np.nonzero(valid==1)[0])
-        #return
-        self.active_cells = np.nonzero(n_events>active_threshold)[0]
-        self.N_events = np.array(n_events)
-        
-    def detect_events(self,sd_times = 3):\
+    def detect_events(self, sd_times = 3, refract_seconds = 5):
         # detecting significant events in the fluorescence signal
-        # an event is significant, if the Gaussian filtered (SD = 3 x Interframe interval ) dF/F 
+        # an event is significant, if the Gaussian filtered (SD = 3 x Interframe interval ) dF/F crosses the threshold baseline + sd_times x SD
         # 
-        # this function is redundant with the calc_active function in some parts. We need this in order to be able to pass events to individual laps
+        # self.events: sparse (CSR) N_cells x N_frames matrix, 1 at the frames where an event starts - here we do not take refractoriness into account. We need this in order to be able to pass events to individual laps
+        # self.N_events: number of events, where events closer than refract_seconds to the previous counted event are not counted - used by calc_active
         sdfilt = 3
         N = 10
         sampling_time = 1
         xfilt = np.arange(-N*sdfilt, N*sdfilt + sampling_time, sampling_time)
         filt = np.exp(-(xfilt**2) / (2*(sdfilt**2)))
         filt = filt/sum(filt)
-        self.events=np.zeros(self.F.shape)
-        
-        for i in range(self.N_cells):
-            temp = np.hstack([np.repeat(self.dF_F[i,0], N*sdfilt),self.dF_F[i,:], np.repeat(self.dF_F[i,-1], N*sdfilt)])
-            dF_F_s = np.convolve(temp, filt, mode = 'valid')
-            threshold=self.cell_baselines[i]+self.cell_SDs[i]*sd_times
-            rises = np.nonzero((dF_F_s[0:-1] < threshold) & (dF_F_s[1:]>= threshold))[0]
-            
-            self.events[i,rises]=1 #here we do not take refractoriness into account
+
+        N_frames = self.dF_F.shape[1]
+        thresholds = self.cell_baselines + self.cell_SDs * sd_times
+        rise_cells = []
+        rise_frames = []
+
+        ## the traces are filtered in blocks of cells - the edges are padded with the first and last values
+        block_size = max(1, int(2**22 / N_frames))
+        for i_start_block in range(0, self.N_cells, block_size):
+            i_cells = np.arange(i_start_block, min(i_start_block + block_size, self.N_cells))
+            dF_F_s = convolve1d(self.dF_F[i_cells,:], filt, axis=1, mode='nearest', output=np.float64)
+            threshold = thresholds[i_cells].reshape(-1,1)
+
+            ## the rounding errors of convolve1d may be different from np.convolve
+            ## cells with values very close to the threshold are filtered again with np.convolve
+            max_error = 2 * len(filt) * np.finfo(np.float64).eps * np.max(np.abs(self.dF_F[i_cells,:]), axis=1).reshape(-1,1)
+            for k_cell in np.flatnonzero(np.any(np.abs(dF_F_s - threshold) <= max_error, axis=1)):
+                i = i_cells[k_cell]
+                temp = np.hstack([np.repeat(self.dF_F[i,0], N*sdfilt),self.dF_F[i,:], np.repeat(self.dF_F[i,-1], N*sdfilt)])
+                dF_F_s[k_cell,:] = np.convolve(temp, filt, mode = 'valid')
+
+            cells, rises = np.nonzero((dF_F_s[:,0:-1] < threshold) & (dF_F_s[:,1:]>= threshold))
+            rise_cells.append(i_cells[cells])
+            rise_frames.append(rises)
+        rise_cells = np.hstack(rise_cells)
+        rise_frames = np.hstack(rise_frames)
+        self.events = csr_matrix((np.ones(len(rise_frames)), (rise_cells, rise_frames)), shape=self.dF_F.shape) #here we do not take refractoriness into account
+
+        ## refractoriness: an event is counted if it is at least refractoriness frames after the previous counted event
+        refractoriness = int(refract_seconds/self.frame_period) 
+        n_events = count_refractory_events(rise_cells, rise_frames, self.N_cells, N_frames, refractoriness)
+
+        self.N_events = n_events
+        self.event_params = (sd_times, refract_seconds)
 
     ##############################################################
     ## loading the LabView data
@@ -687,37 +768,16 @@ class ImagingSessionData:
 
     def get_lapdata(self, datapath, date_time, name, task, selected_laps=None):
 
-        time_array=[]
-        lap_array=[]
-        maze_array=[]
-        position_array=[]
-        mode_array=[]
-        lick_array=[]
-        action=[]
-        substage=[]
-
-        # this could be made much faster by using pandas
-        data_log_file_string=datapath + 'data/' + name + '_' + task + '/' + date_time + '/' + date_time + '_' + name + '_' + task + '_ExpStateMashineLog.txt'
-        data_log_file=open(data_log_file_string, newline='')
-        log_file_reader=csv.reader(data_log_file, delimiter=',')
-        next(log_file_reader, None)#skip the headers
-        for line in log_file_reader:
-            time_array.append(float(line[0]))
-            lap_array.append(int(line[1]))
-            maze_array.append(int(line[2]))
-            position_array.append(int(line[3]))
-            mode_array.append(line[6] == 'Go')
-            lick_array.append(line[9] == 'TRUE')
-            action.append(str(line[14]))
-            substage.append(str(line[17]))
-
-        laptime = np.array(time_array)
+        data_log_file_string = ExpStateLogFileName(datapath, date_time, name, task)
+        explog = ExpStateLog(data_log_file_string)
+
+        laptime = explog.time
         time_breaks = np.where(np.diff(laptime) > 1)[0]
         if (len(time_breaks) > 0):
             print('ExpStateMachineLog time interval > 1s: ', len(time_breaks), ' times')
             # print(laptime[time_breaks])
 
-        lap = np.array(lap_array)
+        lap = explog.lap
         logged_laps = np.unique(lap)
         all_laps = np.arange(max(lap)) + 1
         missing_laps = np.setdiff1d(all_laps, logged_laps)
@@ -728,13 +788,13 @@ class ImagingSessionData:
             self.n_laps = -1
             return 
         
-        sstage = np.array(substage)
+        sstage = explog.substage_codes # integer codes, the names are in explog.substage_names
         current_sstage = sstage[0]
 
-        pos = np.array(position_array)
-        lick = np.array(lick_array)
-        maze = np.array(maze_array)
-        mode = np.array(mode_array)
+        pos = explog.position
+        lick = explog.lick
+        maze = explog.maze
+        mode = explog.mode
 
         #################################################
         ## add position, and lap info into the imaging frames
@@ -838,7 +898,7 @@ class ImagingSessionData:
                     if (sstage_lap != current_sstage):
                         print('############################################################')
                         print('substage change detected!')
-                        print('first lap in substage ', sstage_lap, 'is lap', self.n_laps, ', which started at t', t_lap[0])
+                        print('first lap in substage ', explog.substage_names[sstage_lap], 'is lap', self.n_laps, ', which started at t', t_lap[0])
                         print('the time of the change in imaging time is: ', t_lap[0] - self.imstart_time)
                         print('############################################################')
                         current_sstage = sstage_lap
@@ -846,11 +906,9 @@ class ImagingSessionData:
                         self.substage_change_time.append(t_lap[0] - self.imstart_time)
 
 
-                    istart = np.min(y) # action is not a np.array, array indexing does not work
+                    istart = np.min(y)
                     iend = np.max(y) + 1
-                    action_lap = action[istart:iend]
-        
-                    reward_indices = [j for j, x in enumerate(action_lap) if x == "TrialReward"]
+                    reward_indices = explog.get_reward_indices(istart, iend)
                     t_reward = t_lap[reward_indices]
 
                     ## detecting invalid laps - terminated before the animal could receive reward
@@ -877,10 +935,7 @@ class ImagingSessionData:
                                 t_g_lap = laptime[y_g]
                                 next_grey_lap_duration = np.max(t_g_lap) - np.min(t_g_lap)
 
-                    actions = []
-                    for j in range(len(action_lap)):
-                        if not((action_lap[j]) in ['No', 'TrialReward']):
-                            actions.append([t_lap[j], action_lap[j]])
+                    actions = explog.get_actions(t_lap, istart, iend)
 
                     ## include only valid laps
                     add_ImLap = True
@@ -889,13 +944,13 @@ class ImagingSessionData:
                         print('lap mode = 0')
 
                     ### imaging data    
-                    iframes = np.flatnonzero(self.frame_laps == i_lap)
-                    if (len(iframes) > 1): # there is imaging data belonging to this lap...
+                    iframes = lap_frames(self.frame_laps, i_lap) # slice - the lap arrays are views of the session arrays
+                    if (len(self.frame_times[iframes]) > 1): # there is imaging data belonging to this lap...
                         lap_frames_dF_F = self.dF_F[:,iframes]
                         lap_frames_spikes = self.spks[:,iframes]
                         lap_frames_time = self.frame_times[iframes]
                         lap_frames_pos = self.frame_pos[iframes]
-                        lap_frames_events = self.events[:,iframes]
+                        lap_frames_events = self.events[:,iframes] # sparse matrix
                         # print(self.n_laps, np.min(lap_frames_pos), np.max(lap_frames_pos))
                         if (np.min(lap_frames_pos) > imaging_min_position):
                             add_ImLap = False
@@ -947,34 +1002,21 @@ class ImagingSessionData:
         self.i_corridors = np.array(i_corrids) # ID of corridor for the current lap
 
     def combine_lapdata(self): ## fills in the cell_activity tensor
-        # self.raw_activity_tensor = np.zeros((self.N_pos_bins, self.N_cells, self.N_ImLaps)) # a tensor with space x neurons x trials containing the spikes
-        # self.raw_activity_tensor_time = np.zeros((self.N_pos_bins, self.N_ImLaps)) # a tensor with space x  trials containing the time spent at each location in each lap
-        valid_lap = np.zeros(len(self.i_Laps_ImData))
-        k_lap = 0
-        for i_lap in self.i_Laps_ImData:
-            if (self.ImLaps[i_lap].n_cells > 0):  # we only add imaging data when the lap is valid, so we don't need to test it again
-                valid_lap[k_lap] = 1
-                self.raw_activity_tensor[:,:,k_lap] = np.transpose(self.ImLaps[i_lap].spks_pos)
-                self.raw_activity_tensor_time[:,k_lap] = self.ImLaps[i_lap].T_pos_fast
-            k_lap = k_lap + 1
+        ## we only add imaging data when the lap is valid, so we don't need to test it again
+        valid_lap = np.array([self.ImLaps[i_lap].n_cells > 0 for i_lap in self.i_Laps_ImData], dtype=bool)
+        self.i_Laps_ImData = self.i_Laps_ImData[valid_lap]
+        N_valid_laps = len(self.i_Laps_ImData)
+
+        self.raw_activity_tensor = np.zeros((self.N_pos_bins, self.N_cells, N_valid_laps)) # a tensor with space x neurons x trials containing the spikes
+        self.raw_activity_tensor_time = np.zeros((self.N_pos_bins, N_valid_laps)) # a tensor with space x trials containing the time spent at each location in each lap
+        for k_lap, i_lap in enumerate(self.i_Laps_ImData):
+            self.raw_activity_tensor[:,:,k_lap] = np.transpose(self.ImLaps[i_lap].spks_pos)
+            self.raw_activity_tensor_time[:,k_lap] = self.ImLaps[i_lap].T_pos_fast
 
         ## smoothing - average of the 3 neighbouring bins
-        # self.activity_tensor = self.raw_activity_tensor
-        # self.activity_tensor_time = self.raw_activity_tensor_time
-        self.activity_tensor[0,:,:] = (self.raw_activity_tensor[0,:,:] + self.raw_activity_tensor[1,:,:]) / 2
-        self.activity_tensor[-1,:,:] = (self.raw_activity_tensor[-2,:,:] + self.raw_activity_tensor[-1,:,:]) / 2
-        self.activity_tensor_time[0,:] = (self.raw_activity_tensor_time[0,:] + self.raw_activity_tensor_time[1,:]) / 2
-        self.activity_tensor_time[-1,:] = (self.raw_activity_tensor_time[-2,:] + self.raw_activity_tensor_time[-1,:]) / 2
-        for i_bin in np.arange(1, self.N_pos_bins-1):
-            self.activity_tensor[i_bin,:,:] = np.average(self.raw_activity_tensor[(i_bin-1):(i_bin+2),:,:], axis=0)
-            self.activity_tensor_time[i_bin,:] = np.average(self.raw_activity_tensor_time[(i_bin-1):(i_bin+2),:], axis=0)
-
-        i_valid_laps = np.nonzero(valid_lap)[0]
-        self.i_Laps_ImData = self.i_Laps_ImData[i_valid_laps]
-        self.raw_activity_tensor = self.raw_activity_tensor[:,:,i_valid_laps]
-        self.raw_activity_tensor_time = self.raw_activity_tensor_time[:,i_valid_laps]
-        self.activity_tensor = self.activity_tensor[:,:,i_valid_laps]
-        self.activity_tensor_time = self.activity_tensor_time[:,i_valid_laps]
+        self.activity_tensor = smooth_bins(self.raw_activity_tensor) # same as the activity tensor spatially smoothed
+        self.activity_tensor_time = smooth_bins(self.raw_activity_tensor_time) # same as the activity tensor time spatially smoothed
+        self.lap_ratemaps = {} # ratemaps in individual laps, calculated by calc_lap_ratemaps when needed
 
     def speed_vs_activity(self):
 #        print('IMAGED LAPS',len(self.ImLaps))
@@ -990,8 +1032,8 @@ class ImagingSessionData:
             if self.ImLaps[i].imaging_data==True:
 #                print(self.ImLaps[i].frames_dF_F.shape)
                 av_speed = np.average(self.ImLaps[i].frames_speed)
-                sum_events = np.sum(self.ImLaps[i].frames_events)
-                n_active_cells = np.nonzero(np.sum(self.ImLaps[i].frames_events, axis=1))[0].size
+                sum_events = self.ImLaps[i].frames_events.sum()
+                n_active_cells = np.count_nonzero(self.ImLaps[i].frames_events.getnnz(axis=1))
                 plt.figure('events')
                 plt.scatter(av_speed, sum_events)
                 plt.figure('active cells')
@@ -1013,6 +1055,7 @@ class ImagingSessionData:
 
         self.cell_corridor_selectivity = np.zeros([2,self.N_cells]) # a matrix with the selectivity index of the cells. Second row indicates the corridor with the highers rate.
         self.cell_corridor_similarity = np.zeros(self.N_cells) # a matrix with the similarity index of the cells.
+        self.PV_corr_cache = {} # population vector correlations between the ratemaps of the corridors, calculated by calc_crosscorr when needed
 
         if (self.N_corridors > 0):
             for i_corridor in np.arange(self.N_corridors): # we exclude corridor 0
@@ -1029,11 +1072,7 @@ class ImagingSessionData:
                 act_tensor_1 = self.activity_tensor[:,:,i_laps] ## bin x cells x laps; all activity in all laps in corridor i
                 total_spikes = np.sum(act_tensor_1, axis=2) ##  bin x cells; total activity of the selected cells in corridor i
 
-                rate_matrix = np.zeros_like(total_spikes) ## event rate 
-                
-                for i_cell in range(self.N_cells):
-                # for i_cell in range(total_spikes.shape[1]):
-                    rate_matrix[:,i_cell] = total_spikes[:,i_cell] / total_time
+                rate_matrix = total_spikes / total_time.reshape(-1,1) ## event rate 
                 self.ratemaps.append(rate_matrix)
                 
                 print('calculating rate, reliability and Fano factor...')
@@ -1052,80 +1091,57 @@ class ImagingSessionData:
                     self.cell_pattern_rates.append(np.vstack([rates_pattern1, rates_pattern2, rates_pattern3, rates_reward]))
 
                 ## reliability and Fano factor
-                reliability = np.zeros(self.N_cells)
-                Fano_factor = np.zeros(self.N_cells)
-                for i_cell in range(self.N_cells):
-                    laps_rates = nan_divide(act_tensor_1[:,i_cell,:], time_matrix_1, where=(time_matrix_1 > 0.025))
-                    corrs_cell = vcorrcoef(np.transpose(laps_rates), rate_matrix[:,i_cell])
-                    reliability[i_cell] = np.nanmean(corrs_cell)
-                    Fano_factor[i_cell] = np.nanmean(nan_divide(np.nanvar(laps_rates, axis=1), rate_matrix[:,i_cell], rate_matrix[:,i_cell] > 0))
+                ## laps_rates: bins x cells x laps, nan where the animal spent too little time in the bin
+                time_matrix_3 = time_matrix_1.reshape(self.N_pos_bins, 1, N_laps_corr)
+                laps_rates = nan_divide(act_tensor_1, time_matrix_3, where=(time_matrix_3 > 0.025))
+                ## the sums are rounded as in the loop over the cells, see loop_sum_layout
+                rates_cells = np.transpose(rate_matrix) # cells x bins
+                corrs = batch_vcorrcoef(loop_sum_layout(np.moveaxis(laps_rates, 0, 2)), rates_cells) # cells x laps
+                reliability = np.nanmean(np.ascontiguousarray(corrs), axis=1)
+                laps_var = np.nanvar(loop_sum_layout(np.moveaxis(laps_rates, 1, 0)), axis=2) # cells x bins
+                Fano_factor = np.nanmean(np.ascontiguousarray(nan_divide(laps_var, rates_cells, rates_cells > 0)), axis=1)
                 self.cell_reliability.append(reliability)
                 self.cell_Fano_factor.append(Fano_factor)
 
 
                 print('calculating Skaggs spatial info...')
                 ## Skaggs spatial info in bits per spike
-                skaggs_vector=np.zeros(self.N_cells)
                 P_x=total_time/np.sum(total_time)
-                for i_cell in range(self.N_cells):
-                    mean_firing = rates[i_cell]
-                    lambda_x = rate_matrix[:,i_cell]
-                    i_nonzero = np.nonzero(lambda_x > 0)
-                    skaggs_vector[i_cell] = np.sum(lambda_x[i_nonzero]*np.log2(lambda_x[i_nonzero]/mean_firing)*P_x[i_nonzero]) / mean_firing
+                skaggs_vector = skaggs_info(np.transpose(rate_matrix), rates, P_x)
                 self.cell_skaggs.append(skaggs_vector)
                  
                 ## active laps/ all laps spks
                 #use raw spks instead activity tensor
                 print('calculating proportion of active laps...')
-                active_laps = np.zeros((self.N_cells, N_laps_corr))
-
                 icorrids = self.i_corridors[self.i_Laps_ImData] # corridor ids with image data
                 i_laps_abs = self.i_Laps_ImData[np.nonzero(icorrids == corridor)[0]] # we need a different indexing here, for the ImLaps list and not fot  the activityTensor
-                k = 0
                 if (self.elfiz):
                     spike_threshold = 0.75
                 else:
                     spike_threshold = 25
 
-                for i_lap in i_laps_abs:#y=ROI
-                    act_cells = np.nonzero(np.amax(self.ImLaps[i_lap].frames_spikes, 1) > spike_threshold)[0]
-                    active_laps[act_cells, k] = 1
-                    k = k + 1
-
-                active_laps_ratio = np.sum(active_laps, 1) / N_laps_corr
+                ## maximum of the cells in each lap: cells x laps
+                max_spikes = np.array([np.amax(self.ImLaps[i_lap].frames_spikes, 1) for i_lap in i_laps_abs]).reshape(N_laps_corr, self.N_cells).T
+                active_laps_ratio = np.sum(max_spikes > spike_threshold, 1) / N_laps_corr
                 self.cell_activelaps.append(active_laps_ratio)
                 
                 ## dF/F active laps/all laps
                 print('calculating proportion of active laps based on dF/F ...')
-                active_laps_df = np.zeros((self.N_cells, N_laps_corr))
-                k = 0
-                for i_lap in i_laps_abs:
-                    act_cells = np.nonzero(np.amax(self.ImLaps[i_lap].frames_dF_F, 1) > (self.cell_SDs*nSD))[0]
-                    active_laps_df[act_cells, k] = 1
-                    k = k + 1
-                active_laps_ratio_df = np.sum(active_laps_df, 1) / N_laps_corr
+                max_dF_F = np.array([np.amax(self.ImLaps[i_lap].frames_dF_F, 1) for i_lap in i_laps_abs]).reshape(N_laps_corr, self.N_cells).T
+                active_laps_ratio_df = np.sum(max_dF_F > (self.cell_SDs*nSD).reshape(-1,1), 1) / N_laps_corr
                 self.cell_activelaps_df.append(active_laps_ratio_df)
 
                 ## linear tuning specificity
                 print('calculating linear tuning specificity ...')
-                tuning_spec = np.zeros(self.N_cells)
                 xbins = (np.arange(self.N_pos_bins) + 0.5) * self.corridor_length_cm / self.N_pos_bins
-                
-                for i_cell in range(self.N_cells):
-                    rr = np.copy(rate_matrix[:,i_cell])
-                    rr[rr < np.mean(rr)] = 0
-                    Px = rr / np.sum(rr)
-                    mu = np.sum(Px * xbins)
-                    sigma = np.sqrt(np.sum(Px * xbins**2) - mu**2)
-                    tuning_spec[i_cell] = self.corridor_length_cm / sigma
-
+                tuning_spec = tuning_specificity(np.transpose(rate_matrix), xbins, self.corridor_length_cm)
                 self.cell_tuning_specificity.append(tuning_spec)
 
         if (self.N_corridors > 1):
             self.calc_selectivity_similarity()
 
 
-    def calc_selectivity_similarity(self, zone=None):
+    def calc_selectivity_similarity(self, zone=None, return_matrix=False):
         ## corridor selectivity calculated for M corridors for all neurons
         ## selectivity is defined as (max(r) - min(r)) / sum(r) 
         ##           is always positive
@@ -1140,42 +1156,28 @@ class ImagingSessionData:
         ##           is near 0 for cells with uncorrelated ratemaps
         ##           is 1 if cells have identical ratemaps for all the corridors
         ## the similarity is stored in a vector of 1 element for each cell
+        ## return_matrix: if True, the corridor x corridor x cells matrix of the correlations between the ratemaps is returned
 
         print('calculating corridor selectivity ...')
-        rate_matrix = np.array(self.cell_rates)
-
-        max_rate = np.max(rate_matrix, axis=0)
-        i_corr_max = np.argmax(rate_matrix, axis=0)
-        min_rate = np.min(rate_matrix, axis=0)
-        sumrate = np.sum(rate_matrix, axis=0)
-
-        self.cell_corridor_selectivity[0,:] = (max_rate - min_rate) / sumrate
+        selectivity, i_corr_max = corridor_selectivity(np.array(self.cell_rates))
+        self.cell_corridor_selectivity[0,:] = selectivity
         self.cell_corridor_selectivity[1,:] = i_corr_max
         
         # in Rita's task, we also calculate corridor selectivity in the pattern and reward zones:
         if (self.task == 'contingency_learning'):
-            rate_matrix = np.array(self.cell_pattern_rates)
-            max_rate = np.max(rate_matrix, axis=0)
-            i_corr_max = np.argmax(rate_matrix, axis=0)
-            min_rate = np.min(rate_matrix, axis=0)
-            sumrate = np.sum(rate_matrix, axis=0)
+            selectivity, i_corr_max = corridor_selectivity(np.array(self.cell_pattern_rates))
             self.cell_pattern_selectivity = np.zeros(2*4*self.N_cells).reshape(2, 4, self.N_cells)
-            self.cell_pattern_selectivity[0,:,:] = (max_rate - min_rate) / sumrate
+            self.cell_pattern_selectivity[0,:,:] = selectivity
             self.cell_pattern_selectivity[1,:,:] = i_corr_max
 
         print('calculating corridor similarity ...')
         map_mat = np.array(self.ratemaps)
         N_corridors_w_ratemaps = map_mat.shape[0]
-        M = int(N_corridors_w_ratemaps * (N_corridors_w_ratemaps - 1) / 2)
-        similarity_matrix = np.zeros((M, self.N_cells))
-        m = 0
-        for i_cor in np.arange(N_corridors_w_ratemaps-1):
-            for j_cor in np.arange(i_cor+1, N_corridors_w_ratemaps):
-                X = np.transpose(map_mat[i_cor,:,:])
-                Y = np.transpose(map_mat[j_cor,:,:])
-                similarity_matrix[m,] = Mcorrcoef(X,Y, zero_var_out=0)
-
-        self.cell_corridor_similarity = np.mean(similarity_matrix, axis=0)
+        similarity_matrix = corridor_similarity(map_mat, zero_var_out=0) # all pairs of corridors at once
+        i_cor, j_cor = np.triu_indices(N_corridors_w_ratemaps, k=1)
+        self.cell_corridor_similarity = np.mean(similarity_matrix[i_cor, j_cor], axis=0)
+        if (return_matrix):
+            return similarity_matrix
 
     def plot_properties(self, cellids=np.array([-1]), interactive=False):
         
@@ -1416,230 +1418,157 @@ class ImagingSessionData:
             rate_matrix = self.ratemaps[i_corrid]
             # only laps with imaging data are selected - this will index the activity_tensor
 
-            candidate_cells = np.zeros(self.N_cells)
-            
             i_laps = np.flatnonzero(self.i_corridors[self.i_Laps_ImData] == corrid)
-            N_laps_corr = len(i_laps)
-            act_tensor_1 = self.activity_tensor[:,:,i_laps] ## bin x cells x laps; all activity in all laps in corridor i
-
-            for i_cell in np.arange(rate_matrix.shape[1]):
-                rate_i = rate_matrix[:,i_cell]
-
-                ### calculate the baseline, peak and threshold for each cell
-                ## Hainmuller: average of the lowest 25%; 
-                baseline = np.mean(np.sort(rate_i)[:12])
-                peak_rate = np.max(rate_i)
-                threshold = baseline + 0.25 * (peak_rate - baseline)
-
-                ## 1) find the longest contiguous region of above threshold for at least 3 bins...
-                placefield_start = np.nan
-                placefield_length = 0
-                candidate_start = 0
-                candidate_length = 0
-                for k in range(self.N_pos_bins):
-                    if (rate_i[k] > threshold):
-                        candidate_length = candidate_length + 1
-                        if (candidate_length == 1):
-                            candidate_start = k
-                        elif ((candidate_length > 2) & (candidate_length > placefield_length)):
-                            placefield_length = candidate_length
-                            placefield_start = candidate_start
-                    else:
-                        candidate_length = 0
-
-                if (not(np.isnan(placefield_start))):
-                    ##  2) with average rate at least 7x the average rate outside
-                    index_infield = np.arange(placefield_start,(placefield_start+placefield_length))
-                    index_outfield = np.setdiff1d(np.arange(self.N_pos_bins), index_infield)
-                    rate_inField = np.mean(rate_i[index_infield])
-                    rate_outField = np.mean(rate_i[index_outfield])
-
-
-                    ## significant (total spike is larger than 0.6) transient in the field in at least 20% of the runs
-                    lapsums = act_tensor_1[index_infield,i_cell,:].sum(0) # only laps in this corridor
-
-                    if ( ( (sum(lapsums > 0.6) / float(N_laps_corr)) > 0.2)  & ( (rate_inField / rate_outField) > 7) ):
-                        candidate_cells[i_cell] = 1
+            ## all cells are processed at once, see utils.placefield_candidates for the criteria
+            candidate_cells = placefield_candidates(rate_matrix[:,:,np.newaxis], self.activity_tensor[:,:,:,np.newaxis], i_laps)[:,0].astype(float)
 
             self.candidate_PCs.append(candidate_cells)
 
     # def __init__(self, datapath, date_time, name, task, stage, raw_spikes, frame_times, frame_pos, frame_laps, N_shuffle=1000, mode='random'):
-    def calc_shuffle(self, cellids, n=1000, mode='shift', batchsize=25, verbous=1, name_string=''):
+    def calc_shuffle(self, cellids, n=1000, mode='shift', batchsize=25, verbous=1, name_string='', n_workers=1, adaptive=False, n_block=50, p_val=0.05, save_null=False, null_dtype='float16'):
         ## cellids: numpy array - the index of the cells to be included in the analysis
         ## n: integer, number of shuffles
         ## mode: 'random' or 'shift'. 
             # random: totally randomize the spike times; 
             # shift: circularly shift spike times 
         ## batchsize: integer. To make computation faster, shuffling is done in batches of size batchsize
+        ## n_workers: integer. The number of processes computing the batches in parallel. The P-values do not depend on it. n_workers > 1 requires python >= 3.8
+        ## adaptive: True or False. If True, shuffles are calculated in blocks of n_block shuffles and stopped for a cell when its P-values are clearly significant or non-significant
+            # at most n shuffles are used, the number of shuffles used for each cell is saved in the last column of the file
+        ## p_val: significance level used for the Holm-Bonferroni correction of the P-values
+        ## save_null: True or False. If True, the statistics of the shuffles are also saved (in null_dtype precision) for each cell
+            # P-values and tuned cells can be recalculated from them later by shuffle_Pvalues_from_null(). Not available in adaptive mode
+            # with reduced precision (e.g. float16) shuffles closer to the data than the resolution are counted as exceeding it,
+            # so the recalculated P-values can only be larger (more conservative) than the P-values of the shuffling, never smaller
         ## verbous: True of False: information is given about the progress
         ## name string: optional string saved in the file to specify the peculiarities of the analysis
 
         cellids = np.array(cellids)
-        raw_spikes = self.raw_spks[cellids,:]
-        calculate_shuffles = True
 
         ##########################################################################
         ## reading shuffling data from file
         ##########################################################################
+        ## the P-values are stored for each cell in a binary file, the parameters of the shuffling are given in its name
+        ## the P-values of a cell do not depend on the other cells shuffled together with it,
+        ## so only the cells missing from the file are shuffled and then added to the file
+
+        adaptive_string = ''
+        if (adaptive):
+            adaptive_string = '_adaptive_b' + str(n_block) + '_p' + str(p_val)
+        shuffle_filename = 'shuffle_stats_' + name_string + 'n' + str(n) + '_mode_' + mode + adaptive_string
+        if (self.N_corridors == 1):
+            expected_names = self.N_corridors * 4 + 1
+        if (self.N_corridors > 1):
+            if (self.task == 'contingency_learning'):
+                expected_names = self.N_corridors * 4 + 3 + 4
+            else:
+                expected_names = self.N_corridors * 4 + 3
+        if (adaptive):
+            expected_names = expected_names + 1 # number of shuffles used for each cell
 
-        data_folder = self.suite2p_folder + self.data_folder
-        shuffle_filename = 'shuffle_stats_' + name_string + 'n' + str(n) + '_mode_' + mode + '.csv'
-        shuffle_path = data_folder + '/' + shuffle_filename
-        if os.path.exists(shuffle_path):
-            calculate_shuffles = False
-            if (self.check_params(shuffle_filename)):
-                if (verbous > 1):
-                    print('loading shuffling P-values from file...')
-                ## load from file
-                shuffle_file=open(shuffle_path, newline='')
-                shuffle_file_reader=csv.reader(shuffle_file, delimiter=' ')
-                ## we skip the first few lines, as they contain the header already checked by check_params(shuffle_filename)
-                file_data = next(shuffle_file_reader)
-                while (file_data[0][0] == '#'):
-                    file_data = next(shuffle_file_reader)
-                # the statistics and corridors
-                Ps_names = file_data
-                if (self.N_corridors == 1):
-                    expected_names = self.N_corridors * 4 + 1
-                if (self.N_corridors > 1):
-                    if (self.task == 'contingency_learning'):
-                        expected_names = self.N_corridors * 4 + 3 + 4
-                    else:
-                        expected_names = self.N_corridors * 4 + 3
-
-                if (len(Ps_names) == expected_names):
-                    file_data = next(shuffle_file_reader)
-                    shuffle_Pvalues = np.array(file_data, dtype='float').reshape(1, expected_names)
-                    for row in shuffle_file_reader:
-                        shuffle_Pvalues = np.vstack((shuffle_Pvalues, np.array(row, dtype='float')))
-                    ## check the cellids
-                    cellids_from_file = shuffle_Pvalues[:,0]
-                    if not np.array_equal(np.sort(cellids_from_file), np.sort(cellids)):
-                        if (verbous > 0):
-                            print ('cellids of the saved file does not match the cellids provided. We will perform shuffling.')
-                        calculate_shuffles = True
-                    else :
-                        if (verbous > 0):
-                            print(data_folder + '/' + shuffle_filename, 'successfully loaded')
-
-                else :# fill in the P-value array
-                    if (verbous > 0):
-                        print ('number of P-values read from the saved file for each cell does not match the number expected for a given number of corridor. We will perform shuffling.')
-                    calculate_shuffles = True
-            
+        if (verbous > 1):
+            print('loading shuffling P-values from file...')
+        stored = self.load_shuffle_Pvalues(shuffle_filename, expected_names, verbous)
+        if (stored is None):
+            stored_Pvalues = np.zeros((0, expected_names))
+        else:
+            stored_Pvalues, Ps_names = stored
+        missing_cellids = np.setdiff1d(cellids, stored_Pvalues[:,0].astype(int))
+
+        ## the null distributions are saved in a separate file, cells without saved null distributions are shuffled again
+        if (save_null & adaptive):
+            print('Warning: null distributions can not be saved in adaptive mode.')
+            save_null = False
+        if (save_null):
+            null_filename = shuffle_filename + '_null'
+            stored_null = self.load_shuffle_file(null_filename)
+            if ((stored_null is not None) and (stored_null['null'].dtype != np.dtype(null_dtype))):
+                stored_null = None
+            if (stored_null is None):
+                missing_cellids = np.array(cellids)
             else:
-                calculate_shuffles = True
+                missing_cellids = np.union1d(missing_cellids, np.setdiff1d(cellids, stored_null['cellids']))
 
         ##########################################################################
-        ## calculating shuffling - if appropriate file not found
+        ## calculating shuffling - for the cells not found in the file
         ##########################################################################
-        if (calculate_shuffles):
+        if (len(missing_cellids) > 0):
             if (verbous > 0):
-                print('calculating shuffles...')
-            shuffle_stats = ImShuffle(self.datapath, self.date_time, self.name, self.task, self.stage, raw_spikes, self.frame_times, self.frame_pos, self.frame_laps, N_shuffle=n, cellids=cellids, mode=mode, batchsize=batchsize, randseed=self.randseed, selected_laps=self.selected_laps, elfiz=self.elfiz, min_Nlaps=self.minimum_Nlaps, multiplane=self.multiplane)
-            # shuffle_stats = ImShuffle(D1.datapath,   D1.date_time,   D1.name,   D1.task,   D1.stage,   raw_spikes, D1.frame_times,   D1.frame_pos,   D1.frame_laps,   N_shuffle=N_shuffle, cellids=cellids, mode='shift', batchsize=25,        randseed=D1.randseed, selected_laps=np.arange(20,80), elfiz=True)
-
-            # NN = cellids.size
-            N_corrids = len(shuffle_stats.ratemaps)
-            sanity_checks_passed = True
-            if ((N_corrids) != self.N_corridors):
-                    print ('warning: number of corridors is different between shuffling and control!')
-                    sanity_checks_passed = False            
-            for i_cor in np.arange(self.N_corridors):
-                if (self.elfiz == True): # we use a different time resolution for shuffling...
-                    if (np.abs(shuffle_stats.cell_reliability[i_cor][0,n] - self.cell_reliability[i_cor][0]) > 0.1):
-                        print ('warning: calculating reliability is different between shuffling and control!')
-                        sanity_checks_passed = False
-                    if (np.corrcoef(self.ratemaps[i_cor][:,0], shuffle_stats.ratemaps[i_cor][:,0,n])[0,1] < 0.75):
-                        print ('warning: ratemaps are different between shuffling and control!')
-                        sanity_checks_passed = False
-                else:
-                    if (sum(np.abs(shuffle_stats.cell_reliability[i_cor][:,n] - self.cell_reliability[i_cor][cellids]) > 0.0001) > 0):
-                        print ('warning: calculating reliability is different between shuffling and control!')
-                        sanity_checks_passed = False
-                    if (np.sum(np.abs(self.ratemaps[i_cor][:,cellids] - shuffle_stats.ratemaps[i_cor][:,:,n]) > 1e-5)):
-                        print ('warning: ratemaps are different between shuffling and control!')
-                        sanity_checks_passed = False
-
-            if (sanity_checks_passed):
-                if (verbous > 0):
-                    print ('Shuffling stats calculated succesfully')
-            else : 
-                if (verbous > 0):
-                    print ('Shuffling failed, ask for help...')
-                return 
+                print('calculating shuffles for', len(missing_cellids), 'cells...')
+            if (adaptive):
+                shuffle_results = self.calc_shuffle_adaptive(missing_cellids, n, mode, batchsize, n_block, p_val, n_workers=n_workers, verbous=verbous)
+            else:
+                shuffle_stats = ImShuffle(self.datapath, self.date_time, self.name, self.task, self.stage, self.raw_spks[missing_cellids,:], self.frame_times, self.frame_pos, self.frame_laps, N_shuffle=n, cellids=missing_cellids, mode=mode, batchsize=batchsize, randseed=self.randseed, selected_laps=self.selected_laps, elfiz=self.elfiz, min_Nlaps=self.minimum_Nlaps, multiplane=self.multiplane, n_workers=n_workers)
+                # shuffle_stats = ImShuffle(D1.datapath,   D1.date_time,   D1.name,   D1.task,   D1.stage,   raw_spikes, D1.frame_times,   D1.frame_pos,   D1.frame_laps,   N_shuffle=N_shuffle, cellids=cellids, mode='shift', batchsize=25,        randseed=D1.randseed, selected_laps=np.arange(20,80), elfiz=True)
+                shuffle_results = None
+                if (self.check_shuffle(shuffle_stats, missing_cellids, verbous)):
+                    shuffle_results = self.shuffle_Pvalue_matrix(shuffle_stats, missing_cellids)
+            if (shuffle_results is None):
+                return
+            new_Pvalues, Ps_names = shuffle_results
 
             if (verbous > 1):
                 print('saving shuffling data into file...')
-
-            # shuffle_Pvalues:
-            # cellids + N x Skaggs + N x specificits + N x reliability + (selectivity + similarity + (4 x pattern_selectivity)) + N x Hainmuller
-
-            if (shuffle_stats.N_corridors > 1):# & (task == 'contingency_learning')):
-                shuffle_Pvalues = cellids
-                Ps_names = ['cellids']#, 
-                for i in np.arange(shuffle_stats.N_corridors):
-                    shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_skaggs[i]))
-                    Ps_names = Ps_names + ['Skaggs_' + str(i)]
-                for i in np.arange(shuffle_stats.N_corridors):
-                    shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_tuning_specificity[i]))
-                    Ps_names = Ps_names + ['spec_' + str(i)]
-                for i in np.arange(shuffle_stats.N_corridors):
-                    shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_reliability[i]))
-                    Ps_names = Ps_names + ['reli_' + str(i)]
-
-                shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_corridor_selectivity))
-                Ps_names = Ps_names + ['selectivity']
-
-                shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_corridor_similarity))
-                Ps_names = Ps_names + ['similarity']
-
-                if (self.task == 'contingency_learning'):
-                    for kk in np.arange(4):
-                        shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_pattern_selectivity[kk,:]))
-                        Ps_names = Ps_names + ['pattern_selectivity_' + str(kk)]                
-
-                for i in np.arange(shuffle_stats.N_corridors):
-                    shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.accepted_PCs[i]))
-                    Ps_names = Ps_names + ['Hainmuller_PlaceCell_' + str(i)]
-            else :
-                shuffle_Pvalues = np.vstack((cellids, shuffle_stats.P_skaggs[0], shuffle_stats.P_tuning_specificity[0], shuffle_stats.P_reliability[0], shuffle_stats.accepted_PCs[0]))
-                Ps_names = ['cellids', 'Skaggs_0', 'spec_0', 'reli_0', 'Hainmuller_PlaceCell_0']# 
-
-            shuffle_Pvalues = np.transpose(shuffle_Pvalues)
-
-            self.write_params(shuffle_filename)
-            with open(shuffle_path, mode='a', newline='') as shuffle_file:
-                file_writer = csv.writer(shuffle_file, **csv_kwargs)
-                file_writer.writerow(Ps_names)
-                for i_row in np.arange(shuffle_Pvalues.shape[0]):
-                    file_writer.writerow(np.round(shuffle_Pvalues[i_row,:], 6))
-            print('P values for n=', len(cellids), ' saved into file: ', shuffle_path)
-
-        ##########################################################################
-        ## processing the shuffling stats ...
-        ##########################################################################
+            stored_Pvalues = np.vstack((stored_Pvalues[~np.isin(stored_Pvalues[:,0], missing_cellids),:], new_Pvalues))
+            stored_Pvalues = stored_Pvalues[np.argsort(stored_Pvalues[:,0], kind='stable'),:]
+            self.save_shuffle_file(shuffle_filename, Pvalues=stored_Pvalues, Ps_names=np.array(Ps_names))
+            print('P values for n=', len(missing_cellids), ' saved into file: ', shuffle_filename + '.npz')
+
+            if (save_null):
+                new_null = self.shuffle_null_matrix(shuffle_stats, missing_cellids, null_dtype)
+                if (stored_null is not None):
+                    kept_cells = ~np.isin(stored_null['cellids'], missing_cellids)
+                    for key in ['cellids', 'data', 'null', 'candidate', 'candidate_null']:
+                        new_null[key] = np.concatenate((stored_null[key][kept_cells], new_null[key]))
+                i_sorted = np.argsort(new_null['cellids'], kind='stable')
+                for key in ['cellids', 'data', 'null', 'candidate', 'candidate_null']:
+                    new_null[key] = new_null[key][i_sorted]
+                self.save_shuffle_file(null_filename, compressed=True, **new_null)
+                print('null distributions for n=', len(missing_cellids), ' saved into file: ', null_filename + '.npz')
+        elif (verbous > 0):
+            print(shuffle_filename, 'successfully loaded')
+
+        ## the P-values of the cells in the order of cellids
+        shuffle_Pvalues = stored_Pvalues[np.searchsorted(stored_Pvalues[:,0], cellids),:]
+
+        self.shuffle_cellids = cellids
+        self.shuffle_Pvalues = shuffle_Pvalues
+        self.Ps_names = Ps_names
+        self.threshold_shuffle(p_val=p_val, method='holm', verbous=verbous)
+
+    def threshold_shuffle(self, p_val=0.05, method='holm', verbous=1):
+        ## selects the tuned, selective and similar cells from the P-values of the shuffling (self.shuffle_Pvalues) - no shuffling is needed
+        ## p_val: significance level
+        ## method: 'holm' - Holm-Bonferroni correction for the tests of each cell (as in calc_shuffle)
+            # 'bh' - Benjamini-Hochberg false discovery rate control over all tests of all cells
+        if (method == 'holm'):
+            correct_Pvalues = HolmBonfMat
+        elif (method == 'bh'):
+            correct_Pvalues = BenjHochMat
+        else:
+            print('Error: method must be either holm or bh.')
+            return
 
         # shuffle_Pvalues:
         # if N is the number of corridors
         # cellids + N x Skaggs + N x specificits + N x reliability + (selectivity + similarity + (4 x pattern_selectivity)) + N x Hainmuller
 
-        self.shuffle_Pvalues = shuffle_Pvalues
-        self.Ps_names = Ps_names
+        cellids = self.shuffle_cellids
+        shuffle_Pvalues = self.shuffle_Pvalues
 
         # Pmatrix:
         # N x Skaggs + N x specificits + N x reliability + (selectivity + similarity + (4 x pattern_selectivity))
 
         if (self.N_corridors == 1): # we don't have selectivity and similarity
             Pmatrix = np.transpose(self.shuffle_Pvalues[:,1:(self.N_corridors*3+1)])
-            self.ii_tuned_cells = np.transpose(HolmBonfMat(Pmatrix, 0.05))
+            self.ii_tuned_cells = np.transpose(correct_Pvalues(Pmatrix, p_val))
         if (self.N_corridors > 1):
             if (self.task == 'contingency_learning'):# we have 4 + 1 selectivity and similarity
                 max_col_index = self.N_corridors*3+3+4 
             else :# we have selectivity and similarity
                 max_col_index = self.N_corridors*3+3                
             Pmatrix = np.transpose(self.shuffle_Pvalues[:,1:max_col_index])
-            self.ii_tuned_cells = np.transpose(HolmBonfMat(Pmatrix, 0.05))
+            self.ii_tuned_cells = np.transpose(correct_Pvalues(Pmatrix, p_val))
 
         self.accepted_PCs = []
         self.tuned_cells = []
@@ -1679,6 +1608,193 @@ class ImagingSessionData:
                 if (verbous > 1):
                     print('pattern selective cells:', self.pattern_selective_cells)
 
+    def shuffle_Pvalues_from_null(self, cellids, n=1000, mode='shift', name_string='', p_val=0.05, method='holm', verbous=1):
+        ## recalculates the P-values and the tuned cells from the null distributions saved by calc_shuffle(save_null=True)
+        ## the parameters n, mode and name_string identify the file as in calc_shuffle, p_val and method are used as in threshold_shuffle
+        ## the P-values are calculated at the precision of the saved null distributions
+        ## at reduced precision ties between the data and the shuffles are counted as exceedances, so the P-values are conservative
+        ## the null distributions of the cells are kept in self.shuffle_null
+        null_filename = 'shuffle_stats_' + name_string + 'n' + str(n) + '_mode_' + mode + '_null'
+        stored = self.load_shuffle_file(null_filename)
+        if (stored is None):
+            print('Error: no null distributions found in', null_filename + '.npz', '- use calc_shuffle with save_null=True')
+            return
+        cellids = np.array(cellids)
+        missing_cellids = np.setdiff1d(cellids, stored['cellids'])
+        if (len(missing_cellids) > 0):
+            print('Error: null distributions are not saved for cells', missing_cellids)
+            return
+
+        i_cells = np.searchsorted(stored['cellids'], cellids)
+        null = stored['null'][i_cells] # cells x tests x shuffles
+        data = stored['data'][i_cells].astype(null.dtype) # compared at the same precision
+        N_shuffle = null.shape[2]
+        if (null.dtype.itemsize < stored['data'].dtype.itemsize):
+            Pvalues = np.sum(null >= data[:,:,np.newaxis], axis=2) / float(N_shuffle)
+        else:
+            Pvalues = np.sum(null > data[:,:,np.newaxis], axis=2) / float(N_shuffle)
+        place_cell_P = np.sum(stored['candidate_null'][i_cells], axis=2) / float(N_shuffle)
+        accepted_PCs = stored['candidate'][i_cells] & (place_cell_P < 0.05)
+
+        names = [str(name) for name in stored['names']]
+        self.shuffle_null = {'cellids':cellids, 'names':names, 'data':stored['data'][i_cells], 'null':null, 'candidate':stored['candidate'][i_cells], 'candidate_null':stored['candidate_null'][i_cells]}
+        self.shuffle_cellids = cellids
+        self.shuffle_Pvalues = np.hstack((cellids.reshape(-1,1), Pvalues, accepted_PCs))
+        self.Ps_names = ['cellids'] + names + ['Hainmuller_PlaceCell_' + str(i) for i in np.arange(self.N_corridors)]
+        self.threshold_shuffle(p_val=p_val, method=method, verbous=verbous)
+
+    def check_shuffle(self, shuffle_stats, cellids, verbous=1):
+        ## compares the real data in the shuffling (the last shuffle) to the properties of the cells calculated in the session
+        n_shuffle = shuffle_stats.N_shuffle
+        # NN = cellids.size
+        N_corrids = len(shuffle_stats.ratemaps)
+        sanity_checks_passed = True
+        if ((N_corrids) != self.N_corridors):
+                print ('warning: number of corridors is different between shuffling and control!')
+                sanity_checks_passed = False            
+        for i_cor in np.arange(self.N_corridors):
+            if (self.elfiz == True): # we use a different time resolution for shuffling...
+                if (np.abs(shuffle_stats.cell_reliability[i_cor][0,n_shuffle] - self.cell_reliability[i_cor][0]) > 0.1):
+                    print ('warning: calculating reliability is different between shuffling and control!')
+                    sanity_checks_passed = False
+                if (np.corrcoef(self.ratemaps[i_cor][:,0], shuffle_stats.ratemaps[i_cor][:,0,n_shuffle])[0,1] < 0.75):
+                    print ('warning: ratemaps are different between shuffling and control!')
+                    sanity_checks_passed = False
+            else:
+                if (sum(np.abs(shuffle_stats.cell_reliability[i_cor][:,n_shuffle] - self.cell_reliability[i_cor][cellids]) > 0.0001) > 0):
+                    print ('warning: calculating reliability is different between shuffling and control!')
+                    sanity_checks_passed = False
+                if (np.sum(np.abs(self.ratemaps[i_cor][:,cellids] - shuffle_stats.ratemaps[i_cor][:,:,n_shuffle]) > 1e-5)):
+                    print ('warning: ratemaps are different between shuffling and control!')
+                    sanity_checks_passed = False
+
+        if (sanity_checks_passed):
+            if (verbous > 0):
+                print ('Shuffling stats calculated succesfully')
+        else : 
+            if (verbous > 0):
+                print ('Shuffling failed, ask for help...')
+        return sanity_checks_passed
+
+    def shuffle_Pvalue_matrix(self, shuffle_stats, cellids):
+        ## collects the P-values of the cells from the shuffling
+        ## returns the cells x tests matrix of the P-values and the names of its columns
+        # shuffle_Pvalues:
+        # cellids + N x Skaggs + N x specificits + N x reliability + (selectivity + similarity + (4 x pattern_selectivity)) + N x Hainmuller
+
+        if (shuffle_stats.N_corridors > 1):# & (task == 'contingency_learning')):
+            shuffle_Pvalues = cellids
+            Ps_names = ['cellids']#, 
+            for i in np.arange(shuffle_stats.N_corridors):
+                shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_skaggs[i]))
+                Ps_names = Ps_names + ['Skaggs_' + str(i)]
+            for i in np.arange(shuffle_stats.N_corridors):
+                shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_tuning_specificity[i]))
+                Ps_names = Ps_names + ['spec_' + str(i)]
+            for i in np.arange(shuffle_stats.N_corridors):
+                shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_reliability[i]))
+                Ps_names = Ps_names + ['reli_' + str(i)]
+
+            shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_corridor_selectivity))
+            Ps_names = Ps_names + ['selectivity']
+
+            shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_corridor_similarity))
+            Ps_names = Ps_names + ['similarity']
+
+            if (self.task == 'contingency_learning'):
+                for kk in np.arange(4):
+                    shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.P_pattern_selectivity[kk,:]))
+                    Ps_names = Ps_names + ['pattern_selectivity_' + str(kk)]                
+
+            for i in np.arange(shuffle_stats.N_corridors):
+                shuffle_Pvalues = np.vstack((shuffle_Pvalues, shuffle_stats.accepted_PCs[i]))
+                Ps_names = Ps_names + ['Hainmuller_PlaceCell_' + str(i)]
+        else :
+            shuffle_Pvalues = np.vstack((cellids, shuffle_stats.P_skaggs[0], shuffle_stats.P_tuning_specificity[0], shuffle_stats.P_reliability[0], shuffle_stats.accepted_PCs[0]))
+            Ps_names = ['cellids', 'Skaggs_0', 'spec_0', 'reli_0', 'Hainmuller_PlaceCell_0']# 
+
+        shuffle_Pvalues = np.transpose(shuffle_Pvalues)
+        return shuffle_Pvalues, Ps_names
+
+    def shuffle_null_matrix(self, shuffle_stats, cellids, dtype='float16'):
+        ## collects the statistics of the cells in the data and in the shuffles, in the order of the P-values of shuffle_Pvalue_matrix
+        ## returns a dictionary with the cellids, the names of the statistics, the data (cells x statistics), 
+        ## the null distributions (cells x statistics x shuffles) stored as dtype and the candidate place cells in the data and in the shuffles
+        N_shuffle = shuffle_stats.N_shuffle
+        stats, names = self.shuffle_stats_tensor(shuffle_stats)
+        candidate = np.stack(shuffle_stats.candidate_PCs, axis=1) == 1 # cells x corridors x (N_shuffle+1)
+        return {'cellids':np.array(cellids), 'names':np.array(names), 'data':stats[:,:,N_shuffle], 'null':stats[:,:,0:N_shuffle].astype(dtype), 'candidate':candidate[:,:,N_shuffle], 'candidate_null':candidate[:,:,0:N_shuffle]}
+
+    def shuffle_stats_tensor(self, shuffle_stats):
+        ## the statistics of the cells tested by HolmBonfMat, in the order of the P-values of shuffle_Pvalue_matrix
+        ## returns the cells x statistics x (N_shuffle+1) tensor, the last shuffle is the real data, and the names of the statistics
+        corridors = np.arange(shuffle_stats.N_corridors)
+        stats = [shuffle_stats.cell_skaggs[i] for i in corridors] + [shuffle_stats.cell_tuning_specificity[i] for i in corridors] + [shuffle_stats.cell_reliability[i] for i in corridors]
+        names = ['Skaggs_' + str(i) for i in corridors] + ['spec_' + str(i) for i in corridors] + ['reli_' + str(i) for i in corridors]
+        if (shuffle_stats.N_corridors > 1):
+            stats = stats + [shuffle_stats.cell_corridor_selectivity, shuffle_stats.cell_corridor_similarity]
+            names = names + ['selectivity', 'similarity']
+            if (self.task == 'contingency_learning'):
+                stats = stats + [shuffle_stats.cell_pattern_selectivity[kk] for kk in np.arange(4)]
+                names = names + ['pattern_selectivity_' + str(kk) for kk in np.arange(4)]
+        stats = np.stack(stats, axis=1) # cells x statistics x (N_shuffle+1)
+        return stats, names
+
+    def calc_shuffle_adaptive(self, cellids, n, mode, batchsize, n_block, p_val, n_workers=1, verbous=1):
+        ## sequential Monte Carlo P-values (Besag & Clifford 1991)
+        ## shuffles are calculated in blocks of n_block, each block with a different random seed
+        ## after each block we stop the cells whose P-values can not change the result of HolmBonfMat:
+            # for all tests the confidence interval of the P-value is below p_val / number of tests or above p_val
+            # and the place cell P-value of Hainmuller and Bartos is clearly below or above 0.05
+        ## at most n shuffles are calculated for a cell
+        ## returns the same P-value matrix as shuffle_Pvalue_matrix with an extra column with the number of shuffles used for each cell
+        ## None is returned if the shuffling failed
+        N_cells = len(cellids)
+        N_shuffles = np.zeros(N_cells, dtype=int) # number of shuffles used for each cell
+        running = np.ones(N_cells, dtype=bool)
+        N_done = 0
+        i_block = 0
+        while (np.any(running) & (N_done < n)):
+            N_block = min(n_block, n - N_done)
+            block_cellids = cellids[running]
+            if (verbous > 0):
+                print('calculating shuffles', N_done, '-', N_done + N_block, 'for', len(block_cellids), 'cells')
+            if (i_block == 0):
+                shuffle_stats = ImShuffle(self.datapath, self.date_time, self.name, self.task, self.stage, self.raw_spks[block_cellids,:], self.frame_times, self.frame_pos, self.frame_laps, N_shuffle=N_block, cellids=block_cellids, mode=mode, batchsize=batchsize, randseed=self.randseed, selected_laps=self.selected_laps, elfiz=self.elfiz, min_Nlaps=self.minimum_Nlaps, multiplane=self.multiplane, n_workers=n_workers)
+                if (not self.check_shuffle(shuffle_stats, cellids, verbous)):
+                    return None
+            else:
+                ## the behavioral data is loaded once, only the shuffles of the running cells are repeated
+                shuffle_stats.shuffle_block(block_cellids, N_block, self.randseed + 4 * i_block, n_workers=n_workers)
+            block_stats = self.shuffle_stats_tensor(shuffle_stats)[0]
+            block_candidate = np.stack(shuffle_stats.candidate_PCs, axis=1) == 1 # cells x corridors x (N_block+1)
+
+            if (i_block == 0):
+                Ps_names = self.shuffle_Pvalue_matrix(shuffle_stats, block_cellids)[1]
+                N_tests = block_stats.shape[1] # the columns tested by HolmBonfMat
+                counts = np.zeros((N_cells, N_tests), dtype=int) # number of shuffles exceeding the data
+                PC_counts = np.zeros((N_cells, self.N_corridors), dtype=int) # number of shuffles being a candidate place cell
+                candidate = block_candidate[:,:,N_block] # candidate place cells in the real data
+
+            ## the exceedances are counted directly, not recovered from the P-values
+            counts[running,:] = counts[running,:] + shuffle_exceedance_counts(block_stats, N_block)
+            PC_counts[running,:] = PC_counts[running,:] + np.sum(block_candidate[:,:,0:N_block], axis=2)
+            N_done = N_done + N_block
+            N_shuffles[running] = N_done
+            i_block = i_block + 1
+
+            decided = sequential_P_decided(counts[running,:], N_done, p_val / N_tests, p_val)
+            decided_PC = sequential_P_decided(PC_counts[running,:], N_done, 0.05, 0.05) | (~candidate[running,:])
+            stopped = np.all(decided, axis=1) & np.all(decided_PC, axis=1)
+            running[np.flatnonzero(running)[stopped]] = False
+
+        Pvalues = counts / N_shuffles.reshape(-1,1)
+        accepted_PCs = candidate & ((PC_counts / N_shuffles.reshape(-1,1)) < 0.05)
+        shuffle_Pvalues = np.hstack((cellids.reshape(-1,1), Pvalues, accepted_PCs, N_shuffles.reshape(-1,1)))
+        Ps_names = Ps_names + ['N_shuffles']
+        if (verbous > 0):
+            print('number of shuffles used: mean', np.round(np.mean(N_shuffles), 1), 'max', np.max(N_shuffles))
+        return shuffle_Pvalues, Ps_names
 
     def get_lap_indexes(self, corridor=-1, i_lap=-1):
         ## print the indexes of i_lap (or each lap) in a given corridor
@@ -2860,11 +2976,7 @@ class ImagingSessionData:
             except AttributeError:
                 cellids = np.arange(0, self.N_cells)
                 print('tuned_cells attribute does not exist - all cells used for pop vector corr! You probably want to run shuffling first!')
-            a=self.ratemaps[0][:,cellids]
-            b=self.ratemaps[1][:,cellids]
-            
-            popp_full = np.corrcoef(a,b)
-            self.ratemap_corr = popp_full[:self.N_pos_bins, self.N_pos_bins:]
+            self.ratemap_corr = self.calc_crosscorr(self.ratemaps[0], self.ratemaps[1], cellids)
             
             # diag = np.diagonal(popp)
             #for plotting
@@ -3006,13 +3118,33 @@ class ImagingSessionData:
             
             print('previous-based ratemaps calculated - !Previous overwritten!')
 
-    def show_crosscorr(self, ratemap1, ratemap2, cellids=None, ratemap1_annot='map 1', ratemap2_annot='map 2', main_title='Cross correlation', return_matrix=False, plot_ccm=True):
-        #plot cross-correlation matrix between two ratemaps, only for specified cellids
+    def calc_crosscorr(self, ratemap1, ratemap2, cellids=None):
+        ## population vector correlation between the spatial bins of ratemap1 (rows) and ratemap2 (columns), only for specified cellids
+        ## ratemap1, ratemap2: arrays space x neurons
+        ## if both ratemaps are ratemaps of the session (elements of self.ratemaps), the results are stored in self.PV_corr_cache
+        ## keyed by the index of the corridors and the cellids and reused in later calls; other ratemaps are not cached
+        ## the cached matrices are read-only, they should be copied before modifying them (e.g. for plotting)
         if (cellids is None):
             cellids = np.arange(self.N_cells)
+        cellids = np.asarray(cellids)
+        i_map1 = [i for i, ratemap in enumerate(self.ratemaps) if ratemap is ratemap1]
+        i_map2 = [i for i, ratemap in enumerate(self.ratemaps) if ratemap is ratemap2]
+        if ((len(i_map1) == 0) | (len(i_map2) == 0)):
+            return cross_corrcoef(ratemap1[:,cellids], ratemap2[:,cellids])
+
+        key = (i_map1[0], i_map2[0], cellids.dtype.str, cellids.tobytes())
+        if (key not in self.PV_corr_cache):
+            self.PV_corr_cache[key] = cross_corrcoef(ratemap1[:,cellids], ratemap2[:,cellids])
+            self.PV_corr_cache[key].setflags(write=False) # the cached matrix is shared by the callers
+        return self.PV_corr_cache[key]
+
+    def calc_autocorr(self, ratemap, cellids=None):
+        ## population vector correlation between the spatial bins of a ratemap, only for specified cellids
+        return self.calc_crosscorr(ratemap, ratemap, cellids)
 
-        popp_full = np.corrcoef(ratemap1[:,cellids], ratemap2[:,cellids])
-        popp = popp_full[:self.N_pos_bins, self.N_pos_bins:]
+    def show_crosscorr(self, ratemap1, ratemap2, cellids=None, ratemap1_annot='map 1', ratemap2_annot='map 2', main_title='Cross correlation', return_matrix=False, plot_ccm=True):
+        #plot cross-correlation matrix between two ratemaps, only for specified cellids
+        popp = self.calc_crosscorr(ratemap1, ratemap2, cellids)
         
         if (plot_ccm == True):
             fig, ax = plt.subplots()
@@ -3026,16 +3158,14 @@ class ImagingSessionData:
             plt.show()
 
         if (return_matrix == True):
-            return popp_full
+            ## the full correlation matrix of the bins of both ratemaps, as np.corrcoef(ratemap1, ratemap2)
+            return np.block([[self.calc_autocorr(ratemap1, cellids), popp], [np.transpose(popp), self.calc_autocorr(ratemap2, cellids)]])
         else :
             return
         
     def show_autocorr(self, ratemap, cellids=None, title='autocorrelation'):
         #show autucorrelation matrix for a given ratemap, cellids
-        if (cellids is None):
-            cellids = np.arange(self.N_cells)
-
-        popp = np.corrcoef(ratemap[:,cellids])
+        popp = self.calc_autocorr(ratemap, cellids)
         
         fig, ax = plt.subplots()
         im = plt.imshow(popp, cmap = 'seismic', vmin = -1, vmax = 1, origin='lower')
@@ -3045,6 +3175,16 @@ class ImagingSessionData:
         plt.title(title)
         plt.show()
         
+    def calc_lap_PV_correlations(self, cellids, ratemaps):
+        ## correlation between the population vectors of each lap and the templates, computed separately in each spatial bin
+        ## ratemaps: list of templates, each is an array space x neurons
+        ## returns an array templates x laps x space, nan where the animal spent too little time in the bin
+        total_spikes = np.transpose(self.activity_tensor[:,cellids,:], (2,0,1)) # laps x space x neurons
+        total_time = np.transpose(self.activity_tensor_time)[:,:,np.newaxis] # laps x space x 1
+        lap_rates = nan_divide(total_spikes, total_time, where=total_time > 0.025)
+        templates = np.array([ratemap[:,cellids] for ratemap in ratemaps]) # templates x space x neurons
+        return popvec_corrcoef(lap_rates, templates)
+
     def lap_decode(self, cellids, ratemaps=None, labels=None, title=''):
         ## D1.lap_decode(cellids, D1.ratemaps, D1.corridors, '')
         add_true_corridor_ids = False
@@ -3053,26 +3193,10 @@ class ImagingSessionData:
             labels = self.corridors
             add_true_corridor_ids = True
 
-        results = np.zeros((len(ratemaps), self.i_Laps_ImData.size))
-        ratemap = np.zeros((self.N_pos_bins, self.N_cells))
-        
-        speed = []
-                        
-        for i in range(self.i_Laps_ImData.size):
-            speed.append(np.nanmean(self.ImLaps[self.i_Laps_ImData[i]].ave_speed))
-            
-            for j in range(self.N_cells):
-                total_spikes = self.activity_tensor[:,j,i]
-                total_time = self.activity_tensor_time[:,i]
-                rate_matrix = nan_divide(total_spikes, total_time, where=total_time > 0.025)
-#                av_rate = np.nanmean(rate_matrix, axis=1)
-                ratemap[:,j] = rate_matrix
+        speed = [np.nanmean(self.ImLaps[i_lap].ave_speed) for i_lap in self.i_Laps_ImData]
+        ## average of the bin-wise population vector correlations, all laps and templates at once
+        results = np.mean(self.calc_lap_PV_correlations(cellids, ratemaps), axis=2) # templates x laps
 
-            for k in range(len(ratemaps)):
-                results[k, i] = np.mean(np.diagonal(np.corrcoef(ratemap[:,cellids], ratemaps[k][:,cellids])[0:self.N_pos_bins,self.N_pos_bins:]))
-                # print(ratemap.shape, ratemaps[k].shape)
-                # print(results[k ,i])
-                
         fig, ax = plt.subplots()
         x=np.arange(0, self.i_Laps_ImData.size)
         for  k in range(len(ratemaps)):
@@ -3104,36 +3228,102 @@ class ImagingSessionData:
 
         return results
         
+    def bayes_decode(self, cellids=None, leave_one_out=True, min_rate=1e-3):
+        ## Bayesian decoder of the position and the corridor in each spatial bin of each lap
+        ## cells are independent Poisson neurons with the rates given by the ratemaps of the corridors; flat prior
+        ## the time spent in the bin is taken from the activity_tensor_time, bins with too little time are not decoded
+        ## leave_one_out: if True, the decoded lap is excluded from the ratemap of its own corridor
+        ## min_rate: rates below min_rate are set to min_rate to avoid log(0)
+        ## returns a dictionary with
+        ##   posterior: laps x space x corridors x space, P(corridor, position | activity in a bin of the lap)
+        ##   corridor: laps x space, index of the decoded corridor in self.corridors, -1 where not decoded
+        ##   position: laps x space, the decoded position bin, -1 where not decoded
+        ##   P_corridor: laps x corridors, P(corridor | activity in all bins of the lap)
+        if (cellids is None):
+            cellids = np.arange(self.N_cells)
+        N_laps = self.i_Laps_ImData.size
+        N_corridors = len(self.ratemaps)
+        L = self.N_pos_bins
+        lap_corridors = self.i_corridors[self.i_Laps_ImData]
+
+        spikes = np.transpose(self.activity_tensor[:,cellids,:], (2,0,1)) # laps x space x neurons
+        times = np.transpose(self.activity_tensor_time) # laps x space
+        valid = times > 0.025
+
+        ## log likelihood of the activity in each bin of each lap, for all corridors and positions (up to a constant):
+        ## sum_cells n * log(rate) - t * sum_cells rate
+        rates = np.fmax(np.array([ratemap[:,cellids] for ratemap in self.ratemaps]), min_rate) # corridors x space x neurons
+        log_rates = np.log(rates).reshape(N_corridors * L, len(cellids))
+        LL = np.dot(spikes.reshape(N_laps * L, len(cellids)), np.transpose(log_rates)).reshape(N_laps, L, N_corridors, L)
+        LL = LL - times[:,:,np.newaxis,np.newaxis] * np.sum(rates, axis=2)
+
+        if (leave_one_out):
+            for i_corridor in np.arange(N_corridors):
+                i_laps = np.flatnonzero(lap_corridors == self.corridors[i_corridor])
+                total_spikes = np.sum(spikes[i_laps,:,:], axis=0) # space x neurons
+                total_time = np.sum(times[i_laps,:], axis=0) # space
+                for i_lap in i_laps:
+                    loo_time = (total_time - times[i_lap,:]).reshape(-1,1)
+                    loo_rates = np.fmax(nan_divide(total_spikes - spikes[i_lap,:,:], loo_time, where=loo_time > 0), min_rate)
+                    LL[i_lap,:,i_corridor,:] = np.dot(spikes[i_lap,:,:], np.transpose(np.log(loo_rates))) - times[i_lap,:].reshape(-1,1) * np.sum(loo_rates, axis=1)
+
+        ## normalizing the likelihood in each bin over corridors and positions
+        LL_max = np.max(LL.reshape(N_laps, L, N_corridors * L), axis=2) # laps x space
+        likelihood = np.exp(LL - LL_max[:,:,np.newaxis,np.newaxis])
+        bin_evidence = np.sum(likelihood, axis=(2,3)) # >= 1
+        posterior = likelihood / bin_evidence[:,:,np.newaxis,np.newaxis]
+        posterior[~valid] = np.nan
+
+        i_decoded = np.argmax(likelihood.reshape(N_laps, L, N_corridors * L), axis=2)
+        decoded_corridor = np.where(valid, i_decoded // L, -1)
+        decoded_position = np.where(valid, i_decoded % L, -1)
+
+        ## corridor evidence of the whole lap: the position is marginalised in each bin and the bins are combined
+        ## computed in log space from LL: log sum_exp over positions minus log sum_exp over corridors and positions
+        LL_corridor_max = np.max(LL, axis=3) # laps x space x corridors
+        log_marginal = LL_corridor_max + np.log(np.sum(np.exp(LL - LL_corridor_max[:,:,:,np.newaxis]), axis=3))
+        log_bin_evidence = LL_max + np.log(bin_evidence)
+        log_P_corridor_bins = log_marginal - log_bin_evidence[:,:,np.newaxis]
+        log_P_corridor = np.sum(np.where(valid[:,:,np.newaxis], log_P_corridor_bins, 0), axis=1) # laps x corridors
+        P_corridor = np.exp(log_P_corridor - np.max(log_P_corridor, axis=1, keepdims=True))
+        P_corridor = P_corridor / np.sum(P_corridor, axis=1, keepdims=True)
+
+        return {'posterior':posterior, 'corridor':decoded_corridor, 'position':decoded_position, 'P_corridor':P_corridor}
+
+    def calc_lap_ratemaps(self, normalize_rates=False):
+        ## ratemaps of all cells in all laps with imaging data: laps x space x neurons
+        ## as in Low et al., 2021, we clip the max rate of each cell to its 99th percentile
+        ## normalize_rates: if True, the rates of each cell are scaled to the range [0, 1]
+        ## the ratemaps are stored in self.lap_ratemaps and reused until the activity tensor is recalculated
+        ## the stored ratemaps are read-only, they should be copied before modifying them
+        if (normalize_rates in self.lap_ratemaps):
+            return self.lap_ratemaps[normalize_rates]
+
+        if (False in self.lap_ratemaps):
+            ratemaps = self.lap_ratemaps[False]
+        else:
+            total_spikes = np.transpose(self.activity_tensor, (2,0,1)) # laps x space x neurons
+            total_time = np.transpose(self.activity_tensor_time)[:,:,np.newaxis] # laps x space x 1
+            ratemaps = nan_divide(total_spikes, total_time, where=total_time > 0.025)
+            clip_rates = np.nanquantile(ratemaps, 0.99, axis=(0,1)) # I suggest to use 99% instead of 90% as we do Ca imaging and not neurpixels, and these are place cells not grid cells
+            ratemaps = np.where(ratemaps > clip_rates, clip_rates, ratemaps)
+            ratemaps.setflags(write=False) # the cached ratemaps are shared by the callers
+            self.lap_ratemaps[False] = ratemaps
+
+        if (normalize_rates):
+            min_rates = np.nanmin(ratemaps, axis=(0,1))
+            max_rates = np.nanmax(ratemaps, axis=(0,1))
+            ratemaps = (ratemaps - min_rates) / (max_rates - min_rates)
+            ratemaps.setflags(write=False)
+            self.lap_ratemaps[True] = ratemaps
+        return ratemaps
+
     def lap_correlate(self, cellids, filename=None, corridors=None, normalize_rates=False, add_switch_ordered=False):
-        lap2lap_corr = np.zeros((self.i_Laps_ImData.size, self.i_Laps_ImData.size))
-        ratemaps = np.zeros((self.i_Laps_ImData.size, self.N_pos_bins, self.N_cells))
-        
-        for j in range(self.N_cells):
-            for i in range(self.i_Laps_ImData.size):
-                total_spikes = self.activity_tensor[:,j,i]
-                total_time = self.activity_tensor_time[:,i]
-                rate_vector = nan_divide(total_spikes, total_time, where=total_time > 0.025)
-                ratemaps[i,:,j] = rate_vector
-            ## as in Low et al., 2021, we clip the max rate to the 99th percentile
-            clap_rate_j = np.nanquantile(ratemaps[:,:,j], 0.99) # I suggest to use 99% instead of 90% as we do Ca imaging and not neurpixels, and these are place cells not grid cells
-            ratemaps[:,:,j][np.where(ratemaps[:,:,j] > clap_rate_j)] = clap_rate_j
-            if (normalize_rates):
-                ratemaps[:,:,j] = (ratemaps[:,:,j] - np.nanmin(ratemaps[:,:,j])) / (np.nanmax(ratemaps[:,:,j]) - np.nanmin(ratemaps[:,:,j]))
-    
+        ## lap-to-lap correlation of the population ratemaps of the cells given in cellids
+        ratemaps = self.calc_lap_ratemaps(normalize_rates) # laps x space x neurons
+        N_laps = ratemaps.shape[0]
+        lap2lap_corr = corrcoef_matrix(ratemaps[:,:,cellids].reshape(N_laps, -1)) # all pairs of laps at once
 
-        for i in np.arange(self.i_Laps_ImData.size):
-            for j in np.arange(i):
-                ri = ratemaps[i,:,cellids].reshape(len(cellids)* self.N_pos_bins)
-                rj = ratemaps[j,:,cellids].reshape(len(cellids)* self.N_pos_bins)
-                rr12 = np.corrcoef(ri, rj)[0,1]
-                lap2lap_corr[i,j] = rr12
-                lap2lap_corr[j,i] = rr12
-
-                # lap2lap_corr[i,j] = np.nanmean(Mcorrcoef(np.transpose(ratemaps[i,:,cellids]), np.transpose(ratemaps[j,:,cellids])))
-                # lap2lap_corr[i,j] = np.nanmean(np.diagonal(np.corrcoef(np.transpose(ratemaps[i,:,cellids]), np.transpose(ratemaps[j,:,cellids]))[0:self.N_pos_bins,self.N_pos_bins:]))
-                # if np.isnan(lap2lap_corr[i,j]) == True:
-                #     print(i,j)
-    
         fig, axs = plt.subplots(1,2)
         im0 = axs[0].imshow(lap2lap_corr, cmap = 'seismic', vmin = -1, vmax = 1, origin='lower')
         plt.colorbar(im0, orientation='horizontal',ax=axs[0])
@@ -3266,7 +3456,7 @@ class Lap_ImData:
         self.frames_spikes = lap_frames_spikes
         self.frames_pos = lap_frames_pos
         self.frames_time = lap_frames_time
-        self.frames_events = lap_frames_events
+        self.frames_events = lap_frames_events # sparse matrix, n_cells x n_frames
 
         self.n_cells = 1 # we still create the same np arrays even if there are no cells
         self.bincenters = np.arange(0, self.corridor_length_roxel, 70) + 70 / 2.0
@@ -3351,33 +3541,17 @@ class Lap_ImData:
 
         ####################################################################
         ## calculate the lick-rate and the average speed versus location    
-        bin_counts = np.zeros(self.N_pos_bins)
-        total_speed = np.zeros(self.N_pos_bins)
-
-        last_bin_number = 0 # each spike is assigned to all position bins since the last imaging frame 
-        for i_frame in range(len(self.frames_pos)):
-            next_bin_number = int(self.frames_pos[i_frame] // 70) 
-            if ((next_bin_number > last_bin_number + 1) & self.multiplane):
-                bin_number = np.arange(last_bin_number+1, next_bin_number+1) # the sequence ends at next_bun_number
-                n_bins = len(bin_number)
-                speed_to_add = np.repeat(self.frames_speed[i_frame] * self.frame_period/n_bins, n_bins)
-            else:
-                bin_number = next_bin_number
-                n_bins = 1
-                speed_to_add = self.frames_speed[i_frame] * self.frame_period
-            bin_counts[bin_number] += 1 / n_bins
-            total_speed[bin_number] = total_speed[bin_number] + speed_to_add
-            last_bin_number = next_bin_number
+        ## each frame is assigned to a position bin - in multiplane recordings to all position bins since the last imaging frame
+        i_frames, i_bins, n_bins = position_bins(self.frames_pos, self.multiplane)
+        bin_counts = bin_sum(1 / n_bins, i_bins, self.N_pos_bins)
+        total_speed = bin_sum(self.frames_speed[i_frames] * self.frame_period / n_bins, i_bins, self.N_pos_bins)
 
         self.T_pos = bin_counts * self.frame_period           # used for lick rate and average speed
 
         # total_speed = total_speed * self.frame_period
         self.ave_speed = nan_divide(total_speed, self.T_pos, where=(self.T_pos > 0.025))
 
-        lbin_counts = np.zeros(self.N_pos_bins)
-        for lpos in self.lick_position:
-            lbin_number = int(lpos // 70)
-            lbin_counts[lbin_number] += 1
+        lbin_counts = bin_sum(np.ones(len(self.lick_position)), np.floor_divide(self.lick_position, 70).astype(int), self.N_pos_bins)
         self.N_licks = lbin_counts
         self.lick_rate = nan_divide(self.N_licks, self.T_pos, where=(self.T_pos > 0.025))
         if (verbous > 0):
@@ -3386,34 +3560,20 @@ class Lap_ImData:
         ####################################################################
         ## calculate the cell activations (spike rate) as a function of position
         if (self.imaging_data == True):
-            fast_bin_counts = np.zeros(self.N_pos_bins)
-            self.spks_pos = np.zeros((self.n_cells, self.N_pos_bins)) # sum of spike counts measured at a given position
-            self.event_rate = np.zeros((self.n_cells, self.N_pos_bins)) # spike rate 
+            ## only frames with speed above the threshold are used
+            fast = self.frames_speed[i_frames] > self.speed_threshold
+            fast_bins = i_bins[fast]
+            fast_bin_counts = bin_sum(1 / n_bins[fast], fast_bins, self.N_pos_bins)
 
-            last_bin_number = 0 # each spike is assigned to all position bins since the last imaging frame 
-            for i_frame in range(len(self.frames_pos)):
-                next_bin_number = int(self.frames_pos[i_frame] // 70) 
-                if ((next_bin_number > last_bin_number + 1) & self.multiplane):
-                    bin_number = np.arange(last_bin_number+1, next_bin_number+1) # the sequence ends at next_bun_number
-                    n_bins = len(bin_number)
-                    added_spikes = np.tile(self.frames_spikes[:,i_frame], (n_bins, 1)).T # prepare a matrix with the spikes to add at multiple spatial bins
-                    # print('multiple position bins: ', self.lap, i_frame, n_bins)
-                else:
-                    bin_number = next_bin_number
-                    n_bins = 1
-                    added_spikes = self.frames_spikes[:,i_frame]
-                if (self.frames_speed[i_frame] > self.speed_threshold):
-                    fast_bin_counts[bin_number] += 1 / n_bins
-                    if (self.elfiz):
-                        self.spks_pos[:,bin_number] = self.spks_pos[:,bin_number] + added_spikes
-                    else: ### we need to multiply the values with dt_imaging as this converts probilities to expected counts
-                        self.spks_pos[:,bin_number] = self.spks_pos[:,bin_number] + added_spikes * self.frame_period / n_bins
-                last_bin_number = next_bin_number
+            added_spikes = self.frames_spikes[:,i_frames[fast]]
+            if (not self.elfiz): ### we need to multiply the values with dt_imaging as this converts probilities to expected counts
+                added_spikes = added_spikes * self.frame_period
+                added_spikes = added_spikes / n_bins[fast].astype(added_spikes.dtype)
+            self.spks_pos = bin_sum(added_spikes, fast_bins, self.N_pos_bins, axis=1) # sum of spike counts measured at a given position
 
             self.T_pos_fast = fast_bin_counts * self.frame_period # used for spike rate calculations
-            for bin_number in range(self.N_pos_bins):
-                if (self.T_pos_fast[bin_number] > 0): # otherwise the rate will remain 0
-                    self.event_rate[:,bin_number] = self.spks_pos[:,bin_number] / self.T_pos_fast[bin_number]
+            self.event_rate = np.zeros((self.n_cells, self.N_pos_bins)) # spike rate 
+            np.divide(self.spks_pos, self.T_pos_fast, out=self.event_rate, where=(self.T_pos_fast > 0)) # otherwise the rate will remain 0
 
         if (verbous > 0):
             print('ratemaps calculated')
@@ -3431,16 +3591,10 @@ class Lap_ImData:
                 lz_posbins = np.array([np.min((np.min(self.frames_pos)-1, 0)), zone_start-420, zone_start-210, zone_start, zone_end, self.corridor_length_roxel])
 
 
-            lz_bin_counts = np.zeros(5)
-            for pos in self.frames_pos:
-                bin_number = np.max(np.where(pos > lz_posbins))
-                lz_bin_counts[bin_number] += 1
+            lz_bin_counts = bin_sum(np.ones(len(self.frames_pos)), zone_bins(self.frames_pos, lz_posbins), 5)
             T_lz_pos = lz_bin_counts * self.frame_period
 
-            lz_lbin_counts = np.zeros(5)
-            for lpos in self.lick_position:
-                lbin_number = np.max(np.where(lpos > lz_posbins))
-                lz_lbin_counts[lbin_number] += 1
+            lz_lbin_counts = bin_sum(np.ones(len(self.lick_position)), zone_bins(self.lick_position, lz_posbins), 5)
             lz_lick_rate = nan_divide(lz_lbin_counts, T_lz_pos, where=(T_lz_pos>0.025))
             self.preZoneRate = [lz_lick_rate[1], lz_lick_rate[2]]
             
@@ -3642,7 +3796,7 @@ def HolmBonfMat(P_mat, p_val):
     n_cells = P_mat.shape[1]
     i_significant = np.zeros_like(P_mat)
     for i_cell in np.arange(n_cells):
-        i_significant[:,i_cell] = HolmBonf(P_mat[:,i_cell], 0.05)
+        i_significant[:,i_cell] = HolmBonf(P_mat[:,i_cell], p_val)
     return i_significant
 
 def HolmBonf(P_vec, p_val):
@@ -3657,53 +3811,69 @@ def HolmBonf(P_vec, p_val):
 
     return i_significant
 
+def BenjHochMat(P_mat, p_val):
+    ## Benjamini-Hochberg procedure controlling the false discovery rate at p_val over all elements of P_mat
+    ## P_mat is a matrix with the P-values of different tests in each row and cells in each column
+    P_vec = P_mat.flatten()
+    m = len(P_vec)
+    Pindex = np.argsort(P_vec, kind='stable')
+    i_significant = np.zeros(m)
+    below = np.flatnonzero(P_vec[Pindex] <= p_val * np.arange(1, m+1) / m)
+    if (len(below) > 0):
+        i_significant[Pindex[0:(below[-1]+1)]] = 1
+    return i_significant.reshape(P_mat.shape)
+
+def sequential_P_decided(counts, N, p_low, p_high, confidence=0.99):
+    ## sequential Monte Carlo tests: in counts out of N shuffles the statistics exceeded the data
+    ## a test is decided if the Clopper-Pearson confidence interval of its P-value is below p_low or above p_high
+    counts = np.asarray(counts)
+    alpha = 1 - confidence
+    lower = scipy.stats.beta.ppf(alpha / 2, np.maximum(counts, 1), N - counts + 1)
+    lower[counts == 0] = 0
+    upper = scipy.stats.beta.ppf(1 - alpha / 2, counts + 1, np.maximum(N - counts, 1))
+    upper[counts == N] = 1
+    return (upper < p_low) | (lower > p_high)
+
 
 ##########################################################
-def LocateImaging(trigger_log_file_string, TRIGGER_VOLTAGE_FILENAME, verbose = False, show_plots = False):
+def LocateImaging(trigger_log_file_string, TRIGGER_VOLTAGE_FILENAME, verbose = False, show_plots = False, return_report = False):
     # 1. TRIGGER_DATA  = np.array, 4 x N_triggers, each row is the 1. start time, 2, end time, duration, ITT
     # 2. select only trigger data with ITT > 10 ms
     # 3. find the shortest trigger
     # 4. find candidate trigger times in the log_trigger by matching trigger duration
-    # 5. check the next ITTS in voltage recording and log trigger
+    # 5. check the next ITTS in voltage recording and log trigger - all candidate offsets are tested at once
     # intputs: 
-    #   self.trigger_log_starts,        normal LETTERS: variables defined with LabView time axis
-    #   self.trigger_log_lengths, 
-    #   self.TRIGGER_VOLTAGE_VALUE,      CAPITAL LETTERS: variables defined with IMAGING time axis
-    #   self.TRIGGER_VOLTAGE_TIMES
+    #   trigger_log_starts,        normal LETTERS: variables defined with LabView time axis
+    #   trigger_log_lengths, 
+    #   TRIGGER_VOLTAGE_VALUE,      CAPITAL LETTERS: variables defined with IMAGING time axis
+    #   TRIGGER_VOLTAGE_TIMES
+    #   return_report: if True, a dictionary describing the quality of the match is also returned
     #
     # output:
-    #   self.imstart_time: singe scalar [s]: Labview time of the start of voltage-imaging recordings
+    #   imstart_time: singe scalar [s]: Labview time of the start of voltage-imaging recordings
+    #                 np.nan if the imaging could not be located
+    #   report: (only if return_report) dictionary with the details of the matching
     #
     # only works for 1 imaging session...
     # self.imstart_time = 537.133055 # Bazsi's best guess
     # print('Imaging time axis guessed by Bazsi...')
-    
+
+    report = {'imstart_time':np.nan, 'status':'', 'N_recorded_triggers':0, 'N_logged_triggers':0, 'used_index':-1, 'min_trigger_length':np.nan, 'n_extra_indexes':0, 'candidate_log_indexes':np.zeros(0, dtype=int), 'candidate_max_deviation':np.zeros(0), 'i_log_first_match':-1, 'N_matches':0, 'max_delay':np.nan}
+
+    def locate_failed(message):
+        print(message)
+        report['status'] = message
+        if return_report:
+            return np.nan, report
+        return np.nan
+
     #0)load recorded trigger 
-    trigger_log_starts = [] ## s
-    trigger_log_lengths = []      
-    trigger_log_file=open(trigger_log_file_string, newline='')
-    log_file_reader=csv.reader(trigger_log_file, delimiter=',')
-    next(log_file_reader, None)#skip the headers
-    for line in log_file_reader:             
-        trigger_log_starts.append(float(line[0])) # seconds
-        trigger_log_lengths.append(float(line[1]) / 1000) # convert to seconds from ms
+    trigger_starts, trigger_lengths = LoadTriggerLog(trigger_log_file_string) # s
     if verbose:
         print('trigger logfile loaded')
-    trigger_starts = np.array(trigger_log_starts)
-    trigger_lengths = np.array(trigger_log_lengths)
-
-
-    TRIGGER_VOLTAGE_VALUE = [] 
-    TRIGGER_VOLTAGE_TIMES = [] ## ms
-    trigger_signal_file=open(TRIGGER_VOLTAGE_FILENAME, 'r', newline='')
-    trigger_reader=csv.reader(trigger_signal_file, delimiter=',')
-    next(trigger_reader, None)
-    for line in trigger_reader:
-        TRIGGER_VOLTAGE_VALUE.append(float(line[1])) 
-        TRIGGER_VOLTAGE_TIMES.append(float(line[0]) / 1000) # converting it to seconds
-    TRIGGER_VOLTAGE=np.array(TRIGGER_VOLTAGE_VALUE)
-    TRIGGER_TIMES=np.array(TRIGGER_VOLTAGE_TIMES)
-    
+    report['N_logged_triggers'] = len(trigger_starts)
+
+    TRIGGER_TIMES, TRIGGER_VOLTAGE = LoadVoltageRecording(TRIGGER_VOLTAGE_FILENAME) # s
     if verbose:
         print('trigger voltage signal loaded')
     
@@ -3714,6 +3884,9 @@ def LocateImaging(trigger_log_file_string, TRIGGER_VOLTAGE_FILENAME, verbose = F
     fall_index=np.nonzero((TRIGGER_VOLTAGE[0:-1] > 1)&(TRIGGER_VOLTAGE[1:]<= 1))[0]+1
     FALL_T=TRIGGER_TIMES[fall_index]
     
+    if ((np.size(RISE_T) == 0) | (np.size(FALL_T) == 0)):
+        return locate_failed('no triggers found in the voltage recording! unable to locate imaging part')
+
     # pairing rises with falls
     if (RISE_T[0]>FALL_T[0]):
         FALL_T = np.delete(FALL_T,0)
@@ -3721,7 +3894,7 @@ def LocateImaging(trigger_log_file_string, TRIGGER_VOLTAGE_FILENAME, verbose = F
         if verbose:
             print('deleting first fall')
 
-    if (RISE_T[-1] > FALL_T[-1]):
+    if ((np.size(FALL_T) > 0) and (RISE_T[-1] > FALL_T[-1])):
         RISE_T=np.delete(RISE_T,-1)
         
         if verbose:
@@ -3730,7 +3903,8 @@ def LocateImaging(trigger_log_file_string, TRIGGER_VOLTAGE_FILENAME, verbose = F
 
     if np.size(RISE_T)!=np.size(FALL_T):
         print('rises:', np.size(RISE_T), 'falls:',np.size(FALL_T))
-        sys.exit('trigger ascending and desending edges do not match! unable to locate imaging part')
+        return locate_failed('trigger ascending and desending edges do not match! unable to locate imaging part')
+    report['N_recorded_triggers'] = np.size(RISE_T)
 
 
     #1) filling up TRIGGER_DATA array:
@@ -3743,122 +3917,121 @@ def LocateImaging(trigger_log_file_string, TRIGGER_VOLTAGE_FILENAME, verbose = F
     TEMP_FALL = np.delete(TEMP_FALL,-1)
     TRIGGER_DATA[:,3] = RISE_T - TEMP_FALL # previous down duration - Inter Trigger Time
     TRIGGER_DATA[:,4] = np.arange(0,np.size(RISE_T))
+    N_triggers = TRIGGER_DATA.shape[0]
         
     #2) keeping only triggers with ITT > 10 ms    
     valid_indexes=np.nonzero(TRIGGER_DATA[:,3] > 0.010)[0]
-    TRIGGER_DATA_sub=TRIGGER_DATA[valid_indexes,:]
     
     #3) find the valid shortest trigger
-    lengths = np.copy(TRIGGER_DATA_sub[:,2])
-    index = 0
-    if lengths.size < 2:
-        sys.exit('Less than 2 valid triggers - Unable to locate imaging!')
-    if lengths.size < 6:
-        used_index = int(TRIGGER_DATA_sub[0][4])
-        n_extra_indexes = min(5,TRIGGER_DATA.shape[0]-used_index)
+    # we only use triggers followed by at least 4 more triggers, so that 5 ITTs can be checked
+    if valid_indexes.size < 2:
+        return locate_failed('Less than 2 valid triggers - Unable to locate imaging!')
+    if valid_indexes.size < 6:
+        used_index = valid_indexes[0]
     else:
-        while True:
-            minindex = np.argmin(lengths)
-            used_index = int(TRIGGER_DATA_sub[minindex][4])
-            n_extra_indexes = min(5,TRIGGER_DATA.shape[0]-used_index)
-            if n_extra_indexes < 5:
-                lengths[minindex] = np.max(lengths)+1
-                index+=1
-                if index == lengths.size:
-                    sys.exit('Unable to locate imaging! Not enough checkable valid triggers!')
-            else:
-                break
+        checkable_indexes = valid_indexes[(N_triggers - valid_indexes) >= 5]
+        if checkable_indexes.size == 0:
+            return locate_failed('Unable to locate imaging! Not enough checkable valid triggers!')
+        used_index = checkable_indexes[np.argmin(TRIGGER_DATA[checkable_indexes,2])] # argmin returns the first of the equally short triggers
+    n_extra_indexes = min(5, N_triggers-used_index)
+    report['used_index'] = used_index
+    report['n_extra_indexes'] = n_extra_indexes
+    report['min_trigger_length'] = TRIGGER_DATA[used_index,2]
     if verbose:
-        print('triggers after:',TRIGGER_DATA.shape[0]-used_index)
+        print('triggers after:',N_triggers-used_index)
         print('n_extra_indexes',n_extra_indexes)
         print('used_index', used_index)
 
     #4)find the candidate trigger times
-    candidate_log_indexes = []
-    for i in range(len(trigger_lengths)):
-        if (abs(trigger_lengths[i] - TRIGGER_DATA[used_index][2]) < 0.007):
-            candidate_log_indexes.append(i)
+    candidate_log_indexes = np.flatnonzero(np.abs(trigger_lengths - TRIGGER_DATA[used_index,2]) < 0.007)
+    report['candidate_log_indexes'] = candidate_log_indexes
             
     if verbose:
         print('candidate log indexes',candidate_log_indexes)
 
     #5)check the next ITT-s, locate relevant behavior
-    i_log_first_match = np.nan
     if verbose:
         print('min recorded trigger length:',TRIGGER_DATA[used_index,2])
         
     if TRIGGER_DATA[used_index,2] > 0.800:
+        return locate_failed('Warning! No short enough trigger in this recording! Unable to locate imaging')
+
+    ## the time of the next n_extra_indexes triggers relative to the first one
+    ## in the recording (dif_mes) and in the log for every possible starting trigger (dif_log)
+    dif_mes = TRIGGER_DATA[used_index:used_index+n_extra_indexes,0] - TRIGGER_DATA[used_index,0]
+    N_testable = len(trigger_starts) - n_extra_indexes # candidates starting later can not be tested
+    max_deviation = np.full(len(trigger_starts), np.nan)
+    if (N_testable > 0):
+        log_windows = np.lib.stride_tricks.sliding_window_view(trigger_starts, n_extra_indexes)[0:N_testable,:]
+        dif_log = log_windows - log_windows[:,0:1]
+        max_deviation[0:N_testable] = np.max(np.abs(dif_log - dif_mes), axis=1)
+    report['candidate_max_deviation'] = max_deviation[candidate_log_indexes]
+
+    N_late = np.sum(candidate_log_indexes >= N_testable)
+    if (N_late > 0):
+        print('   slight warning - testing', N_late, 'late candidates failed')
+
+    matches = candidate_log_indexes[max_deviation[candidate_log_indexes] < 0.009]
+    report['N_matches'] = len(matches)
+    if (len(matches) == 0):
+        return locate_failed('no precise trigger mach found: need to refine code or check device')
+    if (len(matches) > 1):
+        print('Warning! More than one trigger matches found!')
+
+    i_log_first_match = matches[0]
+    imstart_time = trigger_starts[i_log_first_match] - TRIGGER_DATA[used_index,0]
+    print('relevant behavior located, lap time of the first frame:', np.round(imstart_time, 6))
+    if verbose:
+        print('log reference index:', i_log_first_match)
+
+    ## delay between the recorded and the logged triggers after the alignment
+    i_log_triggers = i_log_first_match + np.arange(N_triggers) - used_index
+    i_matched = np.flatnonzero((i_log_triggers >= 0) & (i_log_triggers < len(trigger_starts)))
+    difi = np.full(N_triggers, np.nan)
+    difi[i_matched] = TRIGGER_DATA[i_matched,0] - trigger_starts[i_log_triggers[i_matched]] + imstart_time
+    report['imstart_time'] = imstart_time
+    report['i_log_first_match'] = i_log_first_match
+    report['max_delay'] = np.nanmax(np.abs(difi))
+    report['status'] = 'relevant behavior located'
+
+    #show alignment and recorded trigegr if specified
+    if show_plots:
+        plt.figure('recorded trigger')
+        plt.plot(TRIGGER_TIMES, TRIGGER_VOLTAGE, label = 'recorded trigger')
+        plt.scatter(RISE_T, np.ones_like(RISE_T)*2, c='r', label = 'detected trigger starts')
+        plt.scatter(FALL_T, np.ones_like(FALL_T)*1, c='k', label = 'detected trigger ends')
+        plt.xlabel('sec')
+        plt.ylabel('mV')
+        plt.legend()
+        plt.show()
+        
+        # plt.figure('alignment')
+        fig, ax = plt.subplots()
+        y1 = 7
+        sidey = 5
+        # ax = plt.gca()
+        for i in range(N_triggers):
+            start = TRIGGER_DATA[i,0] + imstart_time
+            patch = Rectangle((start, y1), TRIGGER_DATA[i,2] ,sidey , color='darkred')
+            ax.add_patch(patch)
+        # squares for logged triggers
+        y1 = 1
+        sidey = 5
+        for i in range(trigger_starts.size): 
+            patch = Rectangle((trigger_starts[i], y1), trigger_lengths[i] ,sidey , color='darkblue')
+            ax.add_patch(patch)
+
+        ax2 = ax.twinx()
+        ax2.plot(TRIGGER_DATA[:,0] + imstart_time, difi, c = 'orange')
+        ax2.tick_params(axis='y', labelcolor='orange')
+        ax2.set_ylabel('delay in sec')
+        
+        ax.set_xlim(trigger_starts[0],trigger_starts[-1])
+        ax.set_ylim(0,13)
+        ax.set_xlabel('sec')
+        
+        plt.show()
 
-        sys.exit('Warning! No short enough trigger in this recording! Unable to locate imaging')
-    else:
-        match_found = False
-        for i in range(len(candidate_log_indexes)):    
-            log_reference_index=candidate_log_indexes[i]
-            difs=[]
-            if len(trigger_starts) > log_reference_index + n_extra_indexes:
-                for j in range(n_extra_indexes):
-                    dif_log = trigger_starts[log_reference_index + j] - trigger_starts[log_reference_index]
-                    dif_mes = TRIGGER_DATA[used_index+j,0] - TRIGGER_DATA[used_index,0]
-                    delta = abs(dif_log - dif_mes)
-                    difs.append(delta)
-
-                if max(difs) < 0.009:
-                    if match_found==False:  
-                        match_found=True
-                        i_log_first_match = log_reference_index
-                        lap_time_of_first_frame = trigger_starts[log_reference_index] - TRIGGER_DATA[used_index,0]
-                        print('relevant behavior located, lap time of the first frame:', np.round(lap_time_of_first_frame, 6))
-                       
-                        if verbose:
-                            print('log reference index:', log_reference_index)
-                            
-                    else:
-                        print('Warning! More than one trigger matches found!')
-            else:
-                print('   slight warning - testing some late candidates failed')
-
-        if match_found==True:
-            imstart_time = lap_time_of_first_frame
-            #show alignment and recorded trigegr if specified
-            if show_plots:
-                plt.figure('recorded trigger')
-                plt.plot(TRIGGER_VOLTAGE_TIMES, TRIGGER_VOLTAGE_VALUE, label = 'recorded trigger')
-                plt.scatter(RISE_T, np.ones_like(RISE_T)*2, c='r', label = 'detected trigger starts')
-                plt.scatter(FALL_T, np.ones_like(FALL_T)*1, c='k', label = 'detected trigger ends')
-                plt.xlabel('sec')
-                plt.ylabel('mV')
-                plt.legend()
-                plt.show()
-                
-                # plt.figure('alignment')
-                fig, ax = plt.subplots()
-                y1 = 7
-                sidey = 5
-                # ax = plt.gca()
-                difi = np.zeros(TRIGGER_DATA.shape[0])
-                for i in range(TRIGGER_DATA.shape[0]):
-                    start = TRIGGER_DATA[i,0] + imstart_time
-                    patch = Rectangle((start, y1), TRIGGER_DATA[i,2] ,sidey , color='darkred')
-                    ax.add_patch(patch)
-                    difi[i] = TRIGGER_DATA[i,0] - trigger_starts[i_log_first_match+i-used_index] + imstart_time
-                # squares for logged triggers
-                y1 = 1
-                sidey = 5
-                for i in range(trigger_starts.size): 
-                    patch = Rectangle((trigger_starts[i], y1), trigger_lengths[i] ,sidey , color='darkblue')
-                    ax.add_patch(patch)
-
-                ax2 = ax.twinx()
-                ax2.plot(TRIGGER_DATA[:,0] + imstart_time, difi, c = 'orange')
-                ax2.tick_params(axis='y', labelcolor='orange')
-                ax2.set_ylabel('delay in sec')
-                
-                ax.set_xlim(trigger_starts[0],trigger_starts[-1])
-                ax.set_ylim(0,13)
-                ax.set_xlabel('sec')
-                
-                plt.show()
-                
-        else:
-            sys.exit('no precise trigger mach found: need to refine code or check device')
+    if return_report:
+        return imstart_time, report
     return imstart_time
@@ -25,6 +25,7 @@ import pandas as pd
 
 from Stages import *
 from Corridors import *
+from LogReader import *
 
 def nan_divide(a, b, where=True):
     'division function that returns np.nan where the division is not defined'
@@ -451,36 +452,16 @@ class Session:
 
     def get_lapdata(self, datapath, date_time, name, task):
 
-        time_array=[]
-        lap_array=[]
-        maze_array=[]
-        position_array=[]
-        mode_array=[]
-        lick_array=[]
-        action=[]
-        substage=[]
-
-        data_log_file_string=datapath + 'data/' + name + '_' + task + '/' + date_time + '/' + date_time + '_' + name + '_' + task + '_ExpStateMashineLog.txt'
-        data_log_file=open(data_log_file_string)
-        log_file_reader=csv.reader(data_log_file, delimiter=',')
-        next(log_file_reader, None)#skip the headers
-        for line in log_file_reader:
-            time_array.append(float(line[0]))
-            lap_array.append(int(line[1]))
-            maze_array.append(int(line[2]))
-            position_array.append(int(line[3]))
-            mode_array.append(line[6] == 'Go')
-            lick_array.append(line[9] == 'TRUE')
-            action.append(str(line[14]))
-            substage.append(str(line[17]))
-
-        laptime = np.array(time_array)
+        data_log_file_string = ExpStateLogFileName(datapath, date_time, name, task)
+        explog = ExpStateLog(data_log_file_string)
+
+        laptime = explog.time
         time_breaks = np.where(np.diff(laptime) > 1)[0]
         if (len(time_breaks) > 0):
             print('ExpStateMachineLog time interval > 1s: ', len(time_breaks), ' times')
             print(laptime[time_breaks])
 
-        lap = np.array(lap_array)
+        lap = explog.lap
         logged_laps = np.unique(lap)
         all_laps = np.arange(max(lap)) + 1
         missing_laps = np.setdiff1d(all_laps, logged_laps)
@@ -491,13 +472,13 @@ class Session:
             self.n_laps = -1
             return 
 
-        sstage = np.array(substage)
+        sstage = explog.substage_codes # integer codes, the names are in explog.substage_names
         current_sstage = sstage[0]
 
-        pos = np.array(position_array)
-        lick = np.array(lick_array)
-        maze = np.array(maze_array)
-        mode = np.array(mode_array)
+        pos = explog.position
+        lick = explog.lick
+        maze = explog.maze
+        mode = explog.mode
         N_0lap = 0 # Counting the non-valid laps
         i_corrids = [] # ID of corridor for the current lap
         self.n_laps = 0
@@ -531,16 +512,14 @@ class Session:
                 if (sstage_lap != current_sstage):
                     print('############################################################')
                     print('substage change detected!')
-                    print('first lap in substage ', sstage_lap, 'is lap', self.n_laps, ', which started at t', t_lap[0])
+                    print('first lap in substage ', explog.substage_names[sstage_lap], 'is lap', self.n_laps, ', which started at t', t_lap[0])
                     print('############################################################')
                     current_sstage = sstage_lap
                     self.substage_change_laps.append(self.n_laps)
 
                 istart = np.where(y)[0][0]
                 iend = np.where(y)[0][-1] + 1
-                action_lap = action[istart:iend]
-    
-                reward_indices = [j for j, x in enumerate(action_lap) if x == "TrialReward"]
+                reward_indices = explog.get_reward_indices(istart, iend)
                 t_reward = t_lap[reward_indices]
     
                 ## detecting invalid laps - terminated before the animal could receive reward
@@ -552,10 +531,7 @@ class Session:
                 if (valid_lap == False):
                     mode_lap = 0
 
-                actions = []
-                for j in range(len(action_lap)):
-                    if not((action_lap[j]) in ['No', 'TrialReward']):
-                        actions.append([t_lap[j], action_lap[j]])    
+                actions = explog.get_actions(t_lap, istart, iend)
     
                 # sessions.append(Lap_Data(name, i, t_lap, pos_lap, t_licks, t_reward, corridor, mode_lap, actions))
 				# print(self.n_laps, i_lap, len(pos_lap))
@@ -567,13 +543,10 @@ class Session:
         self.i_corridors = np.array(i_corrids) # ID of corridor for the current lap
 
     def get_stage(self, datapath, date_time, name, task):
-        action_log_file_string=datapath + 'data/' + name + '_' + task + '/' + date_time + '/' + date_time + '_' + name + '_' + task + '_UserActionLog.txt'
-        action_log_file=open(action_log_file_string)
-        log_file_reader=csv.reader(action_log_file, delimiter=',')
-        next(log_file_reader, None)#skip the headers
-        for line in log_file_reader:
-            if (line[1] == 'Stage'):
-                self.stage = int(round(float(line[2])))
+        action_log_file_string = LogFileName(datapath, date_time, name, task, 'UserActionLog')
+        stage = LoadStage(action_log_file_string)
+        if (stage is not None):
+            self.stage = stage
 
     def test_anticipatory(self):
         corridor_types = np.unique(self.i_corridors)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Created in Oct 2026
+@author: bbujfalussy - ubalazs317@gmail.com
+Reading the log files written by LabView in the in vivo virtual reality experiments.
+The frame times are read from the .xml logfile of the imaging software (Prairie).
+The parsed logs are cached in a compressed .npz file next to the logfile and reused until the logfile changes.
+The same reader is used by LogAnal.Session, ImageAnal.ImagingSessionData and ImShuffle.ImShuffle
+
+"""
+
+import numpy as np
+import pandas as pd
+import csv
+import os
+import xml.etree.ElementTree as ET
+
+## increase this if the content of the cache files changes
+cache_version = 1
+
+def LogFileName(datapath, date_time, name, task, logtype):
+    # logtype: 'ExpStateMashineLog', 'UserActionLog' or 'TriggerLog'
+    return datapath + 'data/' + name + '_' + task + '/' + date_time + '/' + date_time + '_' + name + '_' + task + '_' + logtype + '.txt'
+
+def ExpStateLogFileName(datapath, date_time, name, task):
+    return LogFileName(datapath, date_time, name, task, 'ExpStateMashineLog')
+
+def CacheFileName(log_file_string):
+    # the cache is saved next to the logfile: xxx_ExpStateMashineLog.txt -> xxx_ExpStateMashineLog_cache.npz
+    return os.path.splitext(log_file_string)[0] + '_cache.npz'
+
+def LoadCache(log_file_string):
+    # returns the dictionary of arrays stored in the cache file
+    # or None if there is no cache or the logfile has changed since the cache was written (size or modification time)
+    cache_file_string = CacheFileName(log_file_string)
+    if not os.path.exists(cache_file_string):
+        return None
+    try:
+        src = os.stat(log_file_string)
+        with np.load(cache_file_string, allow_pickle=False) as cache:
+            data = {key:cache[key] for key in cache.files}
+    except (OSError, ValueError, KeyError) as e:
+        print('could not read cache file', cache_file_string, ':', e)
+        return None
+    if (int(data.get('cache_version', -1)) != cache_version):
+        return None
+    if ((int(data['source_size']) != src.st_size) or (int(data['source_mtime_ns']) != src.st_mtime_ns)):
+        return None
+    return data
+
+def SaveCache(log_file_string, **arrays):
+    # saves the arrays into a compressed npz file next to the logfile together with the size and modification time of the logfile
+    # failing to write the cache (e.g. read-only data folder) is not an error
+    cache_file_string = CacheFileName(log_file_string)
+    temp_file_string = cache_file_string + '.tmp'
+    try:
+        src = os.stat(log_file_string)
+        with open(temp_file_string, 'wb') as cache_file:
+            np.savez_compressed(cache_file, cache_version=cache_version, source_size=src.st_size, source_mtime_ns=src.st_mtime_ns, **arrays)
+        os.replace(temp_file_string, cache_file_string)
+    except OSError as e:
+        print('could not write cache file', cache_file_string, ':', e)
+        if os.path.exists(temp_file_string):
+            os.remove(temp_file_string)
+
+
+def LoadStage(action_log_file_string, use_cache=True):
+    # reads the UserActionLog and returns the last stage set by the user - None if no stage is found
+    stages = None
+    if use_cache:
+        cache = LoadCache(action_log_file_string)
+        if cache is not None:
+            stages = cache['stages']
+
+    if stages is None:
+        stage_list = []
+        action_log_file = open(action_log_file_string, newline='')
+        log_file_reader = csv.reader(action_log_file, delimiter=',')
+        next(log_file_reader, None)#skip the headers
+        for line in log_file_reader:
+            if (line[1] == 'Stage'):
+                stage_list.append(int(round(float(line[2]))))
+        action_log_file.close()
+        stages = np.array(stage_list, dtype=np.int64)
+        if use_cache:
+            SaveCache(action_log_file_string, stages=stages)
+
+    if (len(stages) == 0):
+        return None
+    return int(stages[-1])
+
+
+def LoadTriggerLog(trigger_log_file_string, use_cache=True):
+    # reads the TriggerLog and returns the start (s) and the length (s) of the triggers sent by LabView
+    if use_cache:
+        cache = LoadCache(trigger_log_file_string)
+        if cache is not None:
+            return cache['trigger_starts'], cache['trigger_lengths']
+
+    df = pd.read_csv(trigger_log_file_string, sep=',', header=None, skiprows=1, usecols=[0, 1], dtype=np.float64, float_precision='round_trip')
+    trigger_starts = df[0].to_numpy() # seconds
+    trigger_lengths = df[1].to_numpy() / 1000 # convert to seconds from ms
+    if use_cache:
+        SaveCache(trigger_log_file_string, trigger_starts=trigger_starts, trigger_lengths=trigger_lengths)
+    return trigger_starts, trigger_lengths
+
+
+class ExpStateLog:
+    'Columns of the ExpStateMashineLog used in the analysis, stored as typed numpy arrays'
+    ## column indices in the logfile
+    ## 0: time, 1: lap, 2: maze, 3: position, 6: mode, 9: lick, 14: action, 17: substage
+    columns = [0, 1, 2, 3, 6, 9, 14, 17]
+    ## arrays stored in the cache file
+    fields = ['time', 'lap', 'maze', 'position', 'mode', 'lick', 'action_codes', 'action_names', 'substage_codes', 'substage_names']
+
+    def __init__(self, data_log_file_string, use_cache=True):
+        self.filename = data_log_file_string
+
+        cache = None
+        if use_cache:
+            cache = LoadCache(data_log_file_string)
+
+        if cache is not None:
+            for key in self.fields:
+                setattr(self, key, cache[key])
+        else:
+            self.read_log()
+            if use_cache:
+                SaveCache(data_log_file_string, **{key:getattr(self, key) for key in self.fields})
+        self.N = len(self.time)
+
+    def read_log(self):
+        # a single pass reading only the used columns, the string columns are read as categories (dictionary encoding)
+        # float_precision='round_trip' gives the same values as python's float()
+        dtypes = {0:np.float64, 1:np.int64, 2:np.int64, 3:np.int64, 6:'category', 9:'category', 14:'category', 17:'category'}
+        df = pd.read_csv(self.filename, sep=',', header=None, skiprows=1, usecols=self.columns, dtype=dtypes, keep_default_na=False, float_precision='round_trip')
+
+        self.time = df[0].to_numpy()
+        self.lap = df[1].to_numpy()
+        self.maze = df[2].to_numpy()
+        self.position = df[3].to_numpy()
+        self.mode = (df[6] == 'Go').to_numpy() # True if recorded in 'Go' mode
+        self.lick = (df[9] == 'TRUE').to_numpy()
+
+        ## action and substage are stored as integer codes and the list of their unique values
+        self.action_codes = df[14].cat.codes.to_numpy().astype(np.int64)
+        self.action_names = np.array(df[14].cat.categories, dtype=str)
+        self.substage_codes = df[17].cat.codes.to_numpy().astype(np.int64)
+        self.substage_names = np.array(df[17].cat.categories, dtype=str)
+
+    def action_code(self, action_name):
+        # integer code of an action - -1 if the action is not present in the log
+        i_action = np.flatnonzero(self.action_names == action_name)
+        if (len(i_action) > 0):
+            return i_action[0]
+        return -1
+
+    def get_actions(self, t_lap, istart, iend):
+        # list of [time, action] pairs for the actions other than 'No' and 'TrialReward' in the range istart:iend
+        action_lap = self.action_codes[istart:iend]
+        other_actions = ~np.isin(action_lap, [self.action_code('No'), self.action_code('TrialReward')])
+        return [[t_lap[j], str(self.action_names[action_lap[j]])] for j in np.flatnonzero(other_actions)]
+
+    def get_reward_indices(self, istart, iend):
+        # indices of reward delivery within the range istart:iend
+        return np.flatnonzero(self.action_codes[istart:iend] == self.action_code('TrialReward'))
+
+
+def LoadVoltageRecording(voltage_file_string, use_cache=True):
+    # reads the trigger signal recorded by the imaging software (first two columns of the csv: time in ms, voltage)
+    # returns the time (s) and the voltage of the samples
+    if use_cache:
+        cache = LoadCache(voltage_file_string)
+        if cache is not None:
+            return cache['voltage_times'], cache['voltage_values']
+
+    df = pd.read_csv(voltage_file_string, sep=',', header=None, skiprows=1, usecols=[0, 1], dtype=np.float64, float_precision='round_trip')
+    voltage_times = df[0].to_numpy() / 1000 # converting it to seconds
+    voltage_values = df[1].to_numpy()
+    if use_cache:
+        SaveCache(voltage_file_string, voltage_times=voltage_times, voltage_values=voltage_values)
+    return voltage_times, voltage_values
+
+
+def LoadImagingXML(imaging_logfile_name, use_cache=True):
+    # streams the Prairie .xml imaging logfile and reads only the attributes used in the analysis
+    # returns a dictionary with the following elements:
+    #   relative_times: relativeTime of all Frames (s)
+    #   absolute_times: absoluteTime of all Frames (s)
+    #   sequence_type: type of the first Sequence, 'TSeries ZSeries Element' for multiplane recordings
+    #   voltage_delay: absoluteTime of the first VoltageRecording (s)
+    if use_cache:
+        cache = LoadCache(imaging_logfile_name)
+        if cache is not None:
+            return {'relative_times':cache['relative_times'], 'absolute_times':cache['absolute_times'], 'sequence_type':str(cache['sequence_type']), 'voltage_delay':float(cache['voltage_delay'])}
+
+    N_alloc = 10000
+    relative_times = np.zeros(N_alloc)
+    absolute_times = np.zeros(N_alloc)
+    N_frames = 0
+    sequence_type = None
+    voltage_delay = None
+
+    for event, elem in ET.iterparse(imaging_logfile_name, events=('start', 'end')):
+        if (event == 'start'):
+            if (elem.tag == 'Frame'):
+                if (N_frames == N_alloc): # the arrays are full, we double their size
+                    relative_times = np.hstack([relative_times, np.zeros(N_alloc)])
+                    absolute_times = np.hstack([absolute_times, np.zeros(N_alloc)])
+                    N_alloc = 2 * N_alloc
+                relative_times[N_frames] = float(elem.get('relativeTime'))
+                absolute_times[N_frames] = float(elem.get('absoluteTime'))
+                N_frames = N_frames + 1
+            elif ((elem.tag == 'Sequence') and (sequence_type is None)):
+                sequence_type = elem.get('type')
+            elif ((elem.tag == 'VoltageRecording') and (voltage_delay is None)):
+                voltage_delay = float(elem.get('absoluteTime'))
+        elif (elem.tag in ['Frame', 'Sequence']): # we do not keep the processed elements in memory
+            elem.clear()
+
+    if (voltage_delay is None):
+        raise ValueError('ERROR: no VoltageRecording found in the imaging logfile ' + imaging_logfile_name)
+    if (sequence_type is None):
+        sequence_type = ''
+
+    imaging_times = {'relative_times':relative_times[0:N_frames], 'absolute_times':absolute_times[0:N_frames], 'sequence_type':sequence_type, 'voltage_delay':voltage_delay}
+    if use_cache:
+        SaveCache(imaging_logfile_name, **imaging_times)
+    return imaging_times
@@ -34,6 +34,205 @@ def Mcorrcoef(X,Y, zero_var_out=0):
     r = np.divide(r_num, r_den, out=out_vec, where=vec_nonzero)
     return r
 
+def batch_vcorrcoef(X, Y, zero_var_out=0):
+    # correlation between the rows of the matrices X[i] (N x k) and the vectors Y[i] (1 x k) for all i
+    # X: ... x N x k, Y: ... x k; the output is ... x N, the same as vcorrcoef(X[i], Y[i]) for each i
+    # zero_var_out: is the output where the variance is 0
+    # can be either 0 or np.nan
+    # the sums along k are rounded as in vcorrcoef only if X[i] has the same memory layout as the matrix passed to vcorrcoef,
+    # use loop_sum_layout to get X in this layout; otherwise the result is equal to vcorrcoef only up to rounding
+    Y = np.ascontiguousarray(Y) # the sums along the rows of Y are calculated as for single vectors
+    Xm = np.nanmean(X, axis=-1, keepdims=True)
+    vec_nonzero = np.sum((X - Xm)**2, axis=-1) != 0 # we select the rows with nonzera VARIANCE...
+
+    Ym = np.nanmean(Y, axis=-1, keepdims=True)
+    r_num = np.nansum((X-Xm)*np.expand_dims(Y-Ym, -2), axis=-1)
+    r_den = np.sqrt(np.nansum((X-Xm)**2, axis=-1)*np.nansum((Y-Ym)**2, axis=-1, keepdims=True))
+    out_vec = np.zeros_like(r_num)
+    out_vec[:] = zero_var_out
+    r = np.divide(r_num, r_den, out=out_vec, where=vec_nonzero)
+    return r
+
+def loop_sum_layout(X):
+    # X: ... x N x k view of the N x k matrices that would be processed one by one, summing along their rows (vcorrcoef, np.nanvar(axis=1)...)
+    # returns X in a memory layout where the sums along k over all matrices at once are rounded as for each matrix separately:
+    # if k is inside N in memory, the rows of each matrix are summed pairwise, as the rows of a contiguous copy of X
+    # otherwise k is the outermost axis (e.g. transposed matrices) and both sum sequentially, so the view is kept
+    if (X.strides[-1] < X.strides[-2]):
+        return np.ascontiguousarray(X)
+    return X
+
+def zscore_rows(X):
+    # rows of X (along its last axis) centered and scaled to unit norm: the correlation of two rows is the dot product of their z-scored rows
+    Z = X - np.mean(X, axis=-1, keepdims=True)
+    return Z / np.sqrt(np.sum(Z**2, axis=-1, keepdims=True))
+
+def corrcoef_matrix(X):
+    # correlation between all pairs of rows of X, the same as np.corrcoef(X)
+    # computed as a single matrix product of the z-scored rows; rows containing NaN give NaN
+    Z = zscore_rows(X)
+    C = np.dot(Z, np.transpose(Z))
+    return np.clip(C, -1, 1)
+
+def cross_corrcoef(X, Y):
+    # correlation between the rows of X and the rows of Y, the same as np.corrcoef(X, Y)[0:n,n:] where n is the number of rows of X
+    C = np.dot(zscore_rows(X), np.transpose(zscore_rows(Y)))
+    return np.clip(C, -1, 1)
+
+def popvec_corrcoef(X, Y):
+    # bin-wise correlation between the population vectors of laps and templates
+    # X: laps x bins x cells, Y: templates x bins x cells; the output is templates x laps x bins
+    # element [k,i,b] is the same as np.corrcoef(X[i,b,:], Y[k,b,:])[0,1], computed with one matrix product per bin
+    C = np.matmul(np.transpose(zscore_rows(X), (1,0,2)), np.transpose(zscore_rows(Y), (1,2,0))) # bins x laps x templates
+    return np.clip(np.transpose(C, (2,1,0)), -1, 1)
+
+def corridor_selectivity(rate_matrix):
+    # corridor selectivity (max(r) - min(r)) / sum(r) of the rates in the corridors along the first axis and the corridor with the maximal rate
+    # rate_matrix: K corridors x ... array, computed for all cells (and shuffles) at once
+    max_rate = np.max(rate_matrix, axis=0)
+    min_rate = np.min(rate_matrix, axis=0)
+    sumrate = np.sum(rate_matrix, axis=0)
+    return (max_rate - min_rate) / sumrate, np.argmax(rate_matrix, axis=0)
+
+def corridor_similarity(ratemaps, zero_var_out=0):
+    # correlation between the ratemaps of all pairs of corridors, computed together for all cells (and shuffles)
+    # ratemaps: K corridors x L bins x ... array; the output is a K x K x ... array
+    # zero_var_out: is the output where the variance is 0
+    # the sums along the bins are rounded as in Mcorrcoef applied to the ratemaps of each pair of corridors
+    K = ratemaps.shape[0]
+    X = ratemaps - np.nanmean(ratemaps, axis=1, keepdims=True)
+    var_nonzero = np.sum(X**2, axis=1) != 0 # K x ...
+    sum_squares = np.nansum(X**2, axis=1)
+    i_cor, j_cor = np.triu_indices(K, k=1) # all pairs of corridors
+
+    r_num = np.nansum(X[i_cor] * X[j_cor], axis=1)
+    r_den = np.sqrt(sum_squares[i_cor] * sum_squares[j_cor])
+    out_vec = np.zeros_like(r_num)
+    out_vec[:] = zero_var_out
+    r = np.divide(r_num, r_den, out=out_vec, where=var_nonzero[i_cor] & var_nonzero[j_cor])
+
+    similarity = np.zeros((K, K) + r.shape[1:])
+    similarity[i_cor, j_cor] = r
+    similarity[j_cor, i_cor] = r
+    similarity[np.arange(K), np.arange(K)] = np.where(var_nonzero, 1, zero_var_out)
+    return similarity
+
+def masked_row_sum(X, mask):
+    # sum of the elements of each row of X where mask is True
+    # the same as np.sum(X[i, mask[i]]) for each row i - rows with the same number of selected elements are summed together
+    order = np.argsort(~mask, axis=1, kind='stable') # the selected elements first, in their original order
+    X_packed = np.take_along_axis(X, order, axis=1)
+    N_selected = np.sum(mask, axis=1)
+    out = np.zeros(X.shape[0], dtype=np.result_type(X, np.float64))
+    for n in np.unique(N_selected):
+        rows = np.flatnonzero(N_selected == n)
+        out[rows] = np.sum(X_packed[rows,0:n], axis=1)
+    return out
+
+def skaggs_info(rate_matrix, rates, P_x):
+    # Skaggs spatial information in bits per spike for each ratemap
+    # rate_matrix: ratemaps along the last axis (... x bins); rates: mean rate of each ratemap (...); P_x: occupancy probability of the bins
+    # only bins with positive rate are summed, as np.sum(lambda_x[i_nonzero]*np.log2(lambda_x[i_nonzero]/mean_firing)*P_x[i_nonzero]) / mean_firing
+    shape = rate_matrix.shape[0:-1]
+    lambda_x = np.ascontiguousarray(rate_matrix).reshape(-1, rate_matrix.shape[-1])
+    mean_firing = np.reshape(rates, (-1,1))
+    i_nonzero = lambda_x > 0
+    log_lambda = np.zeros_like(lambda_x)
+    np.log2(np.divide(lambda_x, mean_firing, out=np.ones_like(lambda_x), where=i_nonzero), out=log_lambda, where=i_nonzero)
+    skaggs = masked_row_sum(lambda_x * log_lambda * P_x, i_nonzero) / mean_firing[:,0]
+    return skaggs.reshape(shape)
+
+def tuning_specificity(rate_matrix, xbins, corridor_length):
+    # linear tuning specificity of each ratemap: corridor length / SD of the positions weighted by the ratemap above its mean
+    # rate_matrix: ratemaps along the last axis (... x bins); xbins: the center of the bins
+    shape = rate_matrix.shape[0:-1]
+    rr = np.array(rate_matrix, order='C').reshape(-1, rate_matrix.shape[-1]) # a contiguous copy
+    rr[rr < np.mean(rr, axis=1, keepdims=True)] = 0
+    Px = rr / np.sum(rr, axis=1, keepdims=True)
+    mu = np.sum(Px * xbins, axis=1)
+    mu_squared = np.array([m**2 for m in mu]) # scalar power, rounded as in the single ratemap calculation
+    sigma = np.sqrt(np.sum(Px * xbins**2, axis=1) - mu_squared)
+    return (corridor_length / sigma).reshape(shape)
+
+def placefield_candidates(rate_matrix, act_tensor, i_laps):
+    # candidate place cells with at least 1 place field according to Hainmuller and Bartos 2018, for all cells and shuffles at once
+    # rate_matrix: bins x cells x shuffles ratemaps; act_tensor: bins x cells x laps x shuffles activity; i_laps: the laps of the corridor
+    # 1) the place field is the first longest region of at least 3 bins above baseline + 0.25 x (peak - baseline), 
+    #    where the baseline is the average of the lowest 12 bins (~25%)
+    # 2) the average rate in the field is at least 7x the average rate outside
+    # 3) the total activity in the field is larger than 0.6 in at least 20% of the laps
+    # returns a cells x shuffles boolean array - the same as processing the ratemaps one by one
+    N_bins, N_cells, N_shuffles = rate_matrix.shape
+    N_laps = len(i_laps)
+    rr = np.ascontiguousarray(np.moveaxis(rate_matrix, 0, 2)).reshape(-1, N_bins) # ratemaps x bins
+    N_maps = rr.shape[0]
+
+    k = min(12, N_bins)
+    lowest = np.sort(np.partition(rr, k-1, axis=1)[:,0:k], axis=1)
+    baseline = np.mean(lowest, axis=1)
+    peak_rate = np.max(rr, axis=1)
+    threshold = baseline + 0.25 * (peak_rate - baseline)
+
+    ## length of the above-threshold region ending in each bin
+    bins = np.arange(N_bins)
+    above = rr > threshold.reshape(-1,1)
+    last_below = np.maximum.accumulate(np.where(above, -1, bins), axis=1)
+    region_length = bins - last_below
+    field_end = np.argmax(region_length, axis=1) # end of the first longest region
+    field_length = region_length[np.arange(N_maps), field_end]
+    field_start = field_end - field_length + 1
+    has_field = field_length > 2
+
+    in_field = (bins >= field_start.reshape(-1,1)) & (bins <= field_end.reshape(-1,1)) & has_field.reshape(-1,1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate_inField = masked_row_sum(rr, in_field) / field_length
+        rate_outField = masked_row_sum(rr, ~in_field) / (N_bins - field_length)
+        rate_ratio = rate_inField / rate_outField
+
+    ## the activity of the laps is summed bin by bin in the field
+    i_cell = np.repeat(np.arange(N_cells), N_shuffles)
+    i_shuffle = np.tile(np.arange(N_shuffles), N_cells)
+    lapsums = np.zeros((N_maps, N_laps), dtype=act_tensor.dtype)
+    for j in range(np.max(field_length * has_field, initial=0)):
+        maps = np.flatnonzero(has_field & (field_length > j))
+        lapsums[maps,:] = lapsums[maps,:] + act_tensor[field_start[maps] + j, i_cell[maps], :, i_shuffle[maps]][:,i_laps]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        active_laps = np.sum(lapsums > 0.6, axis=1) / float(N_laps)
+
+    candidate = has_field & (active_laps > 0.2) & (rate_ratio > 7)
+    return candidate.reshape(N_cells, N_shuffles)
+
+def shuffle_exceedance_counts(stats, N_shuffle):
+    # number of shuffles exceeding the real data - N_shuffle * P(shuffled > measured)
+    # stats: ... x (N_shuffle+1), the last element along the last axis is the real data
+    shuffle_ecdf = stats[...,0:N_shuffle]
+    data_point = stats[...,N_shuffle:(N_shuffle+1)]
+    return np.sum(shuffle_ecdf > data_point, axis=-1)
+
+def shuffle_P_value(stats, N_shuffle):
+    # P value estimated from shuffle control - P(shuffled > measured)
+    # stats: cells x (N_shuffle+1), the last column is the real data
+    return shuffle_exceedance_counts(stats, N_shuffle) / float(N_shuffle)
+
+def count_refractory_events(rise_cells, rise_frames, N_cells, N_frames, refractoriness):
+    # number of events of each cell, an event is counted if it is at least refractoriness frames after the previous counted event
+    # rise_cells, rise_frames: cell and frame of the events, sorted by cell and frame
+    # next_event: the index of the first later event at least refractoriness frames later
+    # we step through the counted events of all cells in parallel
+    step = max(refractoriness, 1) # with refractoriness 0 or 1 all events are counted
+    event_key = rise_cells * (N_frames + step + 1) + rise_frames
+    next_event = np.searchsorted(event_key, event_key + step)
+    cell_first_event = np.searchsorted(rise_cells, np.arange(N_cells))
+    cell_last_event = np.searchsorted(rise_cells, np.arange(N_cells) + 1)
+    n_events = np.zeros(N_cells)
+    current_event = cell_first_event
+    counted = current_event < cell_last_event
+    while np.any(counted):
+        n_events[counted] += 1
+        current_event[counted] = next_event[current_event[counted]]
+        counted = current_event < cell_last_event
+    return n_events
+
 def nan_divide(a, b, where=True):
     'division function that returns np.nan where the division is not defined'
     x = np.zeros_like(a)
@@ -55,6 +254,135 @@ def pol2cart(rho, phi):
     y = rho * np.sin(phi)
     return(x, y)
 
+def hist_mode(X, bins=100):
+    # the left edge of the most populated bin of the histogram of each row of the matrix X
+    # gives the same result as calling np.histogram(X[i,:], bins=bins) for each row i,
+    # and taking the left edge of the first bin with the maximal count
+    X = np.atleast_2d(X)
+    N_rows = X.shape[0]
+    first_edges = np.min(X, axis=1)
+    last_edges = np.max(X, axis=1)
+
+    ## the bin edges only depend on the range and the type of the data
+    edges = np.array([np.histogram_bin_edges(np.array([first_edges[i], last_edges[i]], dtype=X.dtype), bins=bins) for i in range(N_rows)])
+    modes = np.zeros(N_rows, dtype=edges.dtype)
+
+    i_const = np.flatnonzero(first_edges == last_edges) # np.histogram extends the range for constant rows
+    for i in i_const:
+        hist = np.histogram(X[i,:], bins=bins)
+        modes[i] = hist[1][np.argmax(hist[0])]
+    i_rows = np.flatnonzero(first_edges != last_edges)
+    if (len(i_rows) == 0):
+        return modes
+
+    ## the same steps as the fast algorithm of np.histogram for equal bins, but for all rows at once
+    ## this also includes the correction of the bin indices near the bin edges 
+    XX = X[i_rows,:].astype(edges.dtype, copy=False)
+    first = first_edges[i_rows].reshape(-1,1)
+    norm_denom = last_edges[i_rows].reshape(-1,1) - first
+    indices = (((XX - first) / norm_denom) * bins).astype(np.intp)
+    indices[indices == bins] -= 1
+    row_edges = edges[i_rows,:]
+    rows = np.arange(len(i_rows)).reshape(-1,1)
+    decrement = XX < row_edges[rows, indices]
+    indices[decrement] -= 1
+    increment = (XX >= row_edges[rows, indices + 1]) & (indices != bins - 1)
+    indices[increment] += 1
+
+    counts = np.bincount((indices + rows * bins).ravel(), minlength=len(i_rows) * bins).reshape(len(i_rows), bins)
+    modes[i_rows] = row_edges[rows[:,0], np.argmax(counts, axis=1)]
+    return modes
+
+def moving_sum(X, L, exact_at=None):
+    # sum of L consecutive elements along the rows of the matrix X - same as np.convolve(X[i,:], np.ones(L), mode='valid')
+    # the sum is calculated in float64 by adding shifted slices
+    # the rounding errors may be different from np.convolve. If exact_at is given, the rows where the sum is too close to exact_at 
+    # are recalculated with np.convolve, so comparing the output with exact_at gives the same result as with np.convolve
+    # output: N_rows x (N_cols - L + 1) matrix
+    X = np.atleast_2d(X)
+    N_out = X.shape[1] - L + 1
+    S = X[:,0:N_out].astype(np.float64)
+    for k in range(1, L):
+        S += X[:,k:(k+N_out)]
+
+    if (exact_at is not None):
+        ## the error of any summation order is smaller than L * eps * sum(|x|)
+        if (np.min(X) < 0):
+            S_abs = moving_sum(np.abs(X), L)
+        else:
+            S_abs = S
+        max_error = 2 * L * np.finfo(np.float64).eps * S_abs
+        i_rows = np.flatnonzero(np.any(np.abs(S - exact_at) <= max_error, axis=1))
+        filt = np.ones(L)
+        for i in i_rows:
+            S[i,:] = np.convolve(X[i,:], filt, mode='valid')
+    return S
+
+def position_bins(frames_pos, multiplane=False, bin_size=70):
+    # assigns each imaging frame to the position bin of the animal (bin_size roxels)
+    # in multiplane recordings the position may jump several bins between two frames - in this case
+    #   the frame is assigned to all bins since the bin of the previous frame, each with weight 1/n_bins
+    # output: three vectors, one element for each (frame, bin) pair, in the order of the frames:
+    #   i_frames: index of the frame
+    #   i_bins: index of the position bin
+    #   n_bins: number of bins the frame is assigned to
+    next_bins = np.floor_divide(frames_pos, bin_size).astype(int)
+    last_bins = np.hstack([0, next_bins[0:-1]]) # the bin before the first frame is 0
+    if (multiplane):
+        spread = next_bins > last_bins + 1
+    else:
+        spread = np.zeros(len(next_bins), dtype=bool)
+    n_bins = np.where(spread, next_bins - last_bins, 1)
+    first_bins = np.where(spread, last_bins + 1, next_bins)
+
+    i_frames = np.repeat(np.arange(len(next_bins)), n_bins)
+    i_pairs_start = np.cumsum(n_bins) - n_bins
+    i_bins = np.repeat(first_bins, n_bins) + np.arange(len(i_frames)) - np.repeat(i_pairs_start, n_bins)
+    return i_frames, i_bins, np.repeat(n_bins, n_bins)
+
+def bin_sum(values, i_bins, N_bins, axis=0):
+    # sums the values into N_bins bins along the given axis - values can have any number of additional dimensions
+    # i_bins: the index of the bin for each element of values along axis
+    # np.add.at adds the values in the order of their index, so the result is the same as adding them one by one in a loop
+    # negative bin indices are counted from the end, as in python indexing
+    values = np.moveaxis(np.asarray(values), axis, 0)
+    out = np.zeros((N_bins,) + values.shape[1:], dtype=np.result_type(values, np.float64))
+    np.add.at(out, i_bins, values)
+    return np.ascontiguousarray(np.moveaxis(out, 0, axis))
+
+def zone_bins(positions, bin_edges):
+    # the index of the last bin edge that is smaller than the position, for each position
+    # the same as np.max(np.where(pos > bin_edges)), also when the bin edges are not sorted
+    larger = np.asarray(positions).reshape(-1,1) > np.asarray(bin_edges).reshape(1,-1)
+    if (not np.all(np.any(larger, axis=1))):
+        raise ValueError('position smaller than all bin edges')
+    return larger.shape[1] - 1 - np.argmax(larger[:,::-1], axis=1)
+
+def smooth_bins(X, out=None):
+    # spatial smoothing along the first axis (position bins): average of the 3 neighbouring bins, 2 bins at the edges
+    # the result is written into out (allocated if None) using shifted slices, without temporary arrays
+    # the additions are done in the same order as np.average, so the result is the same
+    if out is None:
+        out = np.empty(X.shape, dtype=np.result_type(X, np.float64))
+    np.add(X[0], X[1], out=out[0])
+    np.divide(out[0], 2, out=out[0])
+    np.add(X[-2], X[-1], out=out[-1])
+    np.divide(out[-1], 2, out=out[-1])
+    inner = out[1:-1]
+    np.add(X[0:-2], X[1:-1], out=inner)
+    np.add(inner, X[2:], out=inner)
+    np.divide(inner, 3, out=inner)
+    return out
+
+def lap_frames(frame_laps, i_lap):
+    # the imaging frames belonging to lap i_lap
+    # the frames of a lap are contiguous, so a slice is returned and indexing the session arrays with it gives views, not copies
+    # if the frames are not contiguous, the indices of the frames are returned
+    iframes = np.flatnonzero(frame_laps == i_lap)
+    if ((len(iframes) > 0) and (iframes[-1] - iframes[0] + 1 == len(iframes))):
+        return slice(iframes[0], iframes[-1] + 1)
+    return iframes
+
 
 def test_vcorrcoeff():
     X = np.arange(24).reshape(6,4)
@@ -129,5 +457,147 @@ def test_Mcorrcoeff():
 
     return True
     
+def test_count_refractory_events():
+    rise_cells = np.array([0, 0, 0, 0, 2, 2, 2])
+    rise_frames = np.array([1, 2, 3, 10, 0, 5, 6])
+
+    for refractoriness, expected in [(0, [4, 0, 3]), (1, [4, 0, 3]), (2, [3, 0, 2]), (5, [2, 0, 2]), (20, [1, 0, 1])]:
+        n_events = count_refractory_events(rise_cells, rise_frames, 3, 12, refractoriness)
+        if (not np.array_equal(n_events, expected)):
+            print('Error: refractoriness', refractoriness)
+            return False
+
+    return True
+
+def test_placefield_candidates():
+    # compared to the cell by cell implementation of the criteria of Hainmuller and Bartos 2018
+    rng = np.random.default_rng(17)
+    N_bins, N_cells, N_laps, N_shuffles = 20, 6, 10, 4
+    rate_matrix = rng.random((N_bins, N_cells, N_shuffles)) * 0.1
+    for i_cell in range(N_cells):
+        for i_shuffle in range(N_shuffles):
+            start = rng.integers(N_bins - 6)
+            rate_matrix[start:(start + rng.integers(2, 7)), i_cell, i_shuffle] += rng.random() * 3
+    rate_matrix[:,0,0] = 0.5 # flat ratemap, no place field
+    act_tensor = rng.random((N_bins, N_cells, N_laps, N_shuffles)) * 0.4
+    i_laps = np.array([0, 2, 3, 4, 5, 7, 8, 9])
+    candidate = placefield_candidates(rate_matrix, act_tensor, i_laps)
+
+    for i_cell in range(N_cells):
+        for i_shuffle in range(N_shuffles):
+            rate_i = rate_matrix[:,i_cell,i_shuffle]
+            baseline = np.mean(np.sort(rate_i)[:12])
+            threshold = baseline + 0.25 * (np.max(rate_i) - baseline)
+            placefield_start, placefield_length, candidate_start, candidate_length = np.nan, 0, 0, 0
+            for k in range(N_bins):
+                if (rate_i[k] > threshold):
+                    candidate_length = candidate_length + 1
+                    if (candidate_length == 1):
+                        candidate_start = k
+                    elif ((candidate_length > 2) & (candidate_length > placefield_length)):
+                        placefield_length = candidate_length
+                        placefield_start = candidate_start
+                else:
+                    candidate_length = 0
+            is_candidate = False
+            if (not(np.isnan(placefield_start))):
+                index_infield = np.arange(placefield_start, placefield_start + placefield_length)
+                index_outfield = np.setdiff1d(np.arange(N_bins), index_infield)
+                rate_ratio = np.mean(rate_i[index_infield]) / np.mean(rate_i[index_outfield])
+                lapsums = act_tensor[:,:,i_laps,:][index_infield,i_cell,:,i_shuffle].sum(0)
+                is_candidate = ((sum(lapsums > 0.6) / float(len(i_laps))) > 0.2) & (rate_ratio > 7)
+            if (candidate[i_cell, i_shuffle] != is_candidate):
+                print('Error: placefield_candidates', i_cell, i_shuffle)
+                return False
+
+    return True
+
+def test_corridor_similarity():
+    # compared to Mcorrcoef applied to each pair of corridors, as in the loop over the cells
+    rng = np.random.default_rng(22)
+    K, N_bins, N_cells, N_shuffles = 3, 15, 5, 3
+    ratemaps = rng.random((K, N_bins, N_cells, N_shuffles))
+    ratemaps[1,4,2,:] = np.nan
+    ratemaps[0,:,3,1] = 2 # zero variance
+    similarity = corridor_similarity(ratemaps, zero_var_out=0)
+
+    for i_cor in range(K):
+        for j_cor in range(K):
+            for i_cell in range(N_cells):
+                r = Mcorrcoef(np.transpose(ratemaps[i_cor,:,i_cell,:]), np.transpose(ratemaps[j_cor,:,i_cell,:]), zero_var_out=0)
+                if (i_cor == j_cor):
+                    r = np.where(r != 0, 1, 0) # the diagonal is set to 1 where the variance is not 0
+                if (not np.array_equal(similarity[i_cor,j_cor,i_cell], r, equal_nan=True)):
+                    print('Error: corridor_similarity', i_cor, j_cor, i_cell)
+                    return False
+
+    return True
+
+def test_popvec_corrcoef():
+    # compared to np.corrcoef of the population vectors in each bin
+    rng = np.random.default_rng(24)
+    N_laps, N_bins, N_cells, K = 4, 6, 7, 2
+    X = rng.random((N_laps, N_bins, N_cells))
+    Y = rng.random((K, N_bins, N_cells))
+    X[1,2,3] = np.nan
+    X[2,4,:] = 0 # zero variance
+    Y[1,0,:] = 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = popvec_corrcoef(X, Y)
+        for k in range(K):
+            for i_lap in range(N_laps):
+                for i_bin in range(N_bins):
+                    r_ref = np.corrcoef(X[i_lap,i_bin,:], Y[k,i_bin,:])[0,1]
+                    if ((np.isnan(r_ref) != np.isnan(r[k,i_lap,i_bin])) | (np.abs(r_ref - r[k,i_lap,i_bin]) > 1e-10)):
+                        print('Error: popvec_corrcoef', k, i_lap, i_bin)
+                        return False
+
+    return True
+
+def test_cross_corrcoef():
+    # compared to np.corrcoef of the stacked rows, also for corrcoef_matrix
+    rng = np.random.default_rng(25)
+    X = rng.random((6, 9))
+    Y = rng.random((4, 9))
+    X[2,5] = np.nan
+    X[4,:] = 3 # zero variance
+    Y[1,:] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_ref = np.corrcoef(X, Y)
+        for r, r_ref_block in [(cross_corrcoef(X, Y), r_ref[0:6,6:]), (corrcoef_matrix(X), r_ref[0:6,0:6])]:
+            if (not np.array_equal(np.isnan(r), np.isnan(r_ref_block))):
+                print('Error: cross_corrcoef nan')
+                return False
+            if (np.nanmax(np.abs(r - r_ref_block)) > 1e-10):
+                print('Error: cross_corrcoef')
+                return False
+
+    return True
+
+def test_hist_mode():
+    # compared to np.histogram called row by row, with many values on or near the bin edges
+    rng = np.random.default_rng(6)
+    for bins in [10, 100]:
+        X = np.vstack([np.tile(np.linspace(0, 1, 201), 2)[:300], # every 2nd value on a bin edge
+                       np.round(rng.random(300) * 20) / 10, # ties on the edges
+                       np.arange(300) * 0.1 - 7.3, # edges with rounding errors
+                       rng.standard_normal(300),
+                       np.repeat(2.5, 300)]) # constant row
+        for X_type in [X, X.astype(np.float32), np.round(X * 10).astype(int)]:
+            modes = hist_mode(X_type, bins=bins)
+            for i in range(X_type.shape[0]):
+                hist = np.histogram(X_type[i,:], bins=bins)
+                if (modes[i] != hist[1][np.argmax(hist[0])]):
+                    print('Error: hist_mode', bins, X_type.dtype, i)
+                    return False
+
+    return True
+
 test_vcorrcoeff()
 test_Mcorrcoeff()
+test_count_refractory_events()
+test_placefield_candidates()
+test_corridor_similarity()
+test_popvec_corrcoef()
+test_cross_corrcoef()
+test_hist_mode()